@@ -0,0 +1,21 @@
+from session_store import SessionStore
+
+ADDED_TRACKS_FILE = "./playlist-added-tracks.json"
+
+
+class AddedTracks:
+    """
+    The tracks this tool added to each playlist, with the channel titles they were found for.
+    Pruning only removes tracks recorded here whose titles are all gone from the channel, so tracks
+    added by hand, or whose title just didn't match this time, stay in the playlist.
+    """
+
+    def __init__(self, path=ADDED_TRACKS_FILE):
+        self.store = SessionStore(path)
+
+    def get(self, playlist_key):
+        """URI -> titles it was added for, of the playlist (or shards name) playlist_key"""
+        return {uri: list(titles) for uri, titles in self.store.get(playlist_key, {}).items()}
+
+    def save(self, playlist_key, tracks):
+        self.store.update(**{playlist_key: tracks})
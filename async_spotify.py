@@ -0,0 +1,185 @@
+import asyncio
+import httpx
+from time import perf_counter, time
+from metrics import METRICS
+from rate_limiter import AdaptiveRateLimiter, parse_retry_after
+
+API_URL = "https://api.spotify.com/v1/"
+TOKEN_URL = "https://accounts.spotify.com/api/token"
+
+
+class AsyncSpotifyClient:
+    """
+    Minimal asyncio Spotify Web API client for the calls the migration needs. Requests share one
+    pooled httpx client with keep-alive (and HTTP/2 multiplexing), so many requests can be in
+    flight over a few reused connections, and they go through the same rate limiter as the
+    blocking client.
+    """
+
+    # How many times a throttled or failed request is retried before giving up
+    RETRIES = 5
+    # Not POST: a write that failed after Spotify applied it would be applied twice. Requests that
+    # never reached Spotify (connection errors) and 429s are retried whatever their method
+    IDEMPOTENT_METHODS = frozenset(["GET", "PUT", "DELETE"])
+    UNSENT_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+    # Refresh the access token when it expires within this many seconds
+    REFRESH_MARGIN = 60
+
+    def __init__(self, client_id, client_secret, access_token=None, refresh_token=None, expires_at=0,
+                 rate_limiter=None, max_connections=10, on_token_refresh=None, base_url=API_URL, token_manager=None):
+        self.client_id = client_id
+        self.client_secret = client_secret
+        # With a TokenManager the token is shared with the blocking client, and refreshed through it
+        self.token_manager = token_manager
+        if token_manager:
+            access_token = token_manager.access_token
+            refresh_token = token_manager.refresh_token
+            expires_at = token_manager.expires_at
+        self.access_token = access_token
+        self.refresh_token = refresh_token
+        self.expires_at = expires_at or 0
+        self.rate_limiter = rate_limiter
+        self.on_token_refresh = on_token_refresh
+        self.refresh_lock = asyncio.Lock()
+        self.client = httpx.AsyncClient(
+            base_url=base_url,
+            http2=True,
+            timeout=httpx.Timeout(10.0),
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections,
+                                keepalive_expiry=30.0)
+        )
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def close(self):
+        await self.client.aclose()
+
+    async def refresh_access_token(self):
+        """Exchange the refresh token for a new access token"""
+        async with self.refresh_lock:
+            return await self._refresh()
+
+    async def ensure_token(self):
+        """Refresh the access token if it is about to expire"""
+        if self.token_manager:
+            # Usually already refreshed in the background, then this is just an attribute read
+            if not self.token_manager.is_valid(self.REFRESH_MARGIN) and self.token_manager.refresh_token:
+                await asyncio.to_thread(self.token_manager.get_access_token)
+            self.access_token = self.token_manager.access_token
+            return
+        if not self.refresh_token or not self.expires_at or self.expires_at - time() >= self.REFRESH_MARGIN:
+            return
+        async with self.refresh_lock:
+            # Another request may have refreshed it while we were waiting for the lock
+            if self.expires_at - time() < self.REFRESH_MARGIN:
+                await self._refresh()
+
+    async def _refresh(self):
+        if self.token_manager:
+            token_info = await asyncio.to_thread(self.token_manager.refresh)
+            self.access_token = self.token_manager.access_token
+            return token_info
+        if not self.refresh_token:
+            raise Exception("No Spotify refresh token available")
+
+        with METRICS.time("spotify_token_refresh_seconds"):
+            response = await self.client.post(
+                TOKEN_URL,
+                data={"grant_type": "refresh_token", "refresh_token": self.refresh_token},
+                auth=(self.client_id, self.client_secret)
+            )
+        response.raise_for_status()
+        token_info = response.json()
+        # Spotify only sometimes rotates the refresh token
+        token_info.setdefault("refresh_token", self.refresh_token)
+        token_info["expires_at"] = int(time()) + token_info["expires_in"]
+
+        self.access_token = token_info["access_token"]
+        self.refresh_token = token_info["refresh_token"]
+        self.expires_at = token_info["expires_at"]
+        if self.on_token_refresh:
+            self.on_token_refresh(token_info)
+        return token_info
+
+    async def request(self, method, path, endpoint=None, **kwargs):
+        """
+        Send an API request, refreshing the token, waiting out 429s and retrying 5xx responses.
+        endpoint labels the request in the metrics, named after the matching spotipy method.
+        """
+        endpoint = endpoint or path.split("/")[0]
+        idempotent = method in self.IDEMPOTENT_METHODS
+        for attempt in range(self.RETRIES + 1):
+            await self.ensure_token()
+            if self.rate_limiter:
+                await self.rate_limiter.wait_async()
+
+            start = perf_counter()
+            try:
+                response = await self.client.request(
+                    method, path, headers={"Authorization": f"Bearer {self.access_token}"}, **kwargs)
+            except httpx.TransportError as e:
+                METRICS.inc("spotify_errors_total", endpoint=endpoint, status="transport")
+                if attempt == self.RETRIES or not (idempotent or isinstance(e, self.UNSENT_ERRORS)):
+                    raise
+                METRICS.inc("spotify_retries_total", endpoint=endpoint, reason="transport")
+                await asyncio.sleep(0.3 * 2 ** attempt)
+                continue
+            finally:
+                METRICS.inc("spotify_requests_total", endpoint=endpoint)
+                METRICS.observe("spotify_request_seconds", perf_counter() - start, endpoint=endpoint)
+
+            METRICS.inc("spotify_response_bytes_total", len(response.content))
+            if response.status_code >= 400:
+                METRICS.inc("spotify_errors_total", endpoint=endpoint, status=response.status_code)
+
+            if response.status_code == 429 and attempt < self.RETRIES:
+                METRICS.inc("spotify_retries_total", endpoint=endpoint, reason=429)
+                retry_after = parse_retry_after(response.headers.get("Retry-After"))
+                if retry_after is None:
+                    retry_after = AdaptiveRateLimiter.DEFAULT_RETRY_AFTER
+                print(f"Rate limited by Spotify, pausing for {retry_after}s...")
+                if self.rate_limiter:
+                    self.rate_limiter.on_throttle(retry_after)
+                else:
+                    await asyncio.sleep(retry_after)
+                continue
+            if response.status_code == 401 and self.refresh_token and attempt == 0:
+                METRICS.inc("spotify_retries_total", endpoint=endpoint, reason=401)
+                await self.refresh_access_token()
+                continue
+            if response.status_code >= 500 and idempotent and attempt < self.RETRIES:
+                METRICS.inc("spotify_retries_total", endpoint=endpoint, reason="5xx")
+                await asyncio.sleep(0.3 * 2 ** attempt)
+                continue
+
+            response.raise_for_status()
+            if self.rate_limiter:
+                self.rate_limiter.on_success()
+            return response.json() if response.content else {}
+
+    async def search(self, query, limit=5):
+        """Return compact candidates for a track search, in the same format as Spotify.fetch_candidates"""
+        results = await self.request("GET", "search", "search", params={"q": query, "type": "track", "limit": limit})
+        return [{
+            'id': track['id'],
+            'name': track['name'],
+            'artist': track['artists'][0]['name'],
+            'uri': track['uri']
+        } for track in results['tracks']['items']]
+
+    async def get_playlist_state(self, playlist_id):
+        """Read the track URIs of a playlist page by page, returns (set of URIs, snapshot ID)"""
+        playlist = await self.request("GET", f"playlists/{playlist_id}", "playlist",
+                                      params={"fields": "snapshot_id,tracks(items(track(uri)),next)"})
+        page = playlist["tracks"]
+        uris = set()
+        while page:
+            uris.update(item["track"]["uri"] for item in page["items"] if item.get("track"))
+            if not page.get("next"):
+                break
+            page = await self.request("GET", page["next"], "next")
+        return uris, playlist["snapshot_id"]
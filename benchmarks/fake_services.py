@@ -0,0 +1,272 @@
+"""
+Local stand-ins for the Spotify Web API and a Telegram channel, so the migration can be measured
+without live accounts. Both have a configurable catalog size, latency and throttling rate.
+"""
+import asyncio
+import json
+import random
+import re
+import time
+import zlib
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+from urllib.parse import parse_qs, urlparse
+
+from telethon.tl.types import (DocumentAttributeAudio, DocumentAttributeFilename, Document, InputMessagesFilterMusic,
+                               MessageMediaDocument)
+
+from similarity_benchmark import random_title
+
+
+# track:"..." and artist:"..." filters of a search query
+FIELD_PATTERN = re.compile(r'(track|artist):"([^"]*)"')
+
+
+def make_catalog(size, seed=7):
+    """Unique "name - artist" titles, the same ones for the same size and seed"""
+    rng = random.Random(seed)
+    catalog = list(dict.fromkeys(random_title(rng) for _ in range(size * 2)))
+    # The generator only has so many word combinations, number the rest
+    catalog += [f"Track {i} - Artist {i % 997}" for i in range(len(catalog), size)]
+    return catalog[:size]
+
+
+def make_titles(catalog, count, hit_rate=0.8, seed=11):
+    """Channel titles: mostly songs from the catalog (reposts included), the rest unknown to Spotify"""
+    rng = random.Random(seed)
+    return [rng.choice(catalog) if rng.random() < hit_rate else f"{random_title(rng)} (bootleg {i})"
+            for i in range(count)]
+
+
+class FakeSpotifyServer:
+    """
+    Serves the search, playlist creation, playlist read, add and remove endpoints on localhost,
+    for any number of playlists.
+    Point spotipy at it with prefix=server.prefix. A throttle_rate share of the requests is
+    answered with 429 and a Retry-After of retry_after seconds. Like the real API, tracks are added
+    one request at a time per playlist, at the requested position if any, and a write_error_rate
+    share of the additions is answered with 502 after being applied.
+    """
+
+    def __init__(self, catalog, latency=0.0, throttle_rate=0.0, retry_after=0.1, seed=3, write_error_rate=0.0):
+        self.catalog = catalog
+        self.index = {title.lower(): i for i, title in enumerate(catalog)}
+        self.names = {}
+        for i, title in enumerate(catalog):
+            self.names.setdefault(title.rpartition(" - ")[0].lower(), []).append(i)
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.write_error_rate = write_error_rate
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.lock = Lock()
+        self.requests = 0
+        self.throttled = 0
+        self.playlists = {}  # playlist ID -> track URIs
+        self.snapshots = {}  # playlist ID -> snapshot number
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # Keep-alive, like the real API
+            protocol_version = "HTTP/1.1"
+            # Headers and body are written separately, don't let Nagle hold the body back
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                server.handle(self, "GET")
+
+            def do_POST(self):
+                server.handle(self, "POST")
+
+            def do_DELETE(self):
+                server.handle(self, "DELETE")
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.httpd.daemon_threads = True
+        self.thread = Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def prefix(self):
+        return f"http://127.0.0.1:{self.httpd.server_address[1]}/v1/"
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def track(self, i):
+        name, _, artist = self.catalog[i].rpartition(" - ")
+        return {"id": f"t{i}", "name": name, "artists": [{"name": artist}], "uri": f"spotify:track:t{i}"}
+
+    def search(self, query, limit):
+        """
+        Field queries return only the tracks matching every filter. Free text queries return the
+        exact match first when the catalog has one, padded with unrelated tracks.
+        """
+        fields = dict(FIELD_PATTERN.findall(query.lower()))
+        if fields:
+            matches = [i for i in self.names.get(fields.get("track", ""), [])
+                       if "artist" not in fields or self.catalog[i].lower().endswith(" - " + fields["artist"])]
+            return [self.track(i) for i in matches[:limit]]
+
+        hit = self.index.get(query.lower())
+        start = hit if hit is not None else zlib.crc32(query.encode()) % len(self.catalog)
+        return [self.track((start + offset) % len(self.catalog)) for offset in range(min(limit, len(self.catalog)))]
+
+    def handle(self, request, method):
+        url = urlparse(request.path)
+        body = request.rfile.read(int(request.headers.get("Content-Length") or 0))
+        if self.latency:
+            time.sleep(self.latency)
+
+        with self.lock:
+            self.requests += 1
+            throttled = self.throttle_rate and self.random.random() < self.throttle_rate
+            if throttled:
+                self.throttled += 1
+        if throttled:
+            return self.respond(request, 429, {"error": {"status": 429, "message": "API rate limit exceeded"}},
+                                {"Retry-After": str(self.retry_after)})
+
+        path = url.path[len("/v1/"):]
+        if method == "GET" and path == "search":
+            params = parse_qs(url.query)
+            items = self.search(params["q"][0], int(params.get("limit", ["10"])[0]))
+            return self.respond(request, 200, {"tracks": {"items": items, "next": None}})
+        if method == "POST" and path.endswith("/playlists"):
+            with self.lock:
+                playlist_id = f"benchmarkPlaylist{len(self.playlists) + 1}"
+                self.playlists[playlist_id] = []
+                self.snapshots[playlist_id] = 0
+            return self.respond(request, 201, {"id": playlist_id})
+        playlist_id = path.split("/")[1] if path.startswith("playlists/") else None
+        if playlist_id not in self.playlists:
+            return self.respond(request, 404, {"error": {"status": 404, "message": "Not found"}})
+        if method == "POST":
+            payload = json.loads(body)
+            uris = payload["uris"] if isinstance(payload, dict) else payload
+            # spotipy sends the position as a query parameter, AsyncSpotifyClient in the body
+            position = parse_qs(url.query).get("position", [None])[0]
+            if position is None and isinstance(payload, dict):
+                position = payload.get("position")
+            with self.lock:
+                tracks = self.playlists[playlist_id]
+                position = len(tracks) if position is None else int(position)
+                if position > len(tracks):
+                    return self.respond(request, 400, {"error": {"status": 400, "message": "Index out of bounds"}})
+                tracks[position:position] = uris
+                self.snapshots[playlist_id] += 1
+                snapshot = str(self.snapshots[playlist_id])
+                failed = self.write_error_rate and self.random.random() < self.write_error_rate
+            if failed:
+                return self.respond(request, 502, {"error": {"status": 502, "message": "Bad gateway"}})
+            return self.respond(request, 201, {"snapshot_id": snapshot})
+        if method == "DELETE":
+            with self.lock:
+                removed = {item["uri"] for item in json.loads(body)["items"]}
+                self.playlists[playlist_id] = [uri for uri in self.playlists[playlist_id] if uri not in removed]
+                self.snapshots[playlist_id] += 1
+                snapshot = str(self.snapshots[playlist_id])
+            return self.respond(request, 200, {"snapshot_id": snapshot})
+        if method == "GET" and path.endswith(("/items", "/tracks")):
+            params = parse_qs(url.query)
+            offset = int(params.get("offset", ["0"])[0])
+            limit = int(params.get("limit", ["100"])[0])
+            with self.lock:
+                items = [{"track": {"uri": uri}} for uri in self.playlists[playlist_id][offset:offset + limit]]
+            return self.respond(request, 200, {"items": items, "next": None})
+        if method == "GET":
+            with self.lock:
+                items = [{"track": {"uri": uri}} for uri in self.playlists[playlist_id]]
+                snapshot = str(self.snapshots[playlist_id])
+            return self.respond(request, 200, {"snapshot_id": snapshot,
+                                               "tracks": {"items": items, "total": len(items), "next": None}})
+        self.respond(request, 404, {"error": {"status": 404, "message": "Not found"}})
+
+    @staticmethod
+    def respond(request, status, payload, headers=None):
+        data = json.dumps(payload).encode()
+        request.send_response(status)
+        request.send_header("Content-Type", "application/json")
+        request.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            request.send_header(name, value)
+        request.end_headers()
+        request.wfile.write(data)
+
+
+class FakeMessage:
+    def __init__(self, id, media):
+        self.id = id
+        self.media = media
+        self.date = datetime.now(timezone.utc)
+
+
+class FakeTelegramClient:
+    """
+    Replaces the TelegramClient of a Telegram instance. Messages come in pages of 100 like
+    Telethon fetches them, each page taking `latency` seconds. A flood_rate share of the pages
+    hits a flood wait of flood_wait seconds, which Telethon would sleep through by itself.
+    With InputMessagesFilterMusic only the audio messages are paged through, like Telegram does.
+    """
+
+    PAGE_SIZE = 100
+
+    def __init__(self, titles, latency=0.0, flood_rate=0.0, flood_wait=0.1, seed=5):
+        # Every tenth message is text only
+        media = []
+        for i, title in enumerate(titles):
+            name, _, performer = title.rpartition(" - ")
+            media.append(self.audio(i, name, performer))
+            if i % 9 == 8:
+                media.append(None)
+        # Newest message first, like Telethon returns them
+        self.messages = [FakeMessage(len(media) - n, item) for n, item in enumerate(media)]
+        self.latency = latency
+        self.flood_rate = flood_rate
+        self.flood_wait = flood_wait
+        self.random = random.Random(seed)
+        self.pages = 0
+        self.floods = 0
+        self.page_latencies = []
+
+    @staticmethod
+    def audio(i, title, performer):
+        document = Document(id=i, access_hash=0, file_reference=b"", date=None, mime_type="audio/mpeg",
+                            size=4_000_000, dc_id=1, attributes=[
+                                DocumentAttributeAudio(duration=200, title=title or None, performer=performer or None),
+                                DocumentAttributeFilename(file_name=f"{title}.mp3")
+                            ])
+        return MessageMediaDocument(document=document)
+
+    def is_connected(self):
+        return True
+
+    async def connect(self):
+        pass
+
+    async def get_entity(self, channel_username):
+        return channel_username
+
+    async def iter_messages(self, channel, limit=None, min_id=0, filter=None):
+        messages = [msg for msg in self.messages if msg.id > min_id
+                    and (filter is not InputMessagesFilterMusic or msg.media is not None)][:limit]
+        for page_start in range(0, len(messages), self.PAGE_SIZE):
+            start = time.perf_counter()
+            self.pages += 1
+            if self.flood_rate and self.random.random() < self.flood_rate:
+                self.floods += 1
+                await asyncio.sleep(self.flood_wait)
+            if self.latency:
+                await asyncio.sleep(self.latency)
+            self.page_latencies.append(time.perf_counter() - start)
+            for msg in messages[page_start:page_start + self.PAGE_SIZE]:
+                yield msg
@@ -0,0 +1,271 @@
+"""
+End-to-end benchmark of the migration against local stand-ins for Telegram and the Spotify Web API
+(see fake_services.py), so no accounts are needed. Each scenario runs in a fresh process, so the
+peak RSS it reports is its own.
+
+Scenarios:
+  telegram    Telegram.get_music_files over a fake channel
+  similarity  calculate_similarity over title pairs
+  migrate     Spotify.migrate_tracks against the fake Web API
+  catalog     CatalogIndex.match_all against a local catalog export of the fake catalog
+  shards      Spotify.migrate_tracks into playlists of --shard-size tracks (PlaylistShards)
+
+Usage: python benchmarks/migration_benchmark.py [--sizes 1000,10000,100000] [--latency 0.005]
+                                                [--throttle-rate 0.01] [--output results.json]
+                                                [--compare previous-results.json]
+"""
+import argparse
+import asyncio
+import json
+import logging
+import platform
+import resource
+import subprocess
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import redirect_stdout
+from multiprocessing import get_context
+from os import chdir, devnull, getcwd, path
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+
+import spotipy  # noqa: E402
+from fake_services import FakeSpotifyServer, FakeTelegramClient, make_catalog, make_titles  # noqa: E402
+from similarity_benchmark import make_pairs  # noqa: E402
+from catalog_index import CatalogIndex  # noqa: E402
+from playlist_shards import PlaylistShards  # noqa: E402
+from query_planner import QueryPlanner  # noqa: E402
+from spotify import Spotify, build_requests_session  # noqa: E402
+from telegram import Telegram  # noqa: E402
+from utils import calculate_similarity, split_title  # noqa: E402
+
+SCENARIOS = ("telegram", "similarity", "migrate", "catalog", "shards")
+
+
+class LocalSpotify(Spotify):
+    """Spotify client talking to the fake Web API with a fixed token, without OAuth or session_tokens.json"""
+
+    def __init__(self, prefix, max_requests_per_second=None, query_planner=None):
+        self.prefix = prefix
+        self.latencies = []
+        super().__init__("benchmark", "benchmark", "http://127.0.0.1/callback", "benchmark-user",
+                         max_requests_per_second, query_planner=query_planner)
+
+    def initialize_client(self):
+        session = build_requests_session()
+        send = session.request
+
+        # Every HTTP request spotipy makes, throttled ones included
+        def timed_request(*args, **kwargs):
+            start = perf_counter()
+            try:
+                return send(*args, **kwargs)
+            finally:
+                self.latencies.append(perf_counter() - start)
+
+        session.request = timed_request
+        self.spotify = spotipy.Spotify(auth="benchmark-token", requests_session=session)
+        # spotipy sends every relative API path to this prefix
+        self.spotify.prefix = self.prefix
+
+
+def percentiles(latencies):
+    """p50 and p99 in milliseconds (nearest rank)"""
+    if not latencies:
+        return {"p50": None, "p99": None}
+    latencies = sorted(latencies)
+    rank = lambda p: latencies[min(len(latencies) - 1, int(p * len(latencies)))]  # noqa: E731
+    return {"p50": round(rank(0.50) * 1000, 3), "p99": round(rank(0.99) * 1000, 3)}
+
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def bench_telegram(size, options):
+    titles = make_titles(make_catalog(options.catalog_size), size, options.hit_rate)
+    client = FakeTelegramClient(titles, options.latency, options.throttle_rate, options.retry_after)
+    telegram = Telegram(1, "benchmark", "@benchmark")
+    telegram.client = client
+
+    start = perf_counter()
+    musics = asyncio.run(telegram.get_music_files(limit=len(client.messages)))
+    return {"seconds": perf_counter() - start, "tracks": len(musics), "api_calls": client.pages,
+            "throttled": client.floods, "latency_ms": percentiles(client.page_latencies)}
+
+
+def bench_similarity(size, options):
+    pairs = make_pairs(size)
+    latencies = []
+
+    start = perf_counter()
+    for a, b in pairs:
+        call_start = perf_counter()
+        calculate_similarity(a, b, options.threshold)
+        latencies.append(perf_counter() - call_start)
+    return {"seconds": perf_counter() - start, "tracks": len(pairs), "api_calls": 0, "throttled": 0,
+            "latency_ms": percentiles(latencies)}
+
+
+def bench_migrate(size, options):
+    catalog = make_catalog(options.catalog_size)
+    titles = make_titles(catalog, size, options.hit_rate)
+    with FakeSpotifyServer(catalog, options.latency, options.throttle_rate, options.retry_after,
+                           write_error_rate=options.write_error_rate) as server:
+        query_planner = QueryPlanner(options.stop_similarity) if options.query_planner else None
+        spotify = LocalSpotify(server.prefix, options.max_rps, query_planner)
+
+        start = perf_counter()
+        result = spotify.migrate_tracks(titles, similarity_threshold=options.threshold, workers=options.workers,
+                                        dedupe=options.dedupe, write_concurrency=options.write_concurrency)
+        elapsed = perf_counter() - start
+    return {"seconds": elapsed, "tracks": len(titles), "found": result["found_tracks"],
+            "writes": result["write_stats"], "api_calls": server.requests, "throttled": server.throttled,
+            "latency_ms": percentiles(spotify.latencies),
+            **({"query_plan": query_planner.stats()} if query_planner else {})}
+
+
+def bench_shards(size, options):
+    catalog = make_catalog(options.catalog_size)
+    titles = make_titles(catalog, size, options.hit_rate)
+    with FakeSpotifyServer(catalog, options.latency, options.throttle_rate, options.retry_after,
+                           write_error_rate=options.write_error_rate) as server:
+        spotify = LocalSpotify(server.prefix, options.max_rps)
+        # The mapping file lands in the scenario's scratch directory
+        shards = PlaylistShards(spotify, "Benchmark", "", "playlist-shards.json", options.shard_size,
+                                options.write_concurrency)
+
+        start = perf_counter()
+        result = spotify.migrate_tracks(titles, similarity_threshold=options.threshold, workers=options.workers,
+                                        dedupe=options.dedupe, shards=shards)
+        elapsed = perf_counter() - start
+    return {"seconds": elapsed, "tracks": len(titles), "found": result["found_tracks"],
+            "shards": len(shards.shards), "writes": result["write_stats"], "api_calls": server.requests,
+            "throttled": server.throttled,
+            "latency_ms": percentiles(spotify.latencies)}
+
+
+def bench_catalog(size, options):
+    catalog = make_catalog(options.catalog_size)
+    titles = make_titles(catalog, size, options.hit_rate)
+    index = CatalogIndex(options.catalog_workers)
+    for i, title in enumerate(catalog):
+        name, artist = split_title(title)
+        index.add(name, artist, f"spotify:track:{i}")
+
+    start = perf_counter()
+    tracks = index.match_all(titles, options.threshold)
+    return {"seconds": perf_counter() - start, "tracks": len(titles), "found": sum(1 for track in tracks if track),
+            "api_calls": 0, "throttled": 0, "latency_ms": percentiles([])}
+
+
+def run_scenario(scenario, size, options):
+    """Run one scenario in a scratch directory with its output silenced, returns its measurements"""
+    logging.getLogger("spotipy").setLevel(logging.CRITICAL)
+    cwd = getcwd()
+    with TemporaryDirectory() as workdir, open(devnull, "w") as sink:
+        # Scenarios write their files (e.g. the shards mapping) to the working directory
+        chdir(workdir)
+        try:
+            with redirect_stdout(sink):
+                result = globals()[f"bench_{scenario}"](size, options)
+        finally:
+            chdir(cwd)
+
+    seconds = result["seconds"]
+    return {
+        "scenario": scenario,
+        "size": size,
+        **result,
+        "seconds": round(seconds, 3),
+        "tracks_per_sec": round(result["tracks"] / seconds, 1) if seconds else None,
+        "api_calls_per_track": round(result["api_calls"] / result["tracks"], 3) if result["tracks"] else None,
+        "peak_rss_mb": peak_rss_mb()
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=path.dirname(path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help="comma-separated scenarios to run")
+    parser.add_argument("--sizes", default="1000,10000,100000", help="comma-separated title counts")
+    parser.add_argument("--catalog-size", type=int, default=50000, help="tracks known to the fake Spotify")
+    parser.add_argument("--hit-rate", type=float, default=0.8, help="share of channel titles found in the catalog")
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="seconds added to every fake API request or Telegram page")
+    parser.add_argument("--throttle-rate", type=float, default=0.0,
+                        help="share of requests answered with 429 (flood waits for Telegram)")
+    parser.add_argument("--retry-after", type=float, default=0.1, help="Retry-After seconds of injected 429s")
+    parser.add_argument("--workers", type=int, default=4, help="concurrent Spotify searches")
+    parser.add_argument("--catalog-workers", type=int, default=0,
+                        help="processes matching against the catalog index (default: one per CPU)")
+    parser.add_argument("--write-concurrency", type=int, default=2, help="playlist batches in flight at once")
+    parser.add_argument("--write-error-rate", type=float, default=0.0,
+                        help="share of playlist additions answered with 502 after being applied")
+    parser.add_argument("--shard-size", type=int, default=1000, help="tracks per playlist of the shards scenario")
+    parser.add_argument("--max-rps", type=float, default=0, help="Spotify request rate limit, 0 disables it")
+    parser.add_argument("--threshold", type=float, default=0.5, help="similarity threshold")
+    parser.add_argument("--no-dedupe", dest="dedupe", action="store_false", help="search reposts separately")
+    parser.add_argument("--query-planner", action="store_true", help="search with the staged QueryPlanner")
+    parser.add_argument("--stop-similarity", type=float, default=QueryPlanner.STOP_SIMILARITY,
+                        help="similarity that ends the query plan")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    parser.add_argument("--compare", help="results JSON of an earlier run to compare tracks/sec against")
+    args = parser.parse_args()
+
+    scenarios = [scenario.strip() for scenario in args.scenarios.split(",") if scenario.strip()]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+    sizes = [int(size) for size in args.sizes.split(",")]
+
+    baseline = {}
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            baseline = {(r["scenario"], r["size"]): r for r in json.load(f)["results"]}
+
+    results = []
+    print(f"{'scenario':<12}{'size':>8}{'seconds':>10}{'tracks/s':>12}{'calls/track':>13}"
+          f"{'p50 ms':>10}{'p99 ms':>10}{'429s':>7}{'RSS MB':>9}", file=sys.stderr)
+    for scenario in scenarios:
+        for size in sizes:
+            # A fresh process per run, so peak RSS isn't carried over from an earlier scenario
+            with ProcessPoolExecutor(max_workers=1, mp_context=get_context("spawn")) as executor:
+                result = executor.submit(run_scenario, scenario, size, args).result()
+            results.append(result)
+
+            line = (f"{scenario:<12}{size:>8}{result['seconds']:>10.2f}{result['tracks_per_sec']:>12.0f}"
+                    f"{result['api_calls_per_track'] or 0:>13.3f}{result['latency_ms']['p50'] or 0:>10.3f}"
+                    f"{result['latency_ms']['p99'] or 0:>10.3f}{result['throttled']:>7}{result['peak_rss_mb']:>9.1f}")
+            previous = baseline.get((scenario, size))
+            if previous and previous.get("tracks_per_sec"):
+                line += f"  {result['tracks_per_sec'] / previous['tracks_per_sec']:.2f}x"
+            print(line, file=sys.stderr)
+
+    report = {
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "options": vars(args),
+        "results": results
+    }
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+"""
+Micro-benchmark of utils.calculate_similarity against the original full-matrix implementation.
+
+Usage: python benchmarks/similarity_benchmark.py [--pairs 5000] [--threshold 0.5]
+"""
+import argparse
+import random
+import sys
+from os import path
+from time import perf_counter
+
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+
+from utils import calculate_similarity  # noqa: E402
+
+WORDS = ["love", "night", "dance", "heart", "baby", "fire", "dream", "world", "light", "summer",
+         "remix", "feat.", "live", "version", "forever", "tonight", "shadow", "river", "gold", "home"]
+ARTISTS = ["The Weeknd", "Adele", "Daft Punk", "Coldplay", "Billie Eilish", "Ebi", "Googoosh",
+           "Mohsen Yeganeh", "Arctic Monkeys", "Dua Lipa", "Kendrick Lamar", "Hans Zimmer"]
+
+
+def legacy_similarity(text1, text2):
+    """The original implementation, kept here as the baseline"""
+    text1 = text1.lower()
+    text2 = text2.lower()
+    len1, len2 = len(text1), len(text2)
+    dp = [[0 for _ in range(len2 + 1)] for _ in range(len1 + 1)]
+    for i in range(len1 + 1):
+        dp[i][0] = i
+    for j in range(len2 + 1):
+        dp[0][j] = j
+    for i in range(1, len1 + 1):
+        for j in range(1, len2 + 1):
+            cost = 0 if text1[i - 1] == text2[j - 1] else 1
+            dp[i][j] = min(dp[i - 1][j] + 1, dp[i][j - 1] + 1, dp[i - 1][j - 1] + cost)
+    distance = dp[len1][len2]
+    max_len = max(len1, len2)
+    if max_len == 0:
+        return 1.0
+    return 1.0 - (distance / max_len)
+
+
+def random_title(rng):
+    title = " ".join(rng.choice(WORDS).capitalize() for _ in range(rng.randint(1, 5)))
+    return f"{title} - {rng.choice(ARTISTS)}"
+
+
+def mutate(rng, text):
+    """Apply a few random edits, like a slightly different tag on Spotify would"""
+    chars = list(text)
+    for _ in range(rng.randint(0, 6)):
+        op = rng.random()
+        pos = rng.randrange(len(chars) + 1)
+        if op < 0.4 and pos < len(chars):
+            chars[pos] = rng.choice("abcdefghijklmnopqrstuvwxyz ")
+        elif op < 0.7:
+            chars.insert(pos, rng.choice("abcdefghijklmnopqrstuvwxyz ()"))
+        elif pos < len(chars):
+            del chars[pos]
+    return "".join(chars)
+
+
+def make_pairs(count, seed=42):
+    """One in five candidates is unrelated, the rest are close variants, roughly like search results"""
+    rng = random.Random(seed)
+    pairs = []
+    for _ in range(count):
+        query = random_title(rng)
+        candidate = random_title(rng) if rng.random() < 0.2 else mutate(rng, query)
+        pairs.append((query, candidate))
+    return pairs
+
+
+def time_it(func, pairs):
+    start = perf_counter()
+    scores = [func(a, b) for a, b in pairs]
+    return perf_counter() - start, scores
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pairs", type=int, default=5000)
+    parser.add_argument("--threshold", type=float, default=0.5)
+    args = parser.parse_args()
+
+    pairs = make_pairs(args.pairs)
+    avg_len = sum(len(a) + len(b) for a, b in pairs) / (2 * len(pairs))
+    print(f"{len(pairs)} pairs, average title length {avg_len:.1f} characters")
+
+    legacy_time, legacy_scores = time_it(legacy_similarity, pairs)
+    new_time, new_scores = time_it(calculate_similarity, pairs)
+    cutoff_time, cutoff_scores = time_it(lambda a, b: calculate_similarity(a, b, args.threshold), pairs)
+
+    # Scores must be identical, and the cutoff mode may only differ below the threshold
+    mismatches = sum(1 for old, new in zip(legacy_scores, new_scores) if old != new)
+    cutoff_mismatches = sum(1 for old, new in zip(legacy_scores, cutoff_scores)
+                            if (old >= args.threshold or new != 0.0) and old != new)
+
+    for name, elapsed in (("full matrix (legacy)", legacy_time), ("bit-parallel", new_time),
+                          (f"bit-parallel, cutoff {args.threshold}", cutoff_time)):
+        print(f"{name:<32} {elapsed * 1000:9.1f} ms  {len(pairs) / elapsed:12.0f} pairs/s  "
+              f"{legacy_time / elapsed:6.1f}x")
+    print(f"Score mismatches: {mismatches} (cutoff mode: {cutoff_mismatches})")
+    return 1 if mismatches or cutoff_mismatches else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,188 @@
+import random
+from concurrent.futures import ThreadPoolExecutor
+from threading import Condition, Lock
+from time import perf_counter, sleep
+from job_queue import is_permanent
+from metrics import METRICS
+
+
+class WriteStats:
+    """Tracks, batches and retries of playlist writes, and the time at least one of them was in flight"""
+
+    def __init__(self):
+        self.lock = Lock()
+        self.tracks = 0
+        self.batches = 0
+        self.retries = 0
+        self.requeues = 0
+        self.seconds = 0.0
+        self.in_flight = 0
+        self.busy_since = None
+
+    def started(self):
+        with self.lock:
+            if not self.in_flight:
+                self.busy_since = perf_counter()
+            self.in_flight += 1
+
+    def finished(self):
+        with self.lock:
+            self.in_flight -= 1
+            if not self.in_flight:
+                self.seconds += perf_counter() - self.busy_since
+
+    def to_dict(self):
+        with self.lock:
+            return {"tracks": self.tracks, "batches": self.batches, "retries": self.retries,
+                    "requeues": self.requeues, "seconds": round(self.seconds, 3)}
+
+
+class BulkPlaylistWriter:
+    """
+    Adds batches of URIs to a playlist with up to `concurrency` requests in flight. Every batch is
+    sent with its explicit position, so the playlist ends up in the order the batches were added:
+    a batch that arrives before the ones ahead of it is rejected as out of bounds, and is sent again
+    once they landed. A batch whose request failed without a clear answer (timeout, 5xx) is looked
+    up in the playlist before it is retried, so it is never added twice.
+
+    Spotify applies the writes to one playlist one after another, so concurrency only hides the
+    round trips; different playlists (see PlaylistShards) are written in parallel.
+    """
+
+    BATCH_SIZE = 100  # Spotify's limit per playlist_add_items call
+    MAX_ATTEMPTS = 4
+    # Backoff before retry n is random between 0 and min(MAX_DELAY, BASE_DELAY * 2 ** n) seconds
+    BASE_DELAY = 1.0
+    MAX_DELAY = 30.0
+
+    def __init__(self, spotify, playlist_id, start_position=0, concurrency=2, journal=None, stats=None,
+                 max_attempts=MAX_ATTEMPTS, name=None):
+        self.spotify = spotify
+        self.playlist_id = playlist_id
+        self.journal = journal
+        self.stats = stats or WriteStats()
+        self.max_attempts = max(1, max_attempts)
+        self.name = name or "playlist"
+        self.executor = ThreadPoolExecutor(max_workers=max(1, concurrency))
+        self.futures = []
+        self.next_sequence = 0
+        self.next_position = start_position
+        self.condition = Condition()
+        self.landed = set()  # sequence numbers of the batches in the playlist
+        self.landed_prefix = 0  # every batch before this sequence number is in the playlist
+        self.snapshot_id = None
+        self.snapshot_sequence = -1  # Batch that returned snapshot_id
+        self.added_uris = []  # URIs of the landed batches
+        self.error = None
+
+    def add(self, uris, batch_index=None):
+        """
+        Queue URIs for the playlist, in batches of at most 100; the writes happen in the background.
+        With a journal, the batch_index of a batch an earlier run already added is skipped.
+        """
+        if self.error:
+            raise self.error
+        if self.journal and batch_index is not None and self.journal.is_batch_committed(batch_index):
+            print(f"Batch {batch_index + 1} already added to the playlist, skipping")
+            return
+        for i in range(0, len(uris), self.BATCH_SIZE):
+            batch = uris[i:i + self.BATCH_SIZE]
+            self.futures.append(self.executor.submit(self.write, self.next_sequence, self.next_position, batch,
+                                                     batch_index))
+            self.next_sequence += 1
+            self.next_position += len(batch)
+
+    def send(self, position, uris):
+        self.stats.started()
+        try:
+            with METRICS.time("playlist_write_seconds"):
+                return self.spotify.call(self.spotify.spotify.playlist_add_items, self.playlist_id, uris,
+                                         position=position)
+        finally:
+            self.stats.finished()
+
+    def is_in_playlist(self, position, uris):
+        """Whether a batch whose request failed made it into the playlist anyway"""
+        page = self.spotify.call(self.spotify.spotify.playlist_items, self.playlist_id, limit=len(uris),
+                                 offset=position, fields="items(track(uri))")
+        return [item["track"]["uri"] for item in page["items"] if item.get("track")] == uris
+
+    def wait_for_earlier(self, sequence):
+        """Wait until the batches ahead of this one landed"""
+        with self.condition:
+            while self.landed_prefix < sequence and not self.error:
+                self.condition.wait()
+            if self.error:
+                raise Exception(f"Not adding batch, an earlier one failed: {self.error}")
+
+    def write(self, sequence, position, uris, batch_index):
+        label = f"batch {batch_index + 1 if batch_index is not None else sequence + 1}"
+        print(f"Adding {label} ({len(uris)} tracks) to {self.name} at position {position}...")
+        attempt = 1
+        try:
+            while True:
+                with self.condition:
+                    ahead = self.landed_prefix < sequence
+                try:
+                    result = self.send(position, uris)
+                    break
+                except Exception as e:
+                    # A 4xx is a rejection: nothing was added
+                    rejected = is_permanent(e)
+                    if ahead:
+                        # Sent before the batches ahead of it landed, e.g. rejected as out of bounds
+                        self.wait_for_earlier(sequence)
+                        with self.stats.lock:
+                            self.stats.requeues += 1
+                        METRICS.inc("playlist_write_requeues_total")
+                        if rejected or not self.is_in_playlist(position, uris):
+                            continue
+                        result = {}
+                        break
+                    if rejected or attempt >= self.max_attempts:
+                        raise
+                    METRICS.inc("playlist_write_retries_total")
+                    with self.stats.lock:
+                        self.stats.retries += 1
+                    print(f"Adding {label} failed ({type(e).__name__}: {e}), retrying ({attempt}/{self.max_attempts})...")
+                    sleep(random.uniform(0, min(self.MAX_DELAY, self.BASE_DELAY * 2 ** attempt)))
+                    attempt += 1
+                    if self.is_in_playlist(position, uris):
+                        print(f"{label.capitalize()} was added despite the error, not sending it again")
+                        result = {}
+                        break
+        except Exception as e:
+            with self.condition:
+                self.error = self.error or e
+                self.condition.notify_all()
+            raise
+
+        METRICS.inc("playlist_tracks_added_total", len(uris))
+        if self.journal and batch_index is not None:
+            self.journal.record_batch(batch_index, len(uris))
+        with self.condition:
+            self.landed.add(sequence)
+            self.added_uris += uris
+            while self.landed_prefix in self.landed:
+                self.landed_prefix += 1
+            # A batch only lands after the ones ahead of it, so the last batch carries the newest snapshot
+            if result.get("snapshot_id") and sequence > self.snapshot_sequence:
+                self.snapshot_id = result["snapshot_id"]
+                self.snapshot_sequence = sequence
+            self.condition.notify_all()
+        with self.stats.lock:
+            self.stats.tracks += len(uris)
+            self.stats.batches += 1
+
+    def close(self):
+        """Wait for every queued batch; raises the first failure once the others are done"""
+        error = None
+        for future in self.futures:
+            try:
+                future.result()
+            except Exception as e:
+                error = error or e
+        self.futures = []
+        self.executor.shutdown()
+        if error:
+            raise self.error or error
@@ -0,0 +1,38 @@
+import json
+from threading import Lock
+
+
+class CandidateArchive:
+    """
+    Append-only JSONL archive of every candidate Spotify returned for each title, not only
+    the best one, so a different threshold or scorer can be tried offline without searching again.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = Lock()
+        self.file = open(path, "a", encoding="utf-8")
+
+    def append(self, title, query, candidates):
+        record = {"title": title, "query": query, "candidates": candidates}
+        with self.lock:
+            self.file.write(json.dumps(record, ensure_ascii=False) + "\n")
+            self.file.flush()
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+    @staticmethod
+    def load(path):
+        """Return {title: {"query": ..., "candidates": [...]}}; later records win over older ones"""
+        archive = {}
+        with open(path, "r", encoding="utf-8") as archive_file:
+            for line in archive_file:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # Torn last line of an interrupted run
+                    continue
+                archive[record["title"]] = {"query": record["query"], "candidates": record["candidates"]}
+        return archive
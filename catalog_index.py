@@ -0,0 +1,151 @@
+import csv
+import heapq
+from array import array
+from collections import Counter
+from itertools import chain
+from concurrent.futures import ProcessPoolExecutor
+from os import cpu_count
+from jsonl_output import iter_jsonl
+from metrics import METRICS
+from utils import normalize_title, pick_best_match
+
+# Column names accepted for a catalog CSV, e.g. an Exportify export ("Track Name", "Artist Name(s)", "Track URI")
+NAME_COLUMNS = ("name", "track_name", "track name", "title")
+ARTIST_COLUMNS = ("artist", "artist_name", "artist name(s)", "artists", "artist name")
+URI_COLUMNS = ("uri", "track_uri", "track uri", "spotify_uri")
+# Titles handed to a worker process at once
+BATCH_SIZE = 500
+
+# The index of a worker process, set once by init_worker instead of being sent with every batch
+worker_index = None
+
+
+def trigrams(text):
+    """Character trigrams of a normalized title, padded so short words still get some"""
+    text = f" {text} "
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+def column(row, names):
+    for name in names:
+        if row.get(name):
+            return row[name]
+    return None
+
+
+def init_worker(index):
+    global worker_index
+    worker_index = index
+
+
+def match_batch(titles, similarity_threshold):
+    return [worker_index.match(title, similarity_threshold) for title in titles]
+
+
+class CatalogIndex:
+    """
+    Tracks of a local catalog export (CSV or JSONL with track name, artist and URI) behind a
+    trigram inverted index. A title is only scored against the few tracks sharing the most
+    trigrams with it, instead of against the whole catalog, with the same similarity as search
+    results. Titles it can't match go to the search API as usual.
+    """
+
+    # Tracks scored exactly for each title, the ones sharing the most trigrams with it
+    CANDIDATES = 20
+    # Track entries counted per title at most. The rarest trigrams of a title are counted first: common
+    # ones (" th", "the") hardly narrow anything down and would make every lookup scan most of the catalog
+    MAX_POSTINGS = 20000
+
+    def __init__(self, workers=None):
+        self.workers = workers or cpu_count()
+        self.tracks = []
+        self.keys = set()
+        self.trigram_counts = array("H")  # Trigrams of each track, to rank candidates by overlap
+        self.postings = {}  # trigram -> indexes of the tracks containing it
+
+    def __len__(self):
+        return len(self.tracks)
+
+    def __getstate__(self):
+        # Worker processes only match, they don't need the duplicate check of add()
+        return {**self.__dict__, "keys": set()}
+
+    @classmethod
+    def load(cls, path, workers=None):
+        """Read a .csv or .jsonl catalog export, rows without a name, artist or URI are skipped"""
+        print(f"\n===== Indexing Catalog Export =====")
+        index = cls(workers)
+        if path.endswith(".csv"):
+            with open(path, "r", encoding="utf-8-sig", newline="") as f:
+                for row in csv.DictReader(f):
+                    row = {key.strip().lower(): value for key, value in row.items() if key}
+                    index.add(column(row, NAME_COLUMNS), column(row, ARTIST_COLUMNS), column(row, URI_COLUMNS))
+        else:
+            for row in iter_jsonl(path):
+                row = {key.lower(): value for key, value in row.items()}
+                index.add(column(row, NAME_COLUMNS), column(row, ARTIST_COLUMNS), column(row, URI_COLUMNS))
+        print(f"Indexed {len(index)} tracks of {path} ({len(index.postings)} trigrams)")
+        return index
+
+    def add(self, name, artist, uri):
+        if not name or not artist or not uri:
+            return False
+        # Exports list every artist of a track, searches compare against the first one
+        artist = artist.split(",")[0].strip()
+        key = normalize_title(f"{name} - {artist}")
+        if not key or key in self.keys:
+            return False
+        self.keys.add(key)
+
+        track_index = len(self.tracks)
+        self.tracks.append({'id': uri.rsplit(":", 1)[-1], 'name': name, 'artist': artist, 'uri': uri})
+        grams = trigrams(key)
+        self.trigram_counts.append(min(len(grams), 0xFFFF))
+        for gram in grams:
+            postings = self.postings.get(gram)
+            if postings is None:
+                postings = self.postings[gram] = array("I")
+            postings.append(track_index)
+        return True
+
+    def candidates(self, title):
+        """The CANDIDATES tracks with the highest trigram overlap (Dice coefficient) with the title"""
+        grams = trigrams(normalize_title(title))
+        postings = sorted((self.postings[gram] for gram in grams if gram in self.postings), key=len)
+        selected = []
+        budget = self.MAX_POSTINGS
+        for track_indexes in postings:
+            # A title made only of common trigrams still gets its rarest one counted
+            if selected and len(track_indexes) > budget:
+                break
+            selected.append(track_indexes)
+            budget -= len(track_indexes)
+        shared = Counter(chain.from_iterable(selected))
+
+        # Most shared trigrams first, then re-ranked so long tracks sharing many trigrams by chance drop out
+        best = heapq.nlargest(self.CANDIDATES, shared.most_common(self.CANDIDATES * 5),
+                              key=lambda item: 2 * item[1] / (len(grams) + self.trigram_counts[item[0]]))
+        return [self.tracks[track_index] for track_index, _ in best]
+
+    def match(self, title, similarity_threshold=0.5):
+        """Return the best catalog track for a title with its similarity, or None"""
+        track = pick_best_match(title, self.candidates(title), similarity_threshold)
+        if track:
+            METRICS.inc("catalog_matches_total")
+            track['stage'] = "catalog"
+        return track
+
+    def match_all(self, titles, similarity_threshold=0.5):
+        """Match many titles, in batches spread over `workers` processes; returns a track or None per title"""
+        if self.workers <= 1 or len(titles) < 2 * BATCH_SIZE:
+            return [self.match(title, similarity_threshold) for title in titles]
+
+        batches = [titles[i:i + BATCH_SIZE] for i in range(0, len(titles), BATCH_SIZE)]
+        # Every worker receives the index once, not with every batch
+        with ProcessPoolExecutor(max_workers=self.workers, initializer=init_worker, initargs=(self,)) as executor:
+            # map() keeps the batches in order, so the results follow the titles
+            results = executor.map(match_batch, batches, [similarity_threshold] * len(batches))
+            tracks = [track for batch in results for track in batch]
+        # The workers' counters stay in their processes
+        METRICS.inc("catalog_matches_total", sum(1 for track in tracks if track))
+        return tracks
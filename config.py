@@ -0,0 +1,36 @@
+from os import getenv
+from dotenv import load_dotenv
+
+# Settings and file names shared by main.py, watch.py and rescore.py. Kept apart from main.py, so the
+# offline tools (and their worker processes) don't load Telethon and spotipy or parse unrelated settings
+load_dotenv()
+
+
+def getenv_bool(name, default=False):
+    """Read a true/false flag from the environment"""
+    value = getenv(name)
+    if value is None or value == "":
+        return default
+    return value.strip().lower() in ("1", "true", "yes", "on")
+
+
+MUSIC_DETAILS_FILE = "./telegram-musics.json"
+# Titles of each channel, and the playlist of each channel when PLAYLIST_PER_CHANNEL is on
+CHANNEL_MUSICS_FILE = "./telegram-musics-by-channel.json"
+CHANNEL_PLAYLISTS_FILE = "./channel-playlists.json"
+NOT_FOUND_FILE = "./not-found.json"
+SIMILARITY_DETAILS_FILE = "./similarity_details.json"
+# Load DEFAULT_SIMILARITY_THRESHOLD from .env or use default value if not defined
+DEFAULT_SIMILARITY_THRESHOLD = float(getenv('DEFAULT_SIMILARITY_THRESHOLD', 0.5))
+# Archive of all search candidates, used by rescore.py (empty value disables it)
+CANDIDATE_ARCHIVE_FILE = getenv('CANDIDATE_ARCHIVE_FILE', "./search-candidates.jsonl")
+# Append extracted titles and migration results to JSONL files as they are produced, instead of writing
+# JSON files at the end of each step. The files are synced to disk every OUTPUT_FSYNC_INTERVAL seconds
+STREAMING_OUTPUT = getenv_bool('STREAMING_OUTPUT', False)
+OUTPUT_FSYNC_INTERVAL = float(getenv('OUTPUT_FSYNC_INTERVAL', 5))
+MUSIC_DETAILS_STREAM = "./telegram-musics.jsonl"
+SIMILARITY_DETAILS_STREAM = "./similarity_details.jsonl"
+NOT_FOUND_STREAM = "./not-found.jsonl"
+# Searches that still fail after SEARCH_MAX_ATTEMPTS attempts are parked in DEAD_LETTER_FILE (empty value
+# disables it), and REPLAY_DEAD_LETTERS=true runs only those again instead of the channels' titles
+DEAD_LETTER_FILE = getenv('DEAD_LETTER_FILE', "./failed-searches.jsonl")
@@ -0,0 +1,123 @@
+import asyncio
+import random
+from os import path, remove, rename
+from threading import Lock
+from time import sleep, time
+from jsonl_output import JsonlWriter, iter_jsonl
+from metrics import METRICS
+
+
+def is_permanent(error):
+    """Client errors a retry can't fix, e.g. a query Spotify rejects as malformed"""
+    status = getattr(error, "http_status", None)  # spotipy's SpotifyException
+    response = getattr(error, "response", None)  # httpx.HTTPStatusError
+    if status is None and response is not None:
+        status = getattr(response, "status_code", None)
+    # 401 and 429 are handled by a token refresh and the rate limiter, a later attempt can succeed
+    return isinstance(status, int) and 400 <= status < 500 and status not in (401, 429)
+
+
+class JobQueue:
+    """
+    Runs every search as its own job, whichever worker picks it up: a job that raises (timeout,
+    5xx, malformed response) is retried a few times with jittered exponential backoff, and one that
+    keeps failing is parked in a dead-letter file instead of ending the run. Parked jobs are not
+    "not found" results: replaying the dead-letter file searches them again, into the playlist
+    they were parked for.
+    """
+
+    MAX_ATTEMPTS = 4
+    # Backoff before attempt n is random between 0 and min(MAX_DELAY, BASE_DELAY * 2 ** n) seconds
+    BASE_DELAY = 1.0
+    MAX_DELAY = 30.0
+
+    def __init__(self, dead_letter_path=None, max_attempts=MAX_ATTEMPTS):
+        self.dead_letter_path = dead_letter_path
+        self.max_attempts = max(1, max_attempts)
+        self.dead_letters = None
+        self.failed = []  # IDs of the jobs parked during this run
+        # Playlist the current migration adds to, recorded with every job it parks (None: not known, or shards)
+        self.playlist_id = None
+        self.lock = Lock()
+
+    def backoff(self, attempt):
+        # Full jitter: workers that failed together don't all retry at the same moment
+        return random.uniform(0, min(self.MAX_DELAY, self.BASE_DELAY * 2 ** attempt))
+
+    def retry(self, job_id, error, attempt):
+        """Count a failed attempt; returns False, after parking the job, once it shouldn't be retried"""
+        METRICS.inc("job_failures_total", error=type(error).__name__)
+        if attempt < self.max_attempts and not is_permanent(error):
+            METRICS.inc("job_retries_total")
+            print(f"Search for {job_id} failed ({type(error).__name__}: {error}), "
+                  f"retrying ({attempt}/{self.max_attempts})...")
+            return True
+        self.park(job_id, error, attempt)
+        return False
+
+    def park(self, job_id, error, attempts):
+        METRICS.inc("jobs_dead_lettered_total")
+        print(f"Search for {job_id} failed {attempts} times, parked for a later replay: {error}")
+        with self.lock:
+            self.failed.append(job_id)
+            if not self.dead_letter_path:
+                return
+            if not self.dead_letters:
+                self.dead_letters = JsonlWriter(self.dead_letter_path, append=True, fsync_interval=0)
+        self.dead_letters.write({"title": job_id, "playlist_id": self.playlist_id,
+                                 "error": f"{type(error).__name__}: {error}", "attempts": attempts,
+                                 "failed_at": int(time())})
+
+    def run(self, job_id, func, *args, **kwargs):
+        """Run a job, returns (True, its result) or (False, the last error) once it was parked"""
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                return True, func(*args, **kwargs)
+            except Exception as e:
+                if not self.retry(job_id, e, attempt):
+                    return False, e
+                sleep(self.backoff(attempt))
+
+    async def run_async(self, job_id, func, *args, **kwargs):
+        """Same as run, for a coroutine function"""
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                return True, await func(*args, **kwargs)
+            except Exception as e:
+                if not self.retry(job_id, e, attempt):
+                    return False, e
+                await asyncio.sleep(self.backoff(attempt))
+
+    def close(self):
+        with self.lock:
+            if self.dead_letters:
+                self.dead_letters.close()
+                self.dead_letters = None
+
+
+def take_dead_letters(dead_letter_path):
+    """
+    Return the (title, playlist ID) pairs parked in a dead-letter file for a replay, moving the
+    file aside so the replay's own failures start a new one. The playlist ID is None for records
+    that don't name one. The moved file is only removed by finish_replay, so a replay that is
+    interrupted picks the same titles up again.
+    """
+    replaying_path = f"{dead_letter_path}.replaying"
+    if path.exists(dead_letter_path):
+        if path.exists(replaying_path):
+            # Left behind by an interrupted replay, keep both
+            with open(replaying_path, "a", encoding="utf-8") as replaying, \
+                    open(dead_letter_path, "r", encoding="utf-8") as dead_letters:
+                replaying.write(dead_letters.read())
+            remove(dead_letter_path)
+        else:
+            rename(dead_letter_path, replaying_path)
+    if not path.exists(replaying_path):
+        return []
+    return list(dict.fromkeys((record["title"], record.get("playlist_id")) for record in iter_jsonl(replaying_path)))
+
+
+def finish_replay(dead_letter_path):
+    replaying_path = f"{dead_letter_path}.replaying"
+    if path.exists(replaying_path):
+        remove(replaying_path)
@@ -0,0 +1,100 @@
+import hashlib
+import json
+import os
+from threading import Lock
+
+
+class CheckpointJournal:
+    """
+    Append-only JSONL journal of a migration run: the playlist in use, every resolved
+    search and every playlist batch that was committed. A journal left behind by a run
+    with different inputs is discarded, so resuming only ever skips work of the same run.
+    """
+
+    def __init__(self, path, run_key):
+        self.path = path
+        self.run_key = run_key
+        self.playlist_id = None
+        self.searches = {}  # title index -> {"title": ..., "track": ...}
+        self.committed_batches = set()
+        self.lock = Lock()
+
+        resumed = self._load()
+        self.file = open(path, "a" if resumed else "w", encoding="utf-8")
+        if resumed:
+            print(f"Resuming from {path}: {len(self.searches)} searches and "
+                  f"{len(self.committed_batches)} playlist batches already done")
+        else:
+            self._append({"type": "run", "key": run_key})
+
+    @staticmethod
+    def make_run_key(*inputs):
+        """Fingerprint the inputs of a run, so a journal is only reused for the same run"""
+        return hashlib.sha256(json.dumps(inputs, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+    def _load(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as journal_file:
+                lines = journal_file.readlines()
+        except FileNotFoundError:
+            return False
+
+        records = []
+        valid_lines = []
+        for line in lines:
+            try:
+                records.append(json.loads(line))
+                valid_lines.append(line)
+            except json.JSONDecodeError:
+                # A torn write from a crash can only be the last line, ignore it
+                break
+
+        if not records or records[0].get("type") != "run" or records[0].get("key") != self.run_key:
+            return False
+
+        # Drop the torn tail so the next append starts on a clean line
+        if len(valid_lines) != len(lines) or not valid_lines[-1].endswith("\n"):
+            with open(self.path, "w", encoding="utf-8") as journal_file:
+                journal_file.write("".join(line if line.endswith("\n") else line + "\n" for line in valid_lines))
+
+        for record in records[1:]:
+            if record["type"] == "playlist":
+                self.playlist_id = record["playlist_id"]
+            elif record["type"] == "search":
+                self.searches[record["index"]] = {"title": record["title"], "track": record["track"]}
+            elif record["type"] == "batch":
+                self.committed_batches.add(record["batch"])
+        return True
+
+    def _append(self, record):
+        with self.lock:
+            self.file.write(json.dumps(record, ensure_ascii=False) + "\n")
+            self.file.flush()
+
+    def get_search(self, index, title):
+        """Return (True, track) if this title was already resolved, (False, None) otherwise"""
+        entry = self.searches.get(index)
+        if entry and entry["title"] == title:
+            return True, entry["track"]
+        return False, None
+
+    def record_playlist(self, playlist_id):
+        self.playlist_id = playlist_id
+        self._append({"type": "playlist", "playlist_id": playlist_id})
+
+    def record_search(self, index, title, track):
+        self.searches[index] = {"title": title, "track": track}
+        self._append({"type": "search", "index": index, "title": title, "track": track})
+
+    def record_batch(self, batch_index, size):
+        self.committed_batches.add(batch_index)
+        self._append({"type": "batch", "batch": batch_index, "size": size})
+
+    def is_batch_committed(self, batch_index):
+        return batch_index in self.committed_batches
+
+    def close(self):
+        with self.lock:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.file.close()
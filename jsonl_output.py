@@ -0,0 +1,98 @@
+import json
+from os import fsync
+from threading import Lock
+from time import monotonic
+
+
+class JsonlWriter:
+    """
+    Output file written one JSON record per line as results are produced, instead of one JSON
+    document at the end. Every line is flushed right away, so other tools can tail the file during
+    the run, and the file is fsynced at most every `fsync_interval` seconds and when it is closed.
+    """
+
+    def __init__(self, path, append=False, fsync_interval=5.0):
+        self.path = path
+        self.fsync_interval = fsync_interval
+        self.lock = Lock()
+        self.count = 0
+        self.file = open(path, "a" if append else "w", encoding="utf-8")
+        self.synced = monotonic()
+
+    def write(self, record):
+        with self.lock:
+            self.file.write(json.dumps(record, ensure_ascii=False) + "\n")
+            self.file.flush()
+            self.count += 1
+            if monotonic() - self.synced >= self.fsync_interval:
+                fsync(self.file.fileno())
+                self.synced = monotonic()
+
+    def close(self):
+        with self.lock:
+            if self.file.closed:
+                return
+            self.file.flush()
+            fsync(self.file.fileno())
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def iter_jsonl(path):
+    """Yield the records of a JSONL file one at a time, without loading the whole file"""
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                # Torn last line of a run that is still writing or was interrupted
+                continue
+
+
+def read_records(path):
+    """Yield the records of a .jsonl file lazily, or the items of a JSON list written by older runs"""
+    if path.endswith(".jsonl"):
+        yield from iter_jsonl(path)
+        return
+    with open(path, "r", encoding="utf-8") as f:
+        yield from json.loads(f.read())
+
+
+def similarity_record(title, track):
+    """One entry of similarity_details"""
+    return {
+        'telegram_title': title,
+        'spotify_title': f"{track['name']} - {track['artist']}",
+        'similarity': track['similarity'],
+        # Which query of the QueryPlanner found it, if one was used
+        **({'stage': track['stage']} if 'stage' in track else {})
+    }
+
+
+class ResultStream:
+    """
+    similarity_details.jsonl and not-found.jsonl of a run, appended to as each title is resolved.
+    One stream can be shared by several migrations, e.g. one per channel.
+    """
+
+    def __init__(self, details_path, not_found_path, fsync_interval=5.0):
+        self.details = JsonlWriter(details_path, fsync_interval=fsync_interval)
+        self.not_found = JsonlWriter(not_found_path, fsync_interval=fsync_interval)
+
+    def record(self, title, track):
+        if track:
+            self.details.write(similarity_record(title, track))
+        else:
+            # Plain titles, like the entries of not-found.json
+            self.not_found.write(title)
+
+    def close(self):
+        self.details.close()
+        self.not_found.close()
@@ -0,0 +1,57 @@
+from metrics import METRICS
+from utils import normalize_title, pick_best_match, split_title
+
+
+class LibraryIndex:
+    """
+    In-memory index of the tracks the user already has on Spotify (saved tracks, optionally their
+    playlists), so titles can be matched locally instead of with a search call. A title is scored
+    with the same similarity as search results, against the tracks with the same normalized
+    "title - artist", the same artist or the same track name.
+    """
+
+    def __init__(self):
+        self.exact = {}  # normalized "name - artist" -> track
+        self.by_artist = {}  # normalized artist -> tracks
+        self.by_name = {}  # normalized track name -> tracks
+
+    def __len__(self):
+        return len(self.exact)
+
+    def add(self, track):
+        """Add a track object of the Web API, returns False for local files and removed tracks"""
+        if not track or not track.get('id') or not track.get('artists'):
+            return False
+
+        candidate = {
+            'id': track['id'],
+            'name': track['name'],
+            'artist': track['artists'][0]['name'],
+            'uri': track['uri']
+        }
+        key = normalize_title(f"{candidate['name']} - {candidate['artist']}")
+        if not key or key in self.exact:
+            return False
+        self.exact[key] = candidate
+        self.by_artist.setdefault(normalize_title(candidate['artist']), []).append(candidate)
+        self.by_name.setdefault(normalize_title(candidate['name']), []).append(candidate)
+        return True
+
+    def match(self, title, similarity_threshold=0.5):
+        """Return the best library track for a title with its similarity, or None"""
+        key = normalize_title(title)
+        if key in self.exact:
+            candidates = [self.exact[key]]
+        else:
+            name, performer = split_title(key)
+            candidates = self.by_artist.get(performer, []) + self.by_name.get(name, [])
+
+        track = pick_best_match(title, candidates, similarity_threshold)
+        if track:
+            METRICS.inc("library_matches_total")
+            track['stage'] = "library"
+        return track
+
+    def match_all(self, titles, similarity_threshold=0.5):
+        """Match many titles, returns a track or None per title"""
+        return [self.match(title, similarity_threshold) for title in titles]
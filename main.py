@@ -1,21 +1,182 @@
 import json
-from telegram import Telegram
+from telegram import Telegram, music_title
 from spotify import Spotify
-from os import getenv, path, remove
+from search_cache import SearchCache
+from query_planner import QueryPlanner
+from catalog_index import CatalogIndex
+from pipeline import run_pipeline
+from metrics import METRICS
+from jsonl_output import JsonlWriter, ResultStream, iter_jsonl
+from job_queue import JobQueue, take_dead_letters, finish_replay
+from playlist_shards import PlaylistShards, SHARDS_FILE
+from added_tracks import ADDED_TRACKS_FILE
+from config import getenv_bool, MUSIC_DETAILS_FILE, CHANNEL_MUSICS_FILE, CHANNEL_PLAYLISTS_FILE, NOT_FOUND_FILE, \
+    SIMILARITY_DETAILS_FILE, DEFAULT_SIMILARITY_THRESHOLD, CANDIDATE_ARCHIVE_FILE, STREAMING_OUTPUT, \
+    OUTPUT_FSYNC_INTERVAL, MUSIC_DETAILS_STREAM, SIMILARITY_DETAILS_STREAM, NOT_FOUND_STREAM, DEAD_LETTER_FILE
+from os import cpu_count, getenv, path, remove
 from os.path import exists
-from dotenv import load_dotenv
 from asyncio import run
+from time import perf_counter
 
-load_dotenv()
 REQUIRED_ENVS = ['TELEGRAM_API_ID', 'TELEGRAM_API_HASH', 'TELEGRAM_CHANNEL_USERNAME',
                  'SPOTIFY_CLIENT_ID', 'SPOTIFY_CLIENT_SECRET', 'SPOTIFY_REDIRECT_URI', 'SPOTIFY_USER_ID']
-MUSIC_DETAILS_FILE = "./telegram-musics.json"
 # Load LIMIT from .env or use default value if not defined
 LIMIT = int(getenv('LIMIT', 100))
-NOT_FOUND_FILE = "./not-found.json"
-# Load DEFAULT_SIMILARITY_THRESHOLD from .env or use default value if not defined
-DEFAULT_SIMILARITY_THRESHOLD = float(getenv('DEFAULT_SIMILARITY_THRESHOLD', 0.5))
+# Fetch only new channel posts when telegram-musics.json already exists (false skips extraction instead)
+INCREMENTAL_SYNC = getenv_bool('INCREMENTAL_SYNC', True)
+# TELEGRAM_CHANNEL_USERNAME may list several channels separated by commas, extracted this many at a time
+TELEGRAM_CONCURRENCY = int(getenv('TELEGRAM_CONCURRENCY', 4))
+# Migrate every channel into its own playlist instead of one shared playlist
+PLAYLIST_PER_CHANNEL = getenv_bool('PLAYLIST_PER_CHANNEL', False)
+# Split the playlist into numbered playlists of at most PLAYLIST_SHARD_SIZE tracks (Spotify allows 10,000 per
+# playlist), recorded in playlist-shards.json so later runs append to the last one
+PLAYLIST_SHARDING = getenv_bool('PLAYLIST_SHARDING', False)
+PLAYLIST_SHARD_SIZE = min(int(getenv('PLAYLIST_SHARD_SIZE', PlaylistShards.MAX_TRACKS)), PlaylistShards.MAX_TRACKS)
 CACHE_FILE = ".cache"
+# Number of concurrent Spotify searches and the highest request rate they may share
+SEARCH_WORKERS = int(getenv('SEARCH_WORKERS', 4))
+SPOTIFY_MAX_RPS = float(getenv('SPOTIFY_MAX_RPS', 10))
+# Persistent search cache (set SEARCH_CACHE_FILE to an empty value to disable it)
+SEARCH_CACHE_FILE = getenv('SEARCH_CACHE_FILE', "./search_cache.sqlite")
+SEARCH_CACHE_TTL_DAYS = float(getenv('SEARCH_CACHE_TTL_DAYS', 30))
+SEARCH_CACHE_MAX_ENTRIES = int(getenv('SEARCH_CACHE_MAX_ENTRIES', 100000))
+# Checkpoint journal used to resume an interrupted migration (empty value disables it)
+MIGRATION_JOURNAL_FILE = getenv('MIGRATION_JOURNAL_FILE', "./migration-journal.jsonl")
+# Only add tracks missing from an existing playlist, and optionally remove the ones no longer in the channel
+PLAYLIST_SYNC = getenv_bool('PLAYLIST_SYNC', True)
+PLAYLIST_PRUNE = getenv_bool('PLAYLIST_PRUNE', False)
+# Playlist batches in flight at once; each is sent with its position, so the playlist keeps its order.
+# Spotify applies the writes to one playlist one at a time, higher values mostly resend out-of-order batches
+PLAYLIST_WRITE_CONCURRENCY = int(getenv('PLAYLIST_WRITE_CONCURRENCY', 2))
+# Search reposts of the same song (ignoring case, spacing and tags like "(Official Audio)") only once
+DEDUPLICATE_TITLES = getenv_bool('DEDUPLICATE_TITLES', True)
+# Stream Telegram messages straight into searching and playlist batches instead of running stage by stage
+PIPELINE = getenv_bool('PIPELINE', False)
+PIPELINE_QUEUE_SIZE = int(getenv('PIPELINE_QUEUE_SIZE', 200))
+# Use the asyncio Spotify client: SEARCH_WORKERS searches in flight over at most SPOTIFY_MAX_CONNECTIONS connections
+ASYNC_SPOTIFY = getenv_bool('ASYNC_SPOTIFY', False)
+SPOTIFY_MAX_CONNECTIONS = int(getenv('SPOTIFY_MAX_CONNECTIONS', 10))
+# Match titles against the user's saved tracks (and optionally their playlists) before searching
+LIBRARY_PREPASS = getenv_bool('LIBRARY_PREPASS', False)
+LIBRARY_INCLUDE_PLAYLISTS = getenv_bool('LIBRARY_INCLUDE_PLAYLISTS', False)
+# Match titles offline against a catalog export (CSV or JSONL of track name, artist and URI) before searching,
+# with CATALOG_WORKERS processes (empty value disables it)
+CATALOG_FILE = getenv('CATALOG_FILE', "")
+CATALOG_WORKERS = int(getenv('CATALOG_WORKERS') or cpu_count())
+# Search with precise field queries first, and broader ones only when they find no good match.
+# A stage ends the search once its best match reaches QUERY_PLAN_STOP_SIMILARITY, a near-exact match.
+# Off by default: titles missing from Spotify are searched with every query, costing more calls per title
+QUERY_PLANNER = getenv_bool('QUERY_PLANNER', False)
+QUERY_PLAN_STOP_SIMILARITY = float(getenv('QUERY_PLAN_STOP_SIMILARITY') or QueryPlanner.STOP_SIMILARITY)
+# Counters and latency histograms of the run (empty value disables the file), and an optional port serving
+# them in Prometheus' text format while the run is in progress
+METRICS_FILE = getenv('METRICS_FILE', "./metrics.json")
+METRICS_PORT = int(getenv('METRICS_PORT') or 0)
+# Searches that still fail after SEARCH_MAX_ATTEMPTS attempts are parked in DEAD_LETTER_FILE (set in config.py),
+# and REPLAY_DEAD_LETTERS=true runs only those again instead of the channels' titles
+SEARCH_MAX_ATTEMPTS = int(getenv('SEARCH_MAX_ATTEMPTS', 4))
+REPLAY_DEAD_LETTERS = getenv_bool('REPLAY_DEAD_LETTERS', False)
+
+
+def load_channel_titles(channels):
+    """Load the titles extracted earlier for each channel"""
+    if STREAMING_OUTPUT and exists(MUSIC_DETAILS_STREAM):
+        records = {}
+        for record in iter_jsonl(MUSIC_DETAILS_STREAM):
+            records.setdefault(record["channel"], []).append((record["id"], record["title"]))
+        # Newest posts first like the extraction; messages read twice (a retry, an interrupted run) count once
+        return {channel: list(dict.fromkeys(title for _, title in sorted(items, key=lambda item: -item[0])))
+                for channel, items in records.items()}
+
+    if exists(CHANNEL_MUSICS_FILE):
+        with open(CHANNEL_MUSICS_FILE, "r", encoding="utf-8") as f:
+            return json.loads(f.read())
+
+    # Files written before multi-channel support only hold the titles of a single channel
+    if exists(MUSIC_DETAILS_FILE) and len(channels) == 1:
+        with open(MUSIC_DETAILS_FILE, "r", encoding="utf-8") as f:
+            return {channels[0]: json.loads(f.read())}
+    return {}
+
+
+def save_channel_titles(channel_titles, channels):
+    """Save the titles per channel, and all of them de-duplicated to telegram-musics.json"""
+    music_titles = list(dict.fromkeys(title for channel in channels for title in channel_titles.get(channel, [])))
+    if STREAMING_OUTPUT:
+        # Already appended to telegram-musics.jsonl while extracting
+        print(f"Music details streamed to {MUSIC_DETAILS_STREAM}")
+        return music_titles
+    with open(CHANNEL_MUSICS_FILE, "w", encoding="utf-8") as f:
+        f.write(json.dumps(channel_titles, ensure_ascii=False))
+    with open(MUSIC_DETAILS_FILE, "w", encoding="utf-8") as f:
+        f.write(json.dumps(music_titles))
+    print(f"Music details written to {MUSIC_DETAILS_FILE}")
+    return music_titles
+
+
+def open_title_stream(channel_titles):
+    """Open telegram-musics.jsonl for appending, copying in the titles of earlier runs that didn't stream"""
+    seed = not exists(MUSIC_DETAILS_STREAM)
+    title_output = JsonlWriter(MUSIC_DETAILS_STREAM, append=True, fsync_interval=OUTPUT_FSYNC_INTERVAL)
+    if seed:
+        for channel, titles in channel_titles.items():
+            for title in titles:
+                # ID 0 sorts them after every newly extracted message
+                title_output.write({"channel": channel, "id": 0, "title": title})
+    return title_output
+
+
+def merge_new_titles(new_titles, known_titles):
+    """New posts go first, matching the newest-first order of the extraction"""
+    known = set(known_titles)
+    new_titles = [title for title in dict.fromkeys(new_titles) if title not in known]
+    return new_titles + known_titles, len(new_titles)
+
+
+def channel_journal_path(channel):
+    """Every per-channel playlist gets its own journal, so their runs don't reset each other"""
+    if not MIGRATION_JOURNAL_FILE:
+        return MIGRATION_JOURNAL_FILE
+    root, ext = path.splitext(MIGRATION_JOURNAL_FILE)
+    return f"{root}-{channel.lstrip('@')}{ext}"
+
+
+async def migrate(spotify, music_titles, playlist_name, playlist_description, playlist_id, similarity_threshold,
+                  journal_path, library=None, results=None, catalog=None, prune=PLAYLIST_PRUNE):
+    if PLAYLIST_SHARDING:
+        # Shards are written by the blocking client, with one writer thread per shard
+        shards = PlaylistShards(spotify, playlist_name, playlist_description, SHARDS_FILE, PLAYLIST_SHARD_SIZE,
+                                PLAYLIST_WRITE_CONCURRENCY)
+        return spotify.migrate_tracks(music_titles, playlist_name, playlist_description, None,
+                                      similarity_threshold, SEARCH_WORKERS, journal_path,
+                                      CANDIDATE_ARCHIVE_FILE, PLAYLIST_SYNC, prune, DEDUPLICATE_TITLES,
+                                      library, results, catalog, shards, PLAYLIST_WRITE_CONCURRENCY,
+                                      ADDED_TRACKS_FILE)
+    if ASYNC_SPOTIFY:
+        return await spotify.migrate_tracks_async(music_titles, playlist_name, playlist_description, playlist_id,
+                                                  similarity_threshold, SEARCH_WORKERS, journal_path,
+                                                  CANDIDATE_ARCHIVE_FILE, PLAYLIST_SYNC, prune,
+                                                  DEDUPLICATE_TITLES, SPOTIFY_MAX_CONNECTIONS, library, results,
+                                                  catalog, ADDED_TRACKS_FILE, PLAYLIST_WRITE_CONCURRENCY)
+    return spotify.migrate_tracks(music_titles, playlist_name, playlist_description, playlist_id,
+                                  similarity_threshold, SEARCH_WORKERS, journal_path,
+                                  CANDIDATE_ARCHIVE_FILE, PLAYLIST_SYNC, prune, DEDUPLICATE_TITLES,
+                                  library, results, catalog, write_concurrency=PLAYLIST_WRITE_CONCURRENCY,
+                                  added_tracks_path=ADDED_TRACKS_FILE)
+
+
+def combine_results(results):
+    """Add up the results of several migrations, e.g. one per channel"""
+    combined = {"playlist_id": ", ".join(result["playlist_id"] for result in results)}
+    for key in ("found_tracks", "added_tracks", "removed_tracks", "not_found_tracks", "failed_tracks",
+                "api_calls_saved", "library_matches", "catalog_matches"):
+        combined[key] = sum(result[key] for result in results)
+    for key in ("not_found_list", "failed_list", "skipped_list", "similarity_details"):
+        combined[key] = [item for result in results for item in result[key]]
+    # The channels' playlists are written one after another, so their write times add up too
+    combined["write_stats"] = {key: sum(result["write_stats"][key] for result in results)
+                               for key in results[0]["write_stats"]} if results else {}
+    return combined
 
 
 async def main():
@@ -29,33 +190,112 @@ async def main():
         print(f"Removing {CACHE_FILE} file (using session_tokens.json instead)...")
         remove(CACHE_FILE)
 
+    if METRICS_PORT:
+        METRICS.serve(METRICS_PORT)
+        print(f"Serving metrics on http://127.0.0.1:{METRICS_PORT}/metrics")
+
     # Step 1: Get music details from Telegram or load from file
-    if exists(MUSIC_DETAILS_FILE):
+    channels = [channel.strip() for channel in getenv("TELEGRAM_CHANNEL_USERNAME").split(",") if channel.strip()]
+    channel_titles = load_channel_titles(channels)
+    music_titles = list(dict.fromkeys(title for channel in channels for title in channel_titles.get(channel, [])))
+
+    tel = None
+    min_ids = {}
+    # A replay only searches the titles parked by earlier runs, into the playlists they were meant for
+    replay = REPLAY_DEAD_LETTERS and DEAD_LETTER_FILE
+    replay_playlists = {}  # playlist ID (None: the configured playlist) -> titles to replay into it
+    # The pipeline writes a single playlist, sharded playlists are filled by the stage by stage migration
+    pipeline = PIPELINE and not PLAYLIST_SHARDING
+    if PIPELINE and PLAYLIST_SHARDING:
+        print("PIPELINE is ignored with PLAYLIST_SHARDING, migrating stage by stage")
+    elif PIPELINE and PLAYLIST_PER_CHANNEL and not replay:
+        print("PLAYLIST_PER_CHANNEL is ignored with PIPELINE, all channels stream into one playlist")
+    if pipeline and not replay:
+        # The titles stream in, so there's no fixed input to journal, and no full list of them to prune against
+        ignored = [name for name, used in (("MIGRATION_JOURNAL_FILE", MIGRATION_JOURNAL_FILE),
+                                           ("PLAYLIST_PRUNE", PLAYLIST_PRUNE),
+                                           ("DEDUPLICATE_TITLES=false", not DEDUPLICATE_TITLES)) if used]
+        if ignored:
+            print(f"{', '.join(ignored)} not used with PIPELINE")
+    stage_start = perf_counter()
+    if replay:
+        print("\n===== Step 1: Replaying Failed Searches =====")
+        parked = take_dead_letters(DEAD_LETTER_FILE)
+        print(f"Searching again {len(parked)} titles parked in {DEAD_LETTER_FILE}, Telegram is not read")
+        if not parked:
+            print("No failed searches to replay")
+            return
+        for title, parked_playlist_id in parked:
+            replay_playlists.setdefault(parked_playlist_id, []).append(title)
+        if PLAYLIST_PER_CHANNEL and None in replay_playlists:
+            # Records of older runs don't say which channel's playlist they belong to
+            print(f"{len(replay_playlists[None])} parked titles don't record their playlist, they can't be "
+                  f"replayed with PLAYLIST_PER_CHANNEL. Replay them with PLAYLIST_PER_CHANNEL=false")
+            return
+        music_titles = [title for title, _ in parked]
+    elif pipeline:
+        # Extraction happens while searching, in Step 5
+        print("\n===== Step 1: Connecting to Telegram =====")
+        tel = Telegram(getenv("TELEGRAM_API_ID"), getenv("TELEGRAM_API_HASH"), channels)
+        await tel.init_conn(True)
+        if INCREMENTAL_SYNC:
+            min_ids = {channel: tel.load_high_water_mark(channel) for channel in channels
+                       if channel_titles.get(channel)}
+    elif music_titles and not INCREMENTAL_SYNC:
         print("Music details file exists! Skipping extracting musics...")
-        with open(MUSIC_DETAILS_FILE, "r") as f:
-            music_titles = json.loads(f.read())
     else:
         print("\n===== Step 1: Extracting Musics From Telegram =====")
-        print(f"Using message limit: {LIMIT} (configurable in .env file)")
-        tel = Telegram(getenv("TELEGRAM_API_ID"), getenv("TELEGRAM_API_HASH"), getenv("TELEGRAM_CHANNEL_USERNAME"))
+        tel = Telegram(getenv("TELEGRAM_API_ID"), getenv("TELEGRAM_API_HASH"), channels)
         await tel.init_conn(True)
-        musics = await tel.get_music_files(limit=LIMIT)
-        music_titles = list(map(lambda m: m["title"] + " - " + m["performer"], musics))
-        with open(MUSIC_DETAILS_FILE, "w", encoding="utf-8") as f:
-            f.write(json.dumps(music_titles))
-        print(f"Music details written to {MUSIC_DETAILS_FILE}")
+
+        # Channels with titles from an earlier run only fetch the messages posted since then
+        min_ids = {channel: tel.load_high_water_mark(channel) for channel in channels if channel_titles.get(channel)}
+        print(f"Extracting {len(channels)} channels, up to {TELEGRAM_CONCURRENCY} at a time")
+        print(f"Using message limit: {LIMIT} for channels extracted for the first time (configurable in .env file)")
+        title_output = open_title_stream(channel_titles) if STREAMING_OUTPUT else None
+        musics_by_channel = await tel.extract_channels(LIMIT, min_ids, TELEGRAM_CONCURRENCY, title_output)
+        if title_output:
+            title_output.close()
+            known_counts = {channel: len(channel_titles.get(channel, [])) for channel in channels}
+            channel_titles = load_channel_titles(channels)
+
+        for channel, musics in musics_by_channel.items():
+            if title_output:
+                added = len(channel_titles.get(channel, [])) - known_counts[channel]
+            else:
+                new_titles = [title for title in map(music_title, musics) if title]
+                channel_titles[channel], added = merge_new_titles(new_titles, channel_titles.get(channel, []))
+            print(f"{channel}: added {added} new titles ({len(channel_titles.get(channel, []))} in total)")
+            tel.save_high_water_mark(tel.last_message_ids.get(channel, min_ids.get(channel, 0)), channel)
+        music_titles = save_channel_titles(channel_titles, channels)
+    METRICS.observe("stage_seconds", perf_counter() - stage_start, stage="telegram")
 
     # Step 2: Initialize Spotify
     print("\n===== Step 2: Initializing Spotify =====")
+    search_cache = None
+    if SEARCH_CACHE_FILE:
+        print(f"Using search cache: {SEARCH_CACHE_FILE}")
+        search_cache = SearchCache(SEARCH_CACHE_FILE, SEARCH_CACHE_TTL_DAYS * 24 * 3600, SEARCH_CACHE_MAX_ENTRIES)
+    query_planner = QueryPlanner(QUERY_PLAN_STOP_SIMILARITY) if QUERY_PLANNER else None
+    jobs = JobQueue(DEAD_LETTER_FILE, SEARCH_MAX_ATTEMPTS)
     spotify = Spotify(getenv("SPOTIFY_CLIENT_ID"), getenv("SPOTIFY_CLIENT_SECRET"), getenv("SPOTIFY_REDIRECT_URI"),
-                      getenv("SPOTIFY_USER_ID"))
+                      getenv("SPOTIFY_USER_ID"), SPOTIFY_MAX_RPS, search_cache, query_planner, jobs)
 
     # Step 3: Configure Playlist
     print("\n===== Step 3: Configure Playlist =====")
-    playlist_id = getenv("SPOTIFY_PLAYLIST_ID")
+    per_channel = PLAYLIST_PER_CHANNEL and not replay and not pipeline
+    # Shards are found by playlist name in playlist-shards.json
+    playlist_id = None if per_channel or PLAYLIST_SHARDING else getenv("SPOTIFY_PLAYLIST_ID")
     playlist_name = None
     playlist_description = None
-    if not playlist_id:
+    if per_channel:
+        print("Each channel gets its own playlist, named after the channel.")
+    if PLAYLIST_SHARDING:
+        print(f"Tracks are split into numbered playlists of at most {PLAYLIST_SHARD_SIZE} tracks, "
+              f"an earlier run's playlists are found by name.")
+    if replay and None not in replay_playlists:
+        print("Parked titles are added back to the playlists they were parked for.")
+    elif not playlist_id:
         # Ask for playlist name and other parameters
         playlist_name = input("Enter a name for your Spotify playlist [Telegram Music]: ") or "Telegram Music"
         playlist_description = input("Enter the description for your Spotify playlist [Imported from Telegram]: ") or "Imported from Telegram"
@@ -79,25 +319,141 @@ async def main():
     print(f"Using similarity threshold: {similarity_threshold * 100:.1f}%")
 
     # Step 5: Migrate tracks from Telegram to Spotify
-    print(f"\n===== Step 5: Migrating Tracks ({len(music_titles)}) =====")
-    result = spotify.migrate_tracks(music_titles, playlist_name, playlist_description, playlist_id, similarity_threshold)
+    stage_start = perf_counter()
+    library = spotify.load_library(LIBRARY_INCLUDE_PLAYLISTS) if LIBRARY_PREPASS else None
+    catalog = CatalogIndex.load(CATALOG_FILE, CATALOG_WORKERS) if CATALOG_FILE else None
+    results = ResultStream(SIMILARITY_DETAILS_STREAM, NOT_FOUND_STREAM, OUTPUT_FSYNC_INTERVAL) \
+        if STREAMING_OUTPUT else None
+    if replay:
+        print(f"\n===== Step 5: Migrating Failed Searches ({len(music_titles)}) =====")
+        replay_results = []
+        for parked_playlist_id, titles in replay_playlists.items():
+            # No journal, and no pruning: the playlist holds far more than the replayed titles
+            replay_results.append(await migrate(spotify, titles, playlist_name, playlist_description,
+                                                parked_playlist_id or playlist_id, similarity_threshold, None,
+                                                library, results, catalog, prune=False))
+        result = combine_results(replay_results)
+    elif pipeline:
+        print(f"\n===== Step 5: Streaming Tracks =====")
+        title_output = open_title_stream(channel_titles) if STREAMING_OUTPUT else None
+        result = await run_pipeline(tel, spotify, playlist_id, similarity_threshold, LIMIT, min_ids,
+                                    SEARCH_WORKERS, PIPELINE_QUEUE_SIZE, sync=PLAYLIST_SYNC,
+                                    playlist_name=playlist_name, playlist_description=playlist_description,
+                                    library=library, title_output=title_output, results=results,
+                                    catalog=catalog, write_concurrency=PLAYLIST_WRITE_CONCURRENCY,
+                                    archive_path=CANDIDATE_ARCHIVE_FILE, added_tracks_path=ADDED_TRACKS_FILE)
+        if title_output:
+            title_output.close()
+
+        # Keep the extracted titles and the high-water marks up to date for the next run
+        for channel, titles in result["channel_titles"].items():
+            channel_titles[channel], _ = merge_new_titles(titles, channel_titles.get(channel, []))
+            tel.save_high_water_mark(tel.last_message_ids.get(channel, min_ids.get(channel, 0)), channel)
+        music_titles = save_channel_titles(channel_titles, channels)
+    elif PLAYLIST_PER_CHANNEL:
+        channel_playlists = {}
+        if exists(CHANNEL_PLAYLISTS_FILE):
+            with open(CHANNEL_PLAYLISTS_FILE, "r", encoding="utf-8") as f:
+                channel_playlists = json.loads(f.read())
+
+        channel_results = []
+        for channel in channels:
+            titles = channel_titles.get(channel, [])
+            print(f"\n===== Step 5: Migrating Tracks of {channel} ({len(titles)}) =====")
+            # Every channel's titles go to the same result stream
+            result = await migrate(spotify, titles, f"{playlist_name} - {channel.lstrip('@')}", playlist_description,
+                                   channel_playlists.get(channel), similarity_threshold, channel_journal_path(channel),
+                                   library, results, catalog)
+            channel_results.append(result)
+
+            # Later runs add to the same playlist instead of creating a new one (shards are in playlist-shards.json)
+            if not PLAYLIST_SHARDING:
+                channel_playlists[channel] = result["playlist_id"]
+                with open(CHANNEL_PLAYLISTS_FILE, "w", encoding="utf-8") as f:
+                    f.write(json.dumps(channel_playlists, indent=2))
+        result = combine_results(channel_results)
+    else:
+        print(f"\n===== Step 5: Migrating Tracks ({len(music_titles)}) =====")
+        result = await migrate(spotify, music_titles, playlist_name, playlist_description, playlist_id,
+                               similarity_threshold, MIGRATION_JOURNAL_FILE, library, results, catalog)
+    if results:
+        results.close()
+    jobs.close()
+    if replay:
+        # Titles that failed again were parked in a new dead-letter file
+        finish_replay(DEAD_LETTER_FILE)
+    METRICS.observe("stage_seconds", perf_counter() - stage_start,
+                    stage="pipeline" if pipeline and not replay else "migration")
 
     # Step 6: Print summary
     print("\n===== Migration Summary =====")
-    print(f"Playlist: {playlist_name or playlist_id}")
+    print(f"Playlist: {result['playlist_id'] if per_channel or replay else playlist_name or playlist_id}")
+    if PLAYLIST_SHARDING and not per_channel:
+        print(f"Playlist shards: {result['playlist_id']}")
+    print(f"Channels: {', '.join(channels)}")
     print(f"Total tracks: {len(music_titles)}")
     print(f"Message limit used: {LIMIT}")
-    print(f"Successfully added: {result['found_tracks']} (similarity ≥ {similarity_threshold * 100:.1f}%)")
+    print(f"Successfully found: {result['found_tracks']} (similarity ≥ {similarity_threshold * 100:.1f}%)")
+    print(f"Added to playlist: {result['added_tracks']}")
+    if result['removed_tracks']:
+        print(f"Removed from playlist: {result['removed_tracks']}")
     print(f"Not found or below similarity threshold: {result['not_found_tracks']}")
+    if result['failed_tracks']:
+        where = f", parked in {DEAD_LETTER_FILE} (replay with REPLAY_DEAD_LETTERS=true)" if DEAD_LETTER_FILE else ""
+        print(f"Searches failed: {result['failed_tracks']}{where}")
+    if DEDUPLICATE_TITLES or pipeline:
+        print(f"Skipped untagged titles: {len(result['skipped_list'])}")
+        print(f"Duplicate titles searched once: {result['api_calls_saved']} API calls saved")
+    writes = result['write_stats']
+    if writes.get('seconds'):
+        print(f"Playlist writes: {writes['tracks']} tracks in {writes['batches']} batches, "
+              f"{writes['tracks'] / writes['seconds']:.0f} tracks/s "
+              f"({writes['retries']} retried, {writes['requeues']} resent after earlier batches)")
+    if library:
+        print(f"Matched in your Spotify library: {result['library_matches']} (no search needed)")
+    if catalog:
+        print(f"Matched in the catalog export: {result['catalog_matches']} (no search needed)")
+    if query_planner:
+        stats = query_planner.stats()
+        print("Search queries per stage: " + ", ".join(
+            f"{stage} {stage_stats['calls']} (resolved {stage_stats['resolved']})"
+            for stage, stage_stats in stats["stages"].items()))
+        if stats["calls_per_resolved"]:
+            print(f"Search queries per resolved track: {stats['calls_per_resolved']:.2f}")
+    limiter_stats = spotify.rate_limiter.stats()
+    if limiter_stats["rate"]:
+        print(f"Spotify request rate: {limiter_stats['rate']:.1f}/s (max {limiter_stats['max_rate']:.1f}/s)")
+    print(f"Rate limited {limiter_stats['throttles']} times, "
+          f"{limiter_stats['throttled_seconds']:.1f}s spent waiting on Retry-After")
+    if search_cache:
+        stats = search_cache.stats()
+        print(f"Search cache: {stats['hits']} hits, {stats['misses']} misses "
+              f"({stats['hit_rate'] * 100:.1f}% hit rate, {stats['entries']} entries)")
+        search_cache.close()
 
     # Optionally save not found tracks to a file
-    if result['not_found_tracks'] > 0:
-        with open(NOT_FOUND_FILE, "w", encoding="utf-8") as f:
-            f.write(json.dumps(result['not_found_list'], indent=2))
-        print(f"List of tracks not found saved to {NOT_FOUND_FILE}")
-    
-    # Mention similarity details
-    print(f"Detailed similarity information saved to similarity_details.json")
+    if results:
+        print(f"List of tracks not found streamed to {NOT_FOUND_STREAM}")
+        print(f"Detailed similarity information streamed to {SIMILARITY_DETAILS_STREAM}")
+    else:
+        if result['not_found_tracks'] > 0:
+            with open(NOT_FOUND_FILE, "w", encoding="utf-8") as f:
+                f.write(json.dumps(result['not_found_list'], indent=2))
+            print(f"List of tracks not found saved to {NOT_FOUND_FILE}")
+
+        # Written once here, so a run with a playlist per channel keeps the details of every channel
+        with open(SIMILARITY_DETAILS_FILE, "w", encoding="utf-8") as f:
+            json.dump(result['similarity_details'], f, indent=2, ensure_ascii=False)
+        print(f"Detailed similarity information saved to {SIMILARITY_DETAILS_FILE}")
+
+    if METRICS_FILE:
+        METRICS.set("spotify_throttles", limiter_stats["throttles"])
+        METRICS.set("spotify_throttled_seconds", round(limiter_stats["throttled_seconds"], 3))
+        if writes.get('seconds'):
+            METRICS.set("playlist_write_tracks_per_second", round(writes['tracks'] / writes['seconds'], 1))
+        METRICS.write_json(METRICS_FILE)
+        print(f"Timings and API call metrics saved to {METRICS_FILE}")
+    METRICS.close()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,198 @@
+import json
+from bisect import bisect_left
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+from time import perf_counter, time
+
+# Upper bounds of the latency histogram buckets, in seconds
+BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def series_name(name, labels):
+    """Prometheus series name, e.g. spotify_requests_total{endpoint="search"}"""
+    if not labels:
+        return name
+    return name + "{" + ",".join(f'{key}="{value}"' for key, value in sorted(labels.items())) + "}"
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)  # The last bucket is +Inf
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(BUCKETS, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        """Estimate a quantile by interpolating inside its bucket, like Prometheus' histogram_quantile"""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            if seen + count >= rank and count:
+                lower = BUCKETS[i - 1] if i else 0.0
+                upper = BUCKETS[i] if i < len(BUCKETS) else BUCKETS[-1]
+                return lower + (upper - lower) * (rank - seen) / count
+            seen += count
+        return BUCKETS[-1]
+
+    def to_dict(self):
+        p50, p99 = self.quantile(0.5), self.quantile(0.99)
+        return {
+            "count": self.count,
+            "sum": round(self.sum, 6),
+            "mean": round(self.sum / self.count, 6) if self.count else None,
+            "p50": round(p50, 6) if p50 is not None else None,
+            "p99": round(p99, 6) if p99 is not None else None
+        }
+
+
+class Metrics:
+    """
+    Counters, gauges and latency histograms of a run, shared by every thread. They are written to a
+    JSON file at the end of the run, and can be scraped in Prometheus' text format while it runs.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.started = time()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.server = None
+
+    def inc(self, name, value=1, **labels):
+        key = (name, series_name(name, labels))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.gauges[(name, series_name(name, labels))] = value
+
+    def observe(self, name, seconds, **labels):
+        key = (name, series_name(name, labels))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(seconds)
+
+    @contextmanager
+    def time(self, name, **labels):
+        """Observe how long the block takes, whether it succeeds or not"""
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, perf_counter() - start, **labels)
+
+    def to_dict(self):
+        with self.lock:
+            return {
+                "started_at": self.started,
+                "elapsed_seconds": round(time() - self.started, 3),
+                "counters": {series: value for (_, series), value in sorted(self.counters.items())},
+                "gauges": {series: value for (_, series), value in sorted(self.gauges.items())},
+                "histograms": {series: histogram.to_dict()
+                               for (_, series), histogram in sorted(self.histograms.items())}
+            }
+
+    def write_json(self, path):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+    def prometheus_text(self):
+        lines = []
+        with self.lock:
+            for kind, series in (("counter", self.counters), ("gauge", self.gauges)):
+                last_name = None
+                for (name, key), value in sorted(series.items()):
+                    if name != last_name:
+                        lines.append(f"# TYPE {name} {kind}")
+                        last_name = name
+                    lines.append(f"{key} {value}")
+
+            last_name = None
+            for (name, key), histogram in sorted(self.histograms.items()):
+                if name != last_name:
+                    lines.append(f"# TYPE {name} histogram")
+                    last_name = name
+                labels = key[len(name):].strip("{}")
+                labels = labels + "," if labels else ""
+                cumulative = 0
+                for bound, count in zip(BUCKETS + ("+Inf",), histogram.counts):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{{{labels}le="{bound}"}} {cumulative}')
+                suffix = key[len(name):]
+                lines.append(f"{name}_sum{suffix} {histogram.sum}")
+                lines.append(f"{name}_count{suffix} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port, host="127.0.0.1"):
+        """Serve the metrics in Prometheus' text format on http://host:port/metrics from a background thread"""
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] not in ("/", "/metrics"):
+                    self.send_error(404)
+                    return
+                body = metrics.prometheus_text().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        Thread(target=self.server.serve_forever, daemon=True).start()
+        return self.server.server_address[1]
+
+    def close(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+
+class Progress:
+    """Throughput and ETA of a loop over `total` items, measured from when it was created"""
+
+    def __init__(self, total, name="migration"):
+        self.total = total
+        self.name = name
+        self.started = perf_counter()
+
+    def update(self, done):
+        """Publish the progress as gauges and return (items per second, ETA in seconds or None)"""
+        elapsed = perf_counter() - self.started
+        rate = done / elapsed if elapsed > 0 and done else 0.0
+        eta = (self.total - done) / rate if rate else None
+        METRICS.set(f"{self.name}_items_done", done)
+        METRICS.set(f"{self.name}_items_total", self.total)
+        METRICS.set(f"{self.name}_items_per_second", round(rate, 3))
+        if eta is not None:
+            METRICS.set(f"{self.name}_eta_seconds", round(eta, 1))
+        return rate, eta
+
+
+def format_duration(seconds):
+    if seconds is None:
+        return "unknown"
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}h{minutes:02d}m{seconds:02d}s" if hours else f"{minutes}m{seconds:02d}s"
+
+
+# Metrics of this process, instrumented code records into it directly
+METRICS = Metrics()
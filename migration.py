@@ -0,0 +1,283 @@
+from journal import CheckpointJournal
+from candidate_archive import CandidateArchive
+from added_tracks import AddedTracks
+from utils import group_titles
+from jsonl_output import similarity_record
+from bulk_writer import WriteStats
+from metrics import METRICS, Progress, format_duration
+
+
+class Migration:
+    """
+    Bookkeeping of one migration run: which titles still need a search, how results fan out
+    to duplicate titles, which URIs still have to be sent, and the final report. It makes no
+    API calls itself, so the blocking and the async migration share it.
+    """
+
+    BATCH_SIZE = 100  # Spotify's limit per playlist_add_items call
+
+    def __init__(self, track_titles, similarity_threshold, playlist_id=None, playlist_name=None,
+                 journal_path=None, archive_path=None, dedupe=False, results=None, added_tracks_path=None):
+        self.track_titles = track_titles
+        self.similarity_threshold = similarity_threshold
+        # With a ResultStream every title is written out as soon as it is resolved, and finish()
+        # doesn't collect the similarity details and not found titles in memory
+        self.results = results
+
+        # With a journal, a restarted run with the same inputs skips the work that was already done
+        self.journal = None
+        if journal_path:
+            run_key = CheckpointJournal.make_run_key(track_titles, similarity_threshold, playlist_id, playlist_name,
+                                                     dedupe)
+            self.journal = CheckpointJournal(journal_path, run_key)
+        # Every candidate of every search is archived for offline re-scoring (see rescore.py)
+        self.archive = CandidateArchive(archive_path) if archive_path else None
+        # The tracks this tool added to the playlist and their titles, the only ones pruning may remove
+        self.added_tracks = AddedTracks(added_tracks_path) if added_tracks_path else None
+        self.playlist_key = None
+        self.added_titles = {}  # URI -> titles it was added for, by this run or an earlier one
+        self.found_titles = {}  # URI -> titles it was found for in this run
+
+        # Reposts of the same song are searched once and the result is shared by all of them
+        self.dedupe = dedupe
+        if dedupe:
+            groups, self.skipped = group_titles(track_titles)
+            self.queries = list(groups)
+            self.members = list(groups.values())
+        else:
+            self.skipped = []
+            self.queries = list(track_titles)
+            self.members = [[i] for i in range(len(track_titles))]
+        self.title_tracks = [None] * len(track_titles)
+
+        # Only queries the journal doesn't know about yet are searched
+        self.resolved = {}
+        self.pending_queries = []
+        for i, query in enumerate(self.queries):
+            done, track = self.journal.get_search(i, query) if self.journal else (False, None)
+            if done:
+                self.resolved[i] = track
+            else:
+                self.pending_queries.append(query)
+
+        self.library_hits = 0
+        self.catalog_hits = 0
+        self.failed_queries = []  # Queries whose search job was parked in the dead-letter file
+        self.sync = False
+        self.existing_uris = set()
+        self.snapshot_id = None
+        self.track_uris = []
+        self.pending_uris = []
+        self.sent_uris = set()
+        self.added = 0
+        self.batch_index = 0
+        self.write_stats = WriteStats().to_dict()  # Set by the migration once its playlist writes are done
+        self.progress = None
+
+    def resolve_locally(self, index):
+        """Resolve pending queries against a LibraryIndex or CatalogIndex, returns how many it matched"""
+        pending = [i for i in range(len(self.queries)) if i not in self.resolved]
+        tracks = index.match_all([self.queries[i] for i in pending], self.similarity_threshold)
+        for i, track in zip(pending, tracks):
+            if track:
+                self.resolved[i] = track
+        pending_queries = [self.queries[i] for i in pending if i not in self.resolved]
+        hits = len(self.pending_queries) - len(pending_queries)
+        self.pending_queries = pending_queries
+        return hits
+
+    def resolve_from_library(self, library):
+        """Resolve pending queries against the user's library, so they skip the search API"""
+        self.library_hits = self.resolve_locally(library)
+        print(f"Matched {self.library_hits} tracks in your Spotify library, they won't be searched")
+
+    def resolve_from_catalog(self, catalog):
+        """Resolve pending queries against a local catalog export, so they skip the search API"""
+        self.catalog_hits = self.resolve_locally(catalog)
+        print(f"Matched {self.catalog_hits} tracks in the catalog export, they won't be searched")
+
+    @property
+    def journal_playlist_id(self):
+        return self.journal.playlist_id if self.journal else None
+
+    def use_playlist(self, playlist_id, existing_uris=None, snapshot_id=None, playlist_key=None):
+        """
+        Record the playlist in use; with existing_uris, only URIs missing from it will be sent.
+        The tracks added to it are recorded under playlist_key, the playlist ID by default.
+        """
+        if self.journal and self.journal.playlist_id != playlist_id:
+            self.journal.record_playlist(playlist_id)
+        self.playlist_key = playlist_key or playlist_id
+        if self.added_tracks:
+            self.added_titles = self.added_tracks.get(self.playlist_key)
+        if existing_uris is not None:
+            self.sync = True
+            self.existing_uris = existing_uris
+            self.snapshot_id = snapshot_id
+            self.sent_uris = set(existing_uris)
+            # Tracks removed since they were added (by hand, or pruned) are no longer ours
+            self.added_titles = {uri: titles for uri, titles in self.added_titles.items() if uri in existing_uris}
+            print(f"Playlist already holds {len(existing_uris)} tracks, only missing tracks will be added")
+
+    @property
+    def batch_journal(self):
+        # The diff already keeps sync runs idempotent, and it shifts batch contents between runs
+        return None if self.sync else self.journal
+
+    def print_plan(self, workers=1):
+        print(f"\n===== Searching for Tracks =====")
+        print(f"Searching for {len(self.pending_queries)} tracks on Spotify...")
+        if self.dedupe:
+            print(f"Merged {self.api_calls_saved} duplicate titles, skipped {len(self.skipped)} untagged titles")
+        if self.resolved:
+            print(f"Skipping {len(self.resolved)} tracks already resolved in the journal")
+        print(f"Using similarity threshold of {self.similarity_threshold * 100}%")
+        if workers > 1:
+            print(f"Using {workers} concurrent searches")
+        self.progress = Progress(len(self.queries))
+
+    def print_progress(self, i):
+        if i % 10 == 0:
+            rate, eta = self.progress.update(i)
+            print(f"Progress: {i}/{len(self.queries)} tracks processed ({(i/len(self.queries)*100):.1f}%), "
+                  f"{rate:.1f} tracks/s, ETA {format_duration(eta)}")
+
+    def record(self, i, track, candidates=None, searched=True):
+        """Record the result for query i and fan it out to all titles sharing that query"""
+        query = self.queries[i]
+        if searched:
+            if self.archive:
+                for title_index in self.members[i]:
+                    self.archive.append(self.track_titles[title_index], query, candidates)
+            if self.journal:
+                self.journal.record_search(i, query, track)
+
+        for title_index in self.members[i]:
+            self.title_tracks[title_index] = track
+            if self.results:
+                self.results.record(self.track_titles[title_index], track)
+
+        METRICS.inc("migration_searches_total", result="found" if track else "not_found")
+        if track:
+            self.track_uris.append(track['uri'])
+            self.found_titles.setdefault(track['uri'], []).extend(self.track_titles[t] for t in self.members[i])
+            print(f"Found: {query} → {track['name']} by {track['artist']} (Similarity: {track['similarity']:.2f})")
+            if not self.sync or track['uri'] not in self.sent_uris:
+                self.sent_uris.add(track['uri'])
+                self.pending_uris.append(track['uri'])
+        else:
+            print(f"Not found with enough similarity: {query}")
+
+    def record_failed(self, i, error):
+        """
+        The search for query i kept failing: its titles are neither found nor not found, and it
+        isn't journaled, so a restarted run or a dead-letter replay searches it again
+        """
+        self.failed_queries.append(i)
+        METRICS.inc("migration_searches_total", result="failed")
+        print(f"Search failed, left for a replay: {self.queries[i]} ({type(error).__name__})")
+
+    @property
+    def failed_titles(self):
+        return {title_index for i in self.failed_queries for title_index in self.members[i]}
+
+    @property
+    def prune_allowed(self):
+        """A track whose search failed may still be in the channel, so a run with failures doesn't prune"""
+        if self.failed_queries:
+            print(f"Not pruning the playlist: {len(self.failed_queries)} searches failed")
+            return False
+        return True
+
+    def next_batch(self, final=False):
+        """
+        Return (batch index, URIs) once a full batch is waiting, or whatever is left when final.
+        Committing every full batch right away means an interrupted run still fills the playlist.
+        """
+        if len(self.pending_uris) < self.BATCH_SIZE and not (final and self.pending_uris):
+            return None
+        batch = self.pending_uris[:self.BATCH_SIZE]
+        self.pending_uris = self.pending_uris[self.BATCH_SIZE:]
+        batch_index = self.batch_index
+        self.batch_index += 1
+        return batch_index, batch
+
+    def batch_committed(self, batch, snapshot_id):
+        self.added += len(batch)
+        self.snapshot_id = snapshot_id or self.snapshot_id
+        for uri in batch:
+            self.added_titles.setdefault(uri, [])
+
+    @property
+    def prune_uris(self):
+        """Tracks this tool added to the playlist whose titles are all gone from the channel"""
+        titles = set(self.track_titles)
+        found_uris = set(self.track_uris)
+        return {uri for uri, added_for in self.added_titles.items()
+                if uri in self.existing_uris and uri not in found_uris and titles.isdisjoint(added_for)}
+
+    def save_added_tracks(self):
+        """Record the titles of the tracks this tool added, found again in this run or newly added"""
+        if not self.added_tracks or not self.playlist_key:
+            return
+        for uri, added_for in self.added_titles.items():
+            new_titles = [title for title in self.found_titles.get(uri, []) if title not in added_for]
+            added_for.extend(dict.fromkeys(new_titles))
+        self.added_tracks.save(self.playlist_key, self.added_titles)
+
+    @property
+    def api_calls_saved(self):
+        return len(self.track_titles) - len(self.skipped) - len(self.queries)
+
+    def finish(self, playlist_id, removed=0):
+        """Close the journal and archive, return the summary with the similarity details unless results are streamed"""
+        if self.sync:
+            print(f"Added {self.added} missing tracks, "
+                  f"{len(self.track_uris) - self.added} found tracks were already in the playlist")
+        else:
+            print(f"Playlist now holds the {len(self.track_uris)} found tracks")
+
+        if self.progress:
+            self.progress.update(len(self.queries))
+        if self.journal:
+            self.journal.close()
+        if self.archive:
+            self.archive.close()
+        self.save_added_tracks()
+
+        failed_titles = self.failed_titles
+        if self.results:
+            # Everything was already written out by record()
+            found = sum(1 for track in self.title_tracks if track)
+            not_found_count = len(self.track_titles) - len(self.skipped) - len(failed_titles) - found
+            not_found = []
+            similarity_details = []
+        else:
+            # Fan the results back out to every title, in the original order
+            not_found = []
+            similarity_details = []  # For storing similarity scores
+            skipped_titles = set(self.skipped)
+            for i, (title, track) in enumerate(zip(self.track_titles, self.title_tracks)):
+                if track:
+                    similarity_details.append(similarity_record(title, track))
+                elif i not in skipped_titles and i not in failed_titles:
+                    not_found.append(title)
+            found = len(similarity_details)
+            not_found_count = len(not_found)
+
+        return {
+            "playlist_id": playlist_id,
+            "found_tracks": found,
+            "added_tracks": self.added,
+            "removed_tracks": removed,
+            "not_found_tracks": not_found_count,
+            "not_found_list": not_found,
+            "failed_tracks": len(failed_titles),
+            "failed_list": [self.track_titles[i] for i in sorted(failed_titles)],
+            "skipped_list": [self.track_titles[i] for i in self.skipped],
+            "api_calls_saved": self.api_calls_saved,
+            "library_matches": self.library_hits,
+            "catalog_matches": self.catalog_hits,
+            "write_stats": self.write_stats,
+            "similarity_details": similarity_details
+        }
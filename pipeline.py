@@ -0,0 +1,208 @@
+import asyncio
+from telegram import music_title
+from utils import normalize_title
+from jsonl_output import similarity_record
+from metrics import METRICS
+from candidate_archive import CandidateArchive
+from added_tracks import AddedTracks
+
+# Marks the end of a stage's output on its queue
+END = None
+
+
+async def run_pipeline(telegram, spotify, playlist_id, similarity_threshold, limit=None, min_ids=None,
+                       workers=4, queue_size=200, batch_size=100, sync=False, playlist_name="Telegram Music",
+                       playlist_description="Imported from Telegram", library=None, title_output=None,
+                       results=None, catalog=None, write_concurrency=2, archive_path=None, added_tracks_path=None):
+    """
+    Stream a channel into a playlist: Telegram messages are extracted while earlier titles are
+    being searched, and found URIs are added as soon as a batch fills. Bounded queues between
+    the stages keep a fast stage from running ahead of a slow one. Channels are read one after
+    another; those with a min_id only stream the messages newer than it.
+
+    With a title_output (JsonlWriter), every extracted title is appended to it as it arrives, and
+    with a ResultStream every title is written out as soon as its search finishes. Full batches are
+    handed to a BulkPlaylistWriter, with up to write_concurrency of them in flight.
+
+    With archive_path, every search's candidates are archived for rescore.py, and with
+    added_tracks_path the tracks added are recorded with their titles, as migrate_tracks does.
+    """
+    min_ids = min_ids or {}
+    created = not playlist_id
+    if created:
+        playlist_id = spotify.create_playlist(playlist_name, playlist_description)
+        sync = False
+    else:
+        print(f"\n===== Using Existing Playlist =====")
+        print(f"Using existing playlist with ID: {playlist_id}")
+    # Searches parked from here on are replayed into this playlist
+    spotify.jobs.playlist_id = playlist_id
+
+    existing_uris = set()
+    if sync:
+        existing_uris, _ = await asyncio.to_thread(spotify.get_playlist_state, playlist_id)
+        print(f"Playlist already holds {len(existing_uris)} tracks, only missing tracks will be added")
+    # A new playlist is known to be empty
+    writer = await asyncio.to_thread(spotify.playlist_writer, playlist_id, write_concurrency,
+                                     start_position=0 if created else None)
+
+    title_queue = asyncio.Queue(maxsize=queue_size)
+    uri_queue = asyncio.Queue(maxsize=queue_size)
+    groups = {}  # canonical key -> titles sharing it, in extraction order
+    channel_titles = {}  # channel -> every title extracted from it
+    tracks = {}  # canonical key -> best match or None
+    candidates = {}  # canonical key -> every candidate of its search, when archived
+    failed = set()  # canonical keys whose search job was parked in the dead-letter file
+    skipped = []
+    stats = {"messages": 0, "added": 0, "batches": 0, "library_matches": 0, "catalog_matches": 0}
+
+    print(f"\n===== Streaming Tracks From Telegram to Spotify =====")
+    print(f"Using {workers} search workers, batches of {batch_size} tracks")
+
+    async def extract():
+        for channel in telegram.channels:
+            min_id = min_ids.get(channel, 0)
+            titles = channel_titles.setdefault(channel, [])
+            async for music in telegram.iter_music_files(None if min_id else limit, min_id, channel):
+                stats["messages"] += 1
+                title = music_title(music)
+                key = normalize_title(title) if title else ""
+                if not key:
+                    skipped.append(f"{music.title} - {music.performer}")
+                    continue
+                titles.append(title)
+                if title_output:
+                    title_output.write({"channel": channel, "id": music.id, "title": title})
+                if key in groups:
+                    groups[key].append(title)
+                    # A repost of a song that was already searched
+                    if results and key in tracks:
+                        results.record(title, tracks[key])
+                    continue
+                groups[key] = [title]
+                # Blocks while the search workers are busy, so extraction never runs far ahead
+                await title_queue.put(key)
+                METRICS.set("pipeline_queue_depth", title_queue.qsize(), queue="titles")
+
+        for _ in range(workers):
+            await title_queue.put(END)
+
+    async def search():
+        while (key := await title_queue.get()) is not END:
+            # Titles already in the user's library or in a catalog export skip the search API
+            track = library.match(key, similarity_threshold) if library else None
+            if track:
+                stats["library_matches"] += 1
+            elif catalog and (track := catalog.match(key, similarity_threshold)):
+                stats["catalog_matches"] += 1
+            else:
+                track, found_candidates, error = await asyncio.to_thread(spotify.search_job, key,
+                                                                         similarity_threshold)
+                if error:
+                    # Neither found nor not found, a replay of the dead-letter file searches it again
+                    failed.add(key)
+                    METRICS.inc("migration_searches_total", result="failed")
+                    print(f"Search failed, left for a replay: {key} ({type(error).__name__})")
+                    continue
+                if archive_path:
+                    candidates[key] = found_candidates
+            tracks[key] = track
+            if results:
+                for title in groups[key]:
+                    results.record(title, track)
+            METRICS.inc("migration_searches_total", result="found" if track else "not_found")
+            if track:
+                print(f"Found: {key} → {track['name']} by {track['artist']} (Similarity: {track['similarity']:.2f})")
+                await uri_queue.put(track['uri'])
+                METRICS.set("pipeline_queue_depth", uri_queue.qsize(), queue="uris")
+            else:
+                print(f"Not found with enough similarity: {key}")
+        await uri_queue.put(END)
+
+    async def write():
+        batch = []
+        sent_uris = set(existing_uris)
+        finished_workers = 0
+        while finished_workers < workers:
+            uri = await uri_queue.get()
+            if uri is END:
+                finished_workers += 1
+            elif uri not in sent_uris:
+                sent_uris.add(uri)
+                batch.append(uri)
+
+            if len(batch) == batch_size or (batch and finished_workers == workers):
+                # Sent in the background, only raises if an earlier batch failed
+                writer.add(batch, stats["batches"])
+                stats["added"] += len(batch)
+                stats["batches"] += 1
+                batch = []
+
+    # A failing stage cancels the others instead of leaving them blocked on a queue
+    async with asyncio.TaskGroup() as group:
+        group.create_task(extract())
+        for _ in range(workers):
+            group.create_task(search())
+        group.create_task(write())
+    await asyncio.to_thread(writer.close)
+
+    # Reposts extracted after their song's search are archived and recorded under their own title too
+    if archive_path:
+        archive = CandidateArchive(archive_path)
+        for key, found_candidates in candidates.items():
+            for title in groups[key]:
+                archive.append(title, key, found_candidates)
+        archive.close()
+    if added_tracks_path:
+        added_tracks = AddedTracks(added_tracks_path)
+        added_titles = added_tracks.get(playlist_id)
+        if sync:
+            # Tracks removed since they were added (by hand, or pruned) are no longer ours
+            added_titles = {uri: titles for uri, titles in added_titles.items() if uri in existing_uris}
+        for uri in writer.added_uris:
+            added_titles.setdefault(uri, [])
+        for key, track in tracks.items():
+            if track and track['uri'] in added_titles:
+                added_for = added_titles[track['uri']]
+                added_for.extend(dict.fromkeys(title for title in groups[key] if title not in added_for))
+        added_tracks.save(playlist_id, added_titles)
+
+    # Fan the results out to every title, grouped in extraction order
+    not_found = []
+    similarity_details = []
+    if results:
+        # Already written out as the searches finished
+        found = sum(len(titles) for key, titles in groups.items() if tracks.get(key))
+        not_found_count = sum(len(titles) for key, titles in groups.items() if key not in failed) - found
+    else:
+        for key, titles in groups.items():
+            if key in failed:
+                continue
+            track = tracks.get(key)
+            for title in titles:
+                if track:
+                    similarity_details.append(similarity_record(title, track))
+                else:
+                    not_found.append(title)
+        found = len(similarity_details)
+        not_found_count = len(not_found)
+
+    titles = [title for group_titles in groups.values() for title in group_titles]
+    return {
+        "playlist_id": playlist_id,
+        "titles": titles,
+        "channel_titles": channel_titles,
+        "found_tracks": found,
+        "added_tracks": stats["added"],
+        "removed_tracks": 0,
+        "not_found_tracks": not_found_count,
+        "not_found_list": not_found,
+        "failed_tracks": sum(len(groups[key]) for key in failed),
+        "failed_list": [title for key in failed for title in groups[key]],
+        "skipped_list": skipped,
+        "api_calls_saved": len(titles) - len(groups),
+        "library_matches": stats["library_matches"],
+        "catalog_matches": stats["catalog_matches"],
+        "write_stats": writer.stats.to_dict(),
+        "similarity_details": similarity_details
+    }
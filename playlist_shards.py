@@ -0,0 +1,123 @@
+from threading import Lock
+from bulk_writer import WriteStats
+from session_store import SessionStore
+
+SHARDS_FILE = "./playlist-shards.json"
+
+
+class PlaylistShards:
+    """
+    One playlist spread over numbered playlists ("Telegram Music 1", "Telegram Music 2"...) of at
+    most `max_tracks` tracks each, Spotify's limit being 10,000. A shard is created once the last
+    one is full, and every shard has its own BulkPlaylistWriter, so batches for different shards are
+    added concurrently while searching goes on. The shards, their tracks and snapshot IDs are kept
+    in a mapping file: a later run appends to the last shard and only re-reads the shards that
+    were edited since.
+    """
+
+    MAX_TRACKS = 10000
+
+    def __init__(self, spotify, name, description, mapping_path=SHARDS_FILE, max_tracks=MAX_TRACKS, concurrency=2):
+        self.spotify = spotify
+        self.name = name
+        self.description = description
+        self.store = SessionStore(mapping_path)
+        self.max_tracks = max_tracks
+        self.concurrency = concurrency
+        self.shards = []  # {"id", "name", "snapshot_id", "total", "uris"} of every shard, in order
+        self.writers = {}  # shard index -> BulkPlaylistWriter
+        self.stats = WriteStats()  # Shared by the writers of all shards
+        self.lock = Lock()
+
+    @property
+    def ids(self):
+        return [shard["id"] for shard in self.shards]
+
+    @property
+    def existing_uris(self):
+        return {uri for shard in self.shards for uri in shard["uris"]}
+
+    def load(self):
+        """Read the shards of this playlist from the mapping file, re-reading those edited since it was saved"""
+        print(f"\n===== Using Playlist Shards =====")
+        self.shards = self.store.get(self.name, [])
+        for shard in self.shards:
+            playlist = self.spotify.call(self.spotify.spotify.playlist, shard["id"], fields="snapshot_id,tracks(total)")
+            if playlist["snapshot_id"] != shard["snapshot_id"]:
+                # Edited by hand, or an interrupted run that didn't save its last batches
+                print(f"{shard['name']} changed since the last run, reading it again")
+                uris, snapshot_id = self.spotify.get_playlist_state(shard["id"])
+                shard.update(uris=sorted(uris), snapshot_id=snapshot_id)
+            shard["total"] = playlist["tracks"]["total"]
+        if self.shards:
+            print(f"{self.name} is spread over {len(self.shards)} playlists holding "
+                  f"{sum(shard['total'] for shard in self.shards)} tracks")
+        else:
+            print(f"{self.name} will be split into playlists of at most {self.max_tracks} tracks")
+        return self.shards
+
+    def save(self):
+        with self.lock:
+            self.store.update(**{self.name: self.shards})
+
+    def last_shard(self):
+        """Index of the shard new tracks go to, creating one when there is none or the last one is full"""
+        if self.shards and self.shards[-1]["total"] < self.max_tracks:
+            return len(self.shards) - 1
+        name = f"{self.name} {len(self.shards) + 1}"
+        playlist_id = self.spotify.create_playlist(name, self.description)
+        with self.lock:
+            self.shards.append({"id": playlist_id, "name": name, "snapshot_id": None, "total": 0, "uris": []})
+        # Recorded right away, so a crashed run doesn't leave a playlist no later run knows about
+        self.save()
+        return len(self.shards) - 1
+
+    def add(self, uris, batch_index):
+        """Queue URIs for the last shard, spilling over into new shards; the writes happen in the background"""
+        while uris:
+            shard_index = self.last_shard()
+            shard = self.shards[shard_index]
+            room = self.max_tracks - shard["total"]
+            chunk, uris = uris[:room], uris[room:]
+            if shard_index not in self.writers:
+                self.writers[shard_index] = self.spotify.playlist_writer(shard["id"], self.concurrency,
+                                                                         start_position=shard["total"],
+                                                                         stats=self.stats, name=shard["name"])
+            shard["total"] += len(chunk)
+            self.writers[shard_index].add(chunk, batch_index)
+
+    def flush(self):
+        """Wait for the queued writes and save the mapping, raising the first write that failed"""
+        error = None
+        for shard_index, writer in self.writers.items():
+            try:
+                writer.close()
+            except Exception as e:
+                error = error or e
+            shard = self.shards[shard_index]
+            with self.lock:
+                shard["uris"].extend(writer.added_uris)
+                # Without a snapshot of its last batch, the next run reads the shard again
+                shard["snapshot_id"] = writer.snapshot_id if writer.snapshot_sequence == writer.next_sequence - 1 \
+                    else None
+        self.writers = {}
+        # Even after a failed write, so the batches that made it are known to the next run
+        self.save()
+        if error:
+            raise error
+
+    def prune(self, uris):
+        """Remove the given URIs from the shards holding them, returns the number of tracks removed"""
+        removed = 0
+        for shard in self.shards:
+            shard_uris = uris.intersection(shard["uris"])
+            if not shard_uris:
+                continue
+            shard_removed = self.spotify.prune_playlist(shard["id"], shard_uris, shard["snapshot_id"])
+            if shard_removed:
+                # The snapshot changed with it, the next run reads this shard again
+                shard["uris"] = [uri for uri in shard["uris"] if uri not in shard_uris]
+                shard["total"] -= shard_removed
+                removed += shard_removed
+        self.save()
+        return removed
@@ -0,0 +1,113 @@
+from threading import Lock
+from metrics import METRICS
+from utils import normalize_title, pick_best_match, split_title
+
+
+def field_value(text):
+    # Quotes would end the field filter early
+    return " ".join(text.replace('"', " ").split())
+
+
+class QueryPlanner:
+    """
+    Searches a title with a sequence of queries, most precise first, and only falls back to a
+    broader query when the earlier ones found no match good enough:
+
+      track_artist  track:"title" artist:"performer", needs a performer
+      free_text     the title as is, the only query used before
+      track_only    track:"title" without tags like "(Official Audio)", in case the performer is spelled
+                    differently on Spotify
+
+    Every candidate is scored against the full title, whichever query returned it. Stats per stage
+    show how many calls each stage costs and how many titles it resolves.
+    """
+
+    STAGES = ("track_artist", "free_text", "track_only")
+    # A near-exact match ends the plan; a weaker one that still passes the threshold is only kept
+    # while broader queries look for a better one
+    STOP_SIMILARITY = 0.95
+
+    def __init__(self, stop_similarity=STOP_SIMILARITY, limits=None):
+        # A stage whose best match reaches this similarity (at least the similarity threshold) ends the plan
+        self.stop_similarity = stop_similarity
+        self.limits = {"track_artist": 5, "free_text": 5, "track_only": 10, **(limits or {})}
+        self.lock = Lock()
+        self.calls = dict.fromkeys(self.STAGES, 0)
+        self.resolved = dict.fromkeys(self.STAGES, 0)
+        self.unresolved = 0
+
+    def plan(self, title):
+        """Return the (stage, query, limit) list for a title"""
+        name, performer = split_title(title)
+        queries = []
+        if performer:
+            queries.append(("track_artist", f'track:"{field_value(name)}" artist:"{field_value(performer)}"'))
+        queries.append(("free_text", title))
+        track_only = field_value(normalize_title(name))
+        if performer and track_only:
+            queries.append(("track_only", f'track:"{track_only}"'))
+        return [(stage, query, self.limits[stage]) for stage, query in queries]
+
+    def search(self, title, similarity_threshold, fetch):
+        """
+        Run the plan with fetch(query, limit) returning candidates. Returns (best match or None,
+        every candidate seen); the match carries the stage that found it.
+        """
+        steps = self.plan(title)
+        best = None
+        candidates = []
+        for stage, query, limit in steps:
+            best, done = self.score(title, stage, fetch(query, limit), similarity_threshold, best, candidates)
+            if done:
+                break
+        return self.finish(best), candidates
+
+    async def search_async(self, title, similarity_threshold, fetch):
+        """Same as search, with an async fetch"""
+        steps = self.plan(title)
+        best = None
+        candidates = []
+        for stage, query, limit in steps:
+            best, done = self.score(title, stage, await fetch(query, limit), similarity_threshold, best, candidates)
+            if done:
+                break
+        return self.finish(best), candidates
+
+    def score(self, title, stage, stage_candidates, similarity_threshold, best, candidates):
+        """Merge one stage's candidates in, returns (best match so far, whether the plan can stop)"""
+        with self.lock:
+            self.calls[stage] += 1
+        METRICS.inc("query_plan_calls_total", stage=stage)
+
+        # The same track often comes back from several stages
+        seen = {candidate['uri'] for candidate in candidates}
+        candidates.extend(candidate for candidate in stage_candidates if candidate['uri'] not in seen)
+
+        match = pick_best_match(title, stage_candidates, similarity_threshold)
+        if match and (not best or match['similarity'] > best['similarity']):
+            best = {**match, 'stage': stage}
+        stop_similarity = max(similarity_threshold, self.stop_similarity or 0)
+        return best, best is not None and best['similarity'] >= stop_similarity
+
+    def finish(self, best):
+        with self.lock:
+            if best:
+                self.resolved[best['stage']] += 1
+            else:
+                self.unresolved += 1
+        METRICS.inc("query_plan_resolved_total", stage=best['stage'] if best else "none")
+        return best
+
+    def stats(self):
+        """Calls and resolved titles per stage, and the API calls spent per resolved title"""
+        with self.lock:
+            resolved = sum(self.resolved.values())
+            calls = sum(self.calls.values())
+            return {
+                "stages": {stage: {"calls": self.calls[stage], "resolved": self.resolved[stage]}
+                           for stage in self.STAGES},
+                "resolved": resolved,
+                "unresolved": self.unresolved,
+                "calls": calls,
+                "calls_per_resolved": calls / resolved if resolved else None
+            }
@@ -0,0 +1,115 @@
+import asyncio
+from email.utils import parsedate_to_datetime
+from threading import Lock
+from time import monotonic, sleep, time
+
+
+def parse_retry_after(value):
+    """Seconds to wait from a Retry-After header (seconds or an HTTP date), None if it's missing or unreadable"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time())
+    except (TypeError, ValueError):
+        return None
+
+
+class AdaptiveRateLimiter:
+    """
+    Token bucket shared by every Spotify call, whichever thread makes it.
+    On a 429 every caller pauses for the Retry-After period and the rate is halved; after a run
+    of successful calls it climbs back towards max_rate, so a run settles just below the real quota.
+    A max_rate of 0 or None only honours Retry-After without limiting the rate.
+    """
+
+    # Fallback pause when a 429 comes without a Retry-After header
+    DEFAULT_RETRY_AFTER = 1.0
+    # Successful calls in a row needed before the rate is raised again
+    RECOVER_AFTER = 20
+
+    def __init__(self, max_rate=10.0, min_rate=0.5, burst=None):
+        self.max_rate = max_rate or None
+        self.min_rate = min(min_rate, max_rate) if max_rate else min_rate
+        self.rate = self.max_rate
+        self.capacity = burst or max(1.0, max_rate or 1.0)
+        self.tokens = self.capacity
+        self.updated = monotonic()
+        self.blocked_until = 0.0
+        self.successes = 0
+        self.throttles = 0
+        self.throttled_seconds = 0.0
+        self.lock = Lock()
+
+    def reserve(self):
+        """Take a token and return how long the caller has to wait before using it"""
+        with self.lock:
+            now = monotonic()
+            delay = max(0.0, self.blocked_until - now)
+            if not self.rate:
+                return delay
+
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # Tokens may go negative, later callers queue up behind the debt
+            self.tokens -= 1
+            if self.tokens < 0:
+                delay = max(delay, -self.tokens / self.rate)
+            return delay
+
+    def blocked_for(self):
+        with self.lock:
+            return max(0.0, self.blocked_until - monotonic())
+
+    def wait(self):
+        delay = self.reserve()
+        while delay > 0:
+            sleep(delay)
+            # A 429 may have paused everyone while we were sleeping
+            delay = self.blocked_for()
+
+    async def wait_async(self):
+        """Like wait, but for coroutines, so the event loop keeps running while we wait"""
+        delay = self.reserve()
+        while delay > 0:
+            await asyncio.sleep(delay)
+            delay = self.blocked_for()
+
+    def on_success(self):
+        with self.lock:
+            self.successes += 1
+            if self.rate and self.rate < self.max_rate and self.successes >= self.RECOVER_AFTER:
+                # Additive increase, multiplicative decrease
+                self.rate = min(self.max_rate, self.rate + self.max_rate * 0.1)
+                self.successes = 0
+
+    def on_throttle(self, retry_after=None):
+        """Pause all callers for retry_after seconds and slow down"""
+        pause = retry_after if retry_after is not None else self.DEFAULT_RETRY_AFTER
+        with self.lock:
+            now = monotonic()
+            already_paused = self.blocked_until > now
+            until = now + pause
+            if until > self.blocked_until:
+                # Only count time that isn't already covered by an earlier pause
+                self.throttled_seconds += until - max(self.blocked_until, now)
+                self.blocked_until = until
+            self.successes = 0
+            self.throttles += 1
+
+            # Several in-flight requests usually hit the same 429, slow down only once per pause
+            if self.rate and not already_paused:
+                self.rate = max(self.min_rate, self.rate / 2)
+                self.tokens = min(self.tokens, 0.0)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "rate": self.rate,
+                "max_rate": self.max_rate,
+                "throttles": self.throttles,
+                "throttled_seconds": self.throttled_seconds
+            }
@@ -0,0 +1,108 @@
+import argparse
+import json
+from concurrent.futures import ProcessPoolExecutor
+from os import cpu_count
+from time import perf_counter
+from candidate_archive import CandidateArchive
+from jsonl_output import ResultStream, read_records, similarity_record
+from config import MUSIC_DETAILS_FILE, NOT_FOUND_FILE, DEFAULT_SIMILARITY_THRESHOLD, CANDIDATE_ARCHIVE_FILE, \
+    STREAMING_OUTPUT, OUTPUT_FSYNC_INTERVAL, MUSIC_DETAILS_STREAM, SIMILARITY_DETAILS_STREAM, NOT_FOUND_STREAM, \
+    SIMILARITY_DETAILS_FILE
+from utils import SCORERS, pick_best_match
+
+# Titles handed to a worker process at once
+BATCH_SIZE = 500
+
+
+def score_batch(batch, similarity_threshold, scorer_name):
+    """Score a batch of (title, query, candidates) entries, returns a list of (title, best match or None)"""
+    scorer = SCORERS[scorer_name]
+    return [(title, pick_best_match(query, candidates, similarity_threshold, scorer))
+            for title, query, candidates in batch]
+
+
+def rescore(track_titles, archive, similarity_threshold, scorer_name="levenshtein", workers=None):
+    """Re-apply a threshold and scorer to archived candidates, returns (similarity_details, not_found, missing)"""
+    entries = []
+    missing = []
+    for title in track_titles:
+        if title in archive:
+            entries.append((title, archive[title]["query"], archive[title]["candidates"]))
+        else:
+            missing.append(title)
+
+    batches = [entries[i:i + BATCH_SIZE] for i in range(0, len(entries), BATCH_SIZE)]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        # map() keeps the batches in order, so the output follows the input order
+        results = executor.map(score_batch, batches, [similarity_threshold] * len(batches),
+                               [scorer_name] * len(batches))
+
+        similarity_details = []
+        not_found = []
+        for batch in results:
+            for title, track in batch:
+                if track:
+                    similarity_details.append(similarity_record(title, track))
+                else:
+                    not_found.append(title)
+
+    return similarity_details, not_found, missing
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Re-score archived Spotify search candidates with a new threshold or scorer, without API calls.")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_SIMILARITY_THRESHOLD,
+                        help=f"similarity threshold (0.0-1.0) [{DEFAULT_SIMILARITY_THRESHOLD}]")
+    parser.add_argument("--scorer", choices=sorted(SCORERS), default="levenshtein",
+                        help="similarity scorer [levenshtein]")
+    parser.add_argument("--workers", type=int, default=cpu_count(),
+                        help=f"number of worker processes [{cpu_count()}]")
+    titles_file = MUSIC_DETAILS_STREAM if STREAMING_OUTPUT else MUSIC_DETAILS_FILE
+    parser.add_argument("--titles", default=titles_file, help=f"track titles file, .json or .jsonl [{titles_file}]")
+    parser.add_argument("--archive", default=CANDIDATE_ARCHIVE_FILE,
+                        help=f"search candidate archive [{CANDIDATE_ARCHIVE_FILE}]")
+    args = parser.parse_args()
+
+    if not 0 <= args.threshold <= 1:
+        parser.error("threshold must be between 0.0 and 1.0")
+
+    print("\n===== Re-scoring Archived Search Results =====")
+    # telegram-musics.jsonl holds one record per extracted message, a title can appear more than once
+    track_titles = list(dict.fromkeys(record["title"] if isinstance(record, dict) else record
+                                      for record in read_records(args.titles)))
+    archive = CandidateArchive.load(args.archive)
+    print(f"Loaded {len(track_titles)} titles and {len(archive)} archived searches")
+    print(f"Using similarity threshold: {args.threshold * 100:.1f}%, scorer: {args.scorer}, workers: {args.workers}")
+
+    start = perf_counter()
+    similarity_details, not_found, missing = rescore(track_titles, archive, args.threshold, args.scorer,
+                                                     args.workers)
+    elapsed = perf_counter() - start
+
+    if STREAMING_OUTPUT:
+        details_file, not_found_file = SIMILARITY_DETAILS_STREAM, NOT_FOUND_STREAM
+        results = ResultStream(details_file, not_found_file, OUTPUT_FSYNC_INTERVAL)
+        for record in similarity_details:
+            results.details.write(record)
+        for title in not_found:
+            results.not_found.write(title)
+        results.close()
+    else:
+        details_file, not_found_file = SIMILARITY_DETAILS_FILE, NOT_FOUND_FILE
+        with open(SIMILARITY_DETAILS_FILE, "w", encoding="utf-8") as f:
+            json.dump(similarity_details, f, indent=2, ensure_ascii=False)
+        with open(NOT_FOUND_FILE, "w", encoding="utf-8") as f:
+            f.write(json.dumps(not_found, indent=2))
+
+    print("\n===== Re-scoring Summary =====")
+    print(f"Scored {len(track_titles) - len(missing)} titles in {elapsed:.2f}s")
+    print(f"Matched: {len(similarity_details)} (similarity ≥ {args.threshold * 100:.1f}%)")
+    print(f"Not found or below similarity threshold: {len(not_found)}")
+    if missing:
+        print(f"Not in the archive (run main.py to search them): {len(missing)}")
+    print(f"Results saved to {details_file} and {not_found_file}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+import json
+import sqlite3
+from threading import Lock
+from time import time
+
+
+def normalize_query(query):
+    """Normalize a search query so trivially different spellings share one cache entry"""
+    return " ".join(query.lower().split())
+
+
+class SearchCache:
+    """
+    Persistent SQLite cache of Spotify search candidates, keyed by normalized query and limit.
+    Entries expire after `ttl` seconds and the least recently used ones are evicted
+    once the cache grows past `max_entries`.
+    """
+
+    # How many writes to allow between eviction passes
+    EVICT_EVERY = 200
+
+    def __init__(self, path="./search_cache.sqlite", ttl=30 * 24 * 3600, max_entries=100000):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.writes_since_evict = 0
+        self.lock = Lock()
+
+        # The connection is shared by the search worker threads, access is serialized with self.lock
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS searches (
+                query TEXT NOT NULL,
+                result_limit INTEGER NOT NULL,
+                candidates TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                last_used REAL NOT NULL,
+                PRIMARY KEY (query, result_limit)
+            )
+        """)
+        self.conn.execute("CREATE INDEX IF NOT EXISTS searches_last_used ON searches (last_used)")
+        self.conn.commit()
+        self.evict()
+
+    def get(self, query, limit):
+        """Return the cached candidate list for the query, or None on a miss"""
+        key = normalize_query(query)
+        now = time()
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT candidates, created_at FROM searches WHERE query = ? AND result_limit = ?",
+                (key, limit)
+            ).fetchone()
+            if row is None or (self.ttl and now - row[1] > self.ttl):
+                self.misses += 1
+                return None
+
+            self.conn.execute(
+                "UPDATE searches SET last_used = ? WHERE query = ? AND result_limit = ?",
+                (now, key, limit)
+            )
+            self.conn.commit()
+            self.hits += 1
+        return json.loads(row[0])
+
+    def set(self, query, limit, candidates):
+        key = normalize_query(query)
+        now = time()
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO searches (query, result_limit, candidates, created_at, last_used) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (key, limit, json.dumps(candidates, ensure_ascii=False), now, now)
+            )
+            self.conn.commit()
+            self.writes_since_evict += 1
+            should_evict = self.writes_since_evict >= self.EVICT_EVERY
+
+        if should_evict:
+            self.evict()
+
+    def evict(self):
+        """Drop expired entries, then the least recently used ones above max_entries"""
+        with self.lock:
+            self.writes_since_evict = 0
+            if self.ttl:
+                self.conn.execute("DELETE FROM searches WHERE created_at < ?", (time() - self.ttl,))
+            if self.max_entries:
+                size = self.conn.execute("SELECT COUNT(*) FROM searches").fetchone()[0]
+                if size > self.max_entries:
+                    self.conn.execute(
+                        "DELETE FROM searches WHERE rowid IN "
+                        "(SELECT rowid FROM searches ORDER BY last_used ASC LIMIT ?)",
+                        (size - self.max_entries,)
+                    )
+            self.conn.commit()
+
+    def stats(self):
+        with self.lock:
+            size = self.conn.execute("SELECT COUNT(*) FROM searches").fetchone()[0]
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries": size
+        }
+
+    def close(self):
+        self.evict()
+        with self.lock:
+            self.conn.close()
@@ -0,0 +1,50 @@
+import json
+from os import fsync, replace
+from threading import RLock
+
+SESSION_FILE = "./session_tokens.json"
+
+
+class SessionStore:
+    """
+    A small JSON file read once and kept in memory. Every update rewrites it atomically (a temporary
+    file renamed over it), so an interrupted write never leaves a truncated file behind.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = RLock()
+        self.data = None
+
+    def load(self):
+        """Return a copy of the stored values, {} if the file is missing or unreadable"""
+        with self.lock:
+            if self.data is None:
+                try:
+                    with open(self.path, "r", encoding="utf-8") as f:
+                        self.data = json.loads(f.read())
+                except FileNotFoundError:
+                    self.data = {}
+                except (json.JSONDecodeError, OSError) as e:
+                    print(f"Error loading {self.path}, starting from scratch: {e}")
+                    self.data = {}
+            return dict(self.data)
+
+    def get(self, key, default=None):
+        return self.load().get(key, default)
+
+    def update(self, **values):
+        with self.lock:
+            data = self.load()
+            data.update(values)
+            temp_path = f"{self.path}.tmp"
+            with open(temp_path, "w", encoding="utf-8") as f:
+                f.write(json.dumps(data, indent=2))
+                f.flush()
+                fsync(f.fileno())
+            replace(temp_path, self.path)
+            self.data = data
+
+
+# Telegram session and Spotify tokens, shared by everything that reads or writes them
+SESSION_STORE = SessionStore(SESSION_FILE)
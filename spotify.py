@@ -1,22 +1,80 @@
-import json
+import asyncio
+import requests
 import spotipy
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from spotipy.exceptions import SpotifyException
+from spotipy.cache_handler import MemoryCacheHandler
 from spotipy.oauth2 import SpotifyOAuth
-from utils import calculate_similarity
+from time import perf_counter
+from urllib3.util.retry import Retry
+from metrics import METRICS
+from utils import pick_best_match
+from rate_limiter import AdaptiveRateLimiter, parse_retry_after
+from migration import Migration
+from async_spotify import AsyncSpotifyClient
+from library_index import LibraryIndex
+from token_manager import TokenManager
+from job_queue import JobQueue
+from bulk_writer import BulkPlaylistWriter
+
+
+def count_response_bytes(response, *args, **kwargs):
+    METRICS.inc("spotify_response_bytes_total", len(response.content))
+
+
+def build_requests_session(pool_size=32):
+    """
+    HTTP session for spotipy that still retries connection errors and 5xx responses, but hands
+    429s straight back to us so the shared rate limiter handles them instead of urllib3 sleeping.
+    """
+    retry = Retry(
+        total=3,
+        connect=None,
+        read=False,
+        status=3,
+        backoff_factor=0.3,
+        status_forcelist=(500, 502, 503, 504),
+        # Not POST: a write that failed after Spotify applied it would be applied twice.
+        # BulkPlaylistWriter checks the playlist before retrying a batch instead
+        allowed_methods=frozenset(["GET", "PUT", "DELETE"]),
+        respect_retry_after_header=False,
+        raise_on_status=False
+    )
+    adapter = HTTPAdapter(max_retries=retry, pool_connections=pool_size, pool_maxsize=pool_size)
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.hooks["response"].append(count_response_bytes)
+    return session
 
 
 class Spotify:
-    def __init__(self, client_id, client_secret, redirect_uri, user_id):
+    # How many times a throttled call is retried before giving up
+    THROTTLE_RETRIES = 5
+
+    def __init__(self, client_id, client_secret, redirect_uri, user_id, max_requests_per_second=None,
+                 search_cache=None, query_planner=None, jobs=None):
         print("\n===== Spotify Authentication =====")
         self.client_id = client_id
         self.client_secret = client_secret
         self.redirect_uri = redirect_uri
         self.user_id = user_id
+        # Every Web API call goes through this limiter, whichever thread makes it
+        self.rate_limiter = AdaptiveRateLimiter(max_requests_per_second)
+        # Optional SearchCache, so re-runs only hit the API for titles we haven't searched before
+        self.search_cache = search_cache
+        # Optional QueryPlanner, falling back to broader queries only when precise ones find nothing
+        self.query_planner = query_planner
+        # Searches run as jobs with their own retries, one that keeps failing is parked instead of ending the run
+        self.jobs = jobs or JobQueue()
 
         # load previous sessions or create a new one
         print("Loading Previous Spotify Session If Available...")
-        self.tokens = self.load_tokens()
         self.spotify = None
         self.auth_manager = None
+        self.token_manager = None
         self.initialize_client()
 
     def initialize_client(self):
@@ -27,30 +85,31 @@ class Spotify:
             "user-library-read"
         ]
 
-        # Create auth manager without cache
+        # Tokens live in session_tokens.json, spotipy only keeps them in memory
         self.auth_manager = SpotifyOAuth(
             client_id=self.client_id,
             client_secret=self.client_secret,
             redirect_uri=self.redirect_uri,
             scope=" ".join(scopes),
-            cache_path=None,  # Don't use cache file
+            cache_handler=MemoryCacheHandler(),
             open_browser=False
         )
-        
-        # Check if we have a valid token in session_tokens.json
-        if self.tokens and "spotify" in self.tokens and self.tokens["spotify"]:
+        self.token_manager = TokenManager(self.auth_manager)
+
+        # Check if we have a token in session_tokens.json
+        if self.token_manager.access_token:
             print("Using token from session_tokens.json")
-            token_info = self.auth_manager.refresh_access_token(self.tokens.get("spotify_refresh", "")) if "spotify_refresh" in self.tokens else None
-            
-            if token_info:
-                # If refresh worked, use the new token
-                print("Refreshed Spotify token successfully")
-                self.save_token_info(token_info)
-                self.spotify = spotipy.Spotify(auth=token_info["access_token"])
+            if self.token_manager.is_valid():
+                # No network call needed while the stored token is still valid
+                print(f"Using existing access token, valid for another {self.token_manager.expires_in() / 60:.0f} minutes")
+            elif self.token_manager.refresh_token:
+                try:
+                    self.token_manager.refresh()
+                    print("Refreshed Spotify token successfully")
+                except Exception as e:
+                    print(f"Could not refresh Spotify token, using existing access token: {e}")
             else:
-                # Try to use the access token directly
                 print("Using existing access token")
-                self.spotify = spotipy.Spotify(auth=self.tokens["spotify"])
         else:
             # No token available, need to get a new one
             print("No cached token found, initializing new Spotify authentication...")
@@ -60,16 +119,44 @@ class Spotify:
             print(auth_url)
             print("2. After logging in, you will be redirected.")
             redirected_url = input("3. Paste the redirected URL here: ")
-            
+
             # Get new token from redirect URL
             code = self.auth_manager.parse_response_code(redirected_url)
-            if code:
-                token_info = self.auth_manager.get_access_token(code)
-                self.save_token_info(token_info)
-                self.spotify = spotipy.Spotify(auth=token_info["access_token"])
-                print("New Spotify token obtained and saved")
-            else:
+            if not code:
                 print("Failed to obtain Spotify token")
+                return
+            self.save_token_info(self.auth_manager.get_access_token(code, check_cache=False))
+            print("New Spotify token obtained and saved")
+
+        # spotipy asks the token manager for the token on every request, which keeps it fresh
+        self.spotify = spotipy.Spotify(auth_manager=self.token_manager, requests_session=build_requests_session())
+        self.token_manager.start()
+
+    def call(self, func, *args, **kwargs):
+        """Make a Web API call through the shared rate limiter, waiting out and retrying 429 responses"""
+        endpoint = getattr(func, "__name__", "call")
+        for attempt in range(self.THROTTLE_RETRIES + 1):
+            self.rate_limiter.wait()
+            start = perf_counter()
+            try:
+                result = func(*args, **kwargs)
+            except SpotifyException as e:
+                METRICS.inc("spotify_errors_total", endpoint=endpoint, status=e.http_status)
+                if e.http_status != 429 or attempt == self.THROTTLE_RETRIES:
+                    raise
+                METRICS.inc("spotify_retries_total", endpoint=endpoint, reason=429)
+                # Falls back to the limiter's default pause when the header is missing or unreadable
+                retry_after = parse_retry_after((getattr(e, "headers", None) or {}).get("Retry-After"))
+                print(f"Rate limited by Spotify, pausing for "
+                      f"{retry_after if retry_after is not None else self.rate_limiter.DEFAULT_RETRY_AFTER}s...")
+                self.rate_limiter.on_throttle(retry_after)
+                continue
+            finally:
+                METRICS.inc("spotify_requests_total", endpoint=endpoint)
+                METRICS.observe("spotify_request_seconds", perf_counter() - start, endpoint=endpoint)
+
+            self.rate_limiter.on_success()
+            return result
 
     def create_playlist(self, name, description):
         print(f"\n===== Creating Spotify Playlist =====")
@@ -77,7 +164,8 @@ class Spotify:
             raise Exception("Spotify client not initialized")
 
         print(f"Creating playlist: '{name}' with description: '{description}'")
-        playlist = self.spotify.user_playlist_create(
+        playlist = self.call(
+            self.spotify.user_playlist_create,
             user=self.user_id,
             name=name,
             public=False,
@@ -87,143 +175,386 @@ class Spotify:
         print(f"Created playlist: {name} (ID: {playlist['id']})")
         return playlist['id']
 
-    def search_track(self, query, similarity_threshold=0.5, limit=5):
+    def fetch_candidates(self, query, limit=5):
+        """Return compact search candidates for a query, served from the search cache when possible"""
+        if self.search_cache:
+            candidates = self.search_cache.get(query, limit)
+            METRICS.inc("search_cache_lookups_total", result="miss" if candidates is None else "hit")
+            if candidates is not None:
+                return candidates
+
+        results = self.call(self.spotify.search, q=query, type="track", limit=limit)
+        candidates = [{
+            'id': track['id'],
+            'name': track['name'],
+            'artist': track['artists'][0]['name'],
+            'uri': track['uri']
+        } for track in results['tracks']['items']]
+
+        if self.search_cache:
+            self.search_cache.set(query, limit, candidates)
+        return candidates
+
+    def find_track(self, query, similarity_threshold=0.5, limit=5):
+        """Search for a track, returning both the best match (or None) and every candidate Spotify returned"""
         if not self.spotify:
             raise Exception("Spotify client not initialized")
 
+        if self.query_planner:
+            return self.query_planner.search(query, similarity_threshold, self.fetch_candidates)
+
         # Search for multiple tracks to increase the chance of finding a good match
-        results = self.spotify.search(q=query, type="track", limit=limit)
-        
-        best_match = None
-        best_similarity = 0
-        
-        if results['tracks']['items']:
-            # Check each result for similarity with the query
-            for track in results['tracks']['items']:
-                # Construct a comparable string from the track data
-                track_title = track['name']
-                track_artist = track['artists'][0]['name']
-                track_full = f"{track_title} - {track_artist}"
-                
-                # Calculate similarity
-                similarity = calculate_similarity(query, track_full)
-                
-                # Update best match if this is better
-                if similarity > best_similarity:
-                    best_similarity = similarity
-                    best_match = {
-                        'id': track['id'],
-                        'name': track_title,
-                        'artist': track_artist,
-                        'uri': track['uri'],
-                        'similarity': similarity
-                    }
-            
-            # Only return if the best match is above the threshold
-            if best_match and best_similarity >= similarity_threshold:
-                return best_match
-                
-        return None
-
-    def add_tracks_to_playlist(self, playlist_id, track_uris):
-        print(f"\n===== Adding Tracks to Playlist =====")
+        candidates = self.fetch_candidates(query, limit)
+        return pick_best_match(query, candidates, similarity_threshold), candidates
+
+    def search_track(self, query, similarity_threshold=0.5, limit=5):
+        track, _ = self.find_track(query, similarity_threshold, limit)
+        return track
+
+    def search_job(self, title, similarity_threshold=0.5):
+        """find_track as a job: returns (track, candidates, None), or (None, None, error) once it was parked"""
+        succeeded, result = self.jobs.run(title, self.find_track, title, similarity_threshold)
+        return (*result, None) if succeeded else (None, None, result)
+
+    def load_library(self, include_playlists=False):
+        """Page through the user's saved tracks, and optionally their playlists, into a LibraryIndex"""
+        print(f"\n===== Indexing Your Spotify Library =====")
         if not self.spotify:
             raise Exception("Spotify client not initialized")
 
-        total_tracks = len(track_uris)
-        print(f"Adding {total_tracks} tracks to playlist...")
-        
-        # Split into batches of 100 (Spotify API limit)
-        batch_count = 0
-        for i in range(0, total_tracks, 100):
-            batch_count += 1
-            batch = track_uris[i:i + 100]
-            batch_size = len(batch)
-            print(f"Processing batch {batch_count}: Adding {batch_size} tracks ({i+1}-{min(i+batch_size, total_tracks)} of {total_tracks})")
-            self.spotify.playlist_add_items(playlist_id, batch)
+        library = LibraryIndex()
+        page = self.call(self.spotify.current_user_saved_tracks, limit=50)
+        while page:
+            for item in page["items"]:
+                library.add(item.get("track"))
+            page = self.call(self.spotify.next, page) if page.get("next") else None
+        print(f"Indexed {len(library)} saved tracks")
+
+        if include_playlists:
+            playlists = []
+            page = self.call(self.spotify.current_user_playlists, limit=50)
+            while page:
+                playlists += [playlist["id"] for playlist in page["items"] if playlist]
+                page = self.call(self.spotify.next, page) if page.get("next") else None
+
+            for playlist_id in playlists:
+                page = self.call(self.spotify.playlist_items, playlist_id, limit=100,
+                                 fields="items(track(id,name,uri,artists(name))),next")
+                while page:
+                    for item in page["items"]:
+                        library.add(item.get("track"))
+                    page = self.call(self.spotify.next, page) if page.get("next") else None
+            print(f"Indexed {len(library)} tracks including {len(playlists)} playlists")
+        return library
+
+    def playlist_length(self, playlist_id):
+        return self.call(self.spotify.playlist, playlist_id, fields="tracks(total)")["tracks"]["total"]
 
-        print(f"Successfully added {total_tracks} tracks to playlist")
+    def playlist_writer(self, playlist_id, concurrency=2, journal=None, start_position=None, stats=None, name=None):
+        """A BulkPlaylistWriter appending to the playlist, at start_position if its length is already known"""
+        if start_position is None:
+            start_position = self.playlist_length(playlist_id)
+        return BulkPlaylistWriter(self, playlist_id, start_position, concurrency, journal, stats, name=name)
+
+    def search_tracks(self, track_titles, similarity_threshold=0.5, workers=1):
+        """
+        Yield (title, track, candidates, error) tuples in the same order as track_titles, error
+        being set for searches that kept failing (see JobQueue). With workers > 1 the searches run
+        on a thread pool; the shared rate limiter keeps the combined request rate within the configured limit.
+        """
+        if workers <= 1:
+            for title in track_titles:
+                yield title, *self.search_job(title, similarity_threshold)
+            return
+
+        executor = ThreadPoolExecutor(max_workers=workers)
+        try:
+            # map() returns results in submission order, whatever order they finish in
+            results = executor.map(lambda title: self.search_job(title, similarity_threshold), track_titles)
+            for title, (track, candidates, error) in zip(track_titles, results):
+                yield title, track, candidates, error
+        finally:
+            # If we stopped early (error or Ctrl-C), queued searches are cancelled and in-flight ones waited for
+            executor.shutdown(wait=True, cancel_futures=True)
 
     def migrate_tracks(self, track_titles, playlist_name="Telegram Music",
-                       playlist_description="Imported from Telegram", playlist_id=None, similarity_threshold=0.9):
+                       playlist_description="Imported from Telegram", playlist_id=None, similarity_threshold=0.9,
+                       workers=1, journal_path=None, archive_path=None, sync=False, prune=False, dedupe=False,
+                       library=None, results=None, catalog=None, shards=None, write_concurrency=2,
+                       added_tracks_path=None):
+        """
+        Found tracks are added in the background by a BulkPlaylistWriter, with up to write_concurrency
+        batches in flight, while the searches go on.
+
+        With shards (PlaylistShards), the tracks go to numbered playlists instead of playlist_id, and
+        only the tracks missing from all of them are added, whatever `sync` is set to.
+
+        With added_tracks_path, the tracks added are recorded with their titles, and pruning only
+        removes recorded tracks whose titles are gone from the channel.
+        """
+        run = Migration(track_titles, similarity_threshold, playlist_id, playlist_name, journal_path, archive_path,
+                        dedupe, results, added_tracks_path)
+        # Titles already in the user's library (see load_library) or in a catalog export are never searched
+        if library:
+            run.resolve_from_library(library)
+        if catalog:
+            run.resolve_from_catalog(catalog)
+
         # Create a new playlist if no ID provided
-        if not playlist_id:
+        created = False
+        if shards:
+            shards.load()
+            playlist_id = None
+        elif run.journal_playlist_id:
+            playlist_id = run.journal_playlist_id
+            print(f"\n===== Using Playlist From Journal =====")
+            print(f"Resuming with playlist ID: {playlist_id}")
+        elif not playlist_id:
             playlist_id = self.create_playlist(playlist_name, playlist_description)
+            created = True
         else:
             print(f"\n===== Using Existing Playlist =====")
             print(f"Using existing playlist with ID: {playlist_id}")
 
+        # In sync mode only URIs that aren't in the playlist yet are sent
+        if shards:
+            run.use_playlist(playlist_id, shards.existing_uris, playlist_key=shards.name)
+        elif sync and not created:
+            run.use_playlist(playlist_id, *self.get_playlist_state(playlist_id))
+        else:
+            run.use_playlist(playlist_id)
+        # Searches parked from here on are replayed into this playlist
+        self.jobs.playlist_id = playlist_id
+
+        # A new playlist is known to be empty, an existing one is appended to
+        writer = None if shards else self.playlist_writer(playlist_id, write_concurrency, run.batch_journal,
+                                                          0 if created else None)
+
+        def commit(batch_index, uris):
+            # Written in the background, flush() and close() below wait for them
+            (shards or writer).add(uris, batch_index)
+            return None
+
         # Search for each track and collect URIs
-        track_uris = []
-        not_found = []
-        similarity_details = []  # For storing similarity scores
-
-        print(f"\n===== Searching for Tracks =====")
-        print(f"Searching for {len(track_titles)} tracks on Spotify...")
-        print(f"Using similarity threshold of {similarity_threshold * 100}%")
-
-        for i, title in enumerate(track_titles):
-            if i % 10 == 0:
-                print(f"Progress: {i}/{len(track_titles)} tracks processed ({(i/len(track_titles)*100):.1f}%)")
-
-            track = self.search_track(title, similarity_threshold)
-            if track:
-                track_uris.append(track['uri'])
-                similarity_details.append({
-                    'telegram_title': title,
-                    'spotify_title': f"{track['name']} - {track['artist']}",
-                    'similarity': track['similarity']
-                })
-                print(f"Found: {title} → {track['name']} by {track['artist']} (Similarity: {track['similarity']:.2f})")
+        searches = self.search_tracks(run.pending_queries, similarity_threshold, workers)
+        run.print_plan(workers)
+        for i in range(len(run.queries)):
+            run.print_progress(i)
+            if i in run.resolved:
+                run.record(i, run.resolved[i], searched=False)
             else:
-                not_found.append(title)
-                print(f"Not found with enough similarity: {title}")
-
-        # Add found tracks to the playlist
-        if track_uris:
-            self.add_tracks_to_playlist(playlist_id, track_uris)
-
-        # Save similarity details to a file
-        print(f"\n===== Saving Similarity Details =====")
-        with open("similarity_details.json", "w", encoding="utf-8") as f:
-            json.dump(similarity_details, f, indent=2, ensure_ascii=False)
-        print(f"Similarity details saved to similarity_details.json")
-
-        return {
-            "playlist_id": playlist_id,
-            "found_tracks": len(track_uris),
-            "not_found_tracks": len(not_found),
-            "not_found_list": not_found,
-            "similarity_details": similarity_details
-        }
-
-    def load_tokens(self):
-        """Load all stored tokens from session_tokens.json"""
-        try:
-            with open("./session_tokens.json", "r") as session_file:
-                return json.loads(session_file.read())
-        except Exception as e:
-            print(f"Error loading tokens: {e}")
-            return {}
+                _, track, candidates, error = next(searches)
+                if error:
+                    run.record_failed(i, error)
+                else:
+                    run.record(i, track, candidates)
+
+            batch = run.next_batch()
+            if batch:
+                batch_index, uris = batch
+                run.batch_committed(uris, commit(batch_index, uris))
+
+        # Add the remaining found tracks to the playlist
+        batch = run.next_batch(final=True)
+        if batch:
+            batch_index, uris = batch
+            run.batch_committed(uris, commit(batch_index, uris))
+        if shards:
+            shards.flush()
+            playlist_id = ", ".join(shards.ids)
+            run.write_stats = shards.stats.to_dict()
+        else:
+            writer.close()
+            run.snapshot_id = writer.snapshot_id or run.snapshot_id
+            run.write_stats = writer.stats.to_dict()
+
+        # Optionally remove the tracks that are no longer in the channel
+        removed = 0
+        if run.sync and prune and run.prune_allowed:
+            if shards:
+                removed = shards.prune(run.prune_uris)
+            else:
+                removed = self.prune_playlist(playlist_id, run.prune_uris, run.snapshot_id)
+
+        return run.finish(playlist_id, removed)
+
+    def async_client(self, max_connections=10):
+        """An AsyncSpotifyClient sharing this client's token and rate limiter"""
+        return AsyncSpotifyClient(
+            self.client_id, self.client_secret,
+            rate_limiter=self.rate_limiter, max_connections=max_connections, token_manager=self.token_manager
+        )
+
+    async def fetch_candidates_async(self, client, query, limit=5):
+        """Async variant of fetch_candidates, using the search cache the same way"""
+        candidates = None
+        if self.search_cache:
+            candidates = self.search_cache.get(query, limit)
+            METRICS.inc("search_cache_lookups_total", result="miss" if candidates is None else "hit")
+        if candidates is None:
+            candidates = await client.search(query, limit)
+            if self.search_cache:
+                self.search_cache.set(query, limit, candidates)
+        return candidates
+
+    async def find_track_async(self, client, query, similarity_threshold=0.5, limit=5):
+        """Async variant of find_track"""
+        if self.query_planner:
+            return await self.query_planner.search_async(
+                query, similarity_threshold, lambda planned_query, planned_limit: self.fetch_candidates_async(
+                    client, planned_query, planned_limit))
+
+        candidates = await self.fetch_candidates_async(client, query, limit)
+        return pick_best_match(query, candidates, similarity_threshold), candidates
+
+    async def migrate_tracks_async(self, track_titles, playlist_name="Telegram Music",
+                                   playlist_description="Imported from Telegram", playlist_id=None,
+                                   similarity_threshold=0.9, concurrency=50, journal_path=None, archive_path=None,
+                                   sync=False, prune=False, dedupe=False, max_connections=10, library=None,
+                                   results=None, catalog=None, added_tracks_path=None, write_concurrency=2):
+        """
+        Same as migrate_tracks, but searches run on the asyncio event loop over a pooled connection
+        client, with up to `concurrency` searches in flight at once. Found tracks are added by a
+        BulkPlaylistWriter, like migrate_tracks does, so a batch is never added twice.
+        """
+        run = Migration(track_titles, similarity_threshold, playlist_id, playlist_name, journal_path, archive_path,
+                        dedupe, results, added_tracks_path)
+        if library:
+            run.resolve_from_library(library)
+        if catalog:
+            # Spread over worker processes, so keep the event loop free meanwhile
+            await asyncio.to_thread(run.resolve_from_catalog, catalog)
+
+        async with self.async_client(max_connections) as client:
+            # Create a new playlist if no ID provided
+            created = False
+            if run.journal_playlist_id:
+                playlist_id = run.journal_playlist_id
+                print(f"\n===== Using Playlist From Journal =====")
+                print(f"Resuming with playlist ID: {playlist_id}")
+            elif not playlist_id:
+                playlist_id = await asyncio.to_thread(self.create_playlist, playlist_name, playlist_description)
+                created = True
+            else:
+                print(f"\n===== Using Existing Playlist =====")
+                print(f"Using existing playlist with ID: {playlist_id}")
+
+            # In sync mode only URIs that aren't in the playlist yet are sent
+            if sync and not created:
+                print(f"Reading the current contents of playlist {playlist_id}...")
+                run.use_playlist(playlist_id, *await client.get_playlist_state(playlist_id))
+            else:
+                run.use_playlist(playlist_id)
+            # Searches parked from here on are replayed into this playlist
+            self.jobs.playlist_id = playlist_id
+            # A new playlist is known to be empty, an existing one is appended to
+            writer = await asyncio.to_thread(self.playlist_writer, playlist_id, write_concurrency, run.batch_journal,
+                                             0 if created else None)
+
+            semaphore = asyncio.Semaphore(concurrency)
+
+            async def search(query):
+                async with semaphore:
+                    return await self.jobs.run_async(query, self.find_track_async, client, query,
+                                                     similarity_threshold)
+
+            def commit(batch_index, uris):
+                # Written in the background by the writer's threads, close() below waits for them
+                writer.add(uris, batch_index)
+                return None
+
+            # Results are consumed in input order, whatever order the searches finish in. Only a window of
+            # searches is started ahead of the one being consumed, so a huge channel doesn't create a task per title
+            run.print_plan(concurrency)
+            queries = iter(run.pending_queries)
+            tasks = deque()
+
+            def fill_window():
+                while len(tasks) < concurrency * 2 and (query := next(queries, None)) is not None:
+                    tasks.append(asyncio.create_task(search(query)))
 
-    def save_token_info(self, token_info):
-        """Save both access and refresh tokens to session_tokens.json"""
-        try:
-            # Load existing tokens
             try:
-                with open("./session_tokens.json", "r") as session_file:
-                    tokens = json.loads(session_file.read())
-            except (FileNotFoundError, json.JSONDecodeError):
-                tokens = {"telegram": ""}
-            
-            # Update tokens
-            tokens["spotify"] = token_info.get("access_token", "")
-            tokens["spotify_refresh"] = token_info.get("refresh_token", "")
-            tokens["spotify_expires_at"] = token_info.get("expires_at", 0)
-            
-            # Save updated tokens
-            with open("./session_tokens.json", "w") as session_file:
-                session_file.write(json.dumps(tokens))
-                
-        except Exception as e:
-            print(f"Error saving token info: {e}")
+                for i in range(len(run.queries)):
+                    run.print_progress(i)
+                    if i in run.resolved:
+                        run.record(i, run.resolved[i], searched=False)
+                    else:
+                        fill_window()
+                        succeeded, result = await tasks.popleft()
+                        if succeeded:
+                            run.record(i, *result)
+                        else:
+                            run.record_failed(i, result)
+
+                    batch = run.next_batch()
+                    if batch:
+                        batch_index, uris = batch
+                        run.batch_committed(uris, commit(batch_index, uris))
+            finally:
+                # Don't leave queued searches running if we stopped early
+                for task in tasks:
+                    task.cancel()
+
+            # Add the remaining found tracks to the playlist
+            batch = run.next_batch(final=True)
+            if batch:
+                batch_index, uris = batch
+                run.batch_committed(uris, commit(batch_index, uris))
+            await asyncio.to_thread(writer.close)
+            run.snapshot_id = writer.snapshot_id or run.snapshot_id
+            run.write_stats = writer.stats.to_dict()
+
+        # Pruning is rare and needs the snapshot checks of the blocking client
+        removed = 0
+        if run.sync and prune and run.prune_allowed:
+            removed = await asyncio.to_thread(self.prune_playlist, playlist_id, run.prune_uris, run.snapshot_id)
+
+        return run.finish(playlist_id, removed)
+
+    def get_playlist_state(self, playlist_id):
+        """Read the track URIs of a playlist page by page, returns (set of URIs, snapshot ID)"""
+        if not self.spotify:
+            raise Exception("Spotify client not initialized")
+
+        print(f"Reading the current contents of playlist {playlist_id}...")
+        playlist = self.call(self.spotify.playlist, playlist_id, fields="snapshot_id,tracks(items(track(uri)),next)")
+        page = playlist["tracks"]
+        uris = set()
+        while page:
+            # Unavailable tracks come back without a track object
+            uris.update(item["track"]["uri"] for item in page["items"] if item.get("track"))
+            if not page.get("next"):
+                break
+            page = self.call(self.spotify.next, page)
+
+        return uris, playlist["snapshot_id"]
+
+    def prune_playlist(self, playlist_id, uris, snapshot_id):
+        """
+        Remove the given URIs from the playlist, but only if it hasn't been edited by anyone else
+        since snapshot_id. Returns the number of tracks removed.
+        """
+        print(f"\n===== Pruning Playlist =====")
+        if not uris:
+            print("No tracks to remove")
+            return 0
+
+        current_snapshot = self.call(self.spotify.playlist, playlist_id, fields="snapshot_id")["snapshot_id"]
+        if current_snapshot != snapshot_id:
+            print("Playlist was modified by someone else during the migration, skipping removal")
+            return 0
+
+        uris = list(uris)
+        for i in range(0, len(uris), 100):
+            batch = uris[i:i + 100]
+            print(f"Removing {len(batch)} tracks that are no longer in the channel...")
+            # Passing the snapshot makes Spotify apply the removal to the version we checked
+            snapshot_id = self.call(self.spotify.playlist_remove_all_occurrences_of_items,
+                                    playlist_id, batch, snapshot_id=snapshot_id)["snapshot_id"]
+
+        print(f"Removed {len(uris)} tracks from the playlist")
+        return len(uris)
+
+    def save_token_info(self, token_info):
+        """Use a new token and save it to session_tokens.json"""
+        self.token_manager.save(token_info)
@@ -1,10 +1,52 @@
-import json
+import asyncio
+from dataclasses import dataclass
+from os.path import splitext
 from telethon import TelegramClient
+from telethon.errors import FloodWaitError
 from telethon.sessions import StringSession
-from telethon.tl.types import DocumentAttributeAudio, DocumentAttributeFilename, MessageMediaDocument
+from telethon.tl.types import (DocumentAttributeAudio, DocumentAttributeFilename, InputMessagesFilterMusic,
+                               MessageMediaDocument)
+from metrics import METRICS
+from session_store import SESSION_STORE, SessionStore
+
+# Highest processed message ID per channel, used for incremental extraction
+STATE_FILE = "./telegram-state.json"
+STATE_STORE = SessionStore(STATE_FILE)
+
+
+@dataclass(slots=True)
+class MusicFile:
+    """
+    The fields of an audio message the migration needs. Telethon's message and document objects
+    aren't kept, so a 100k-message channel only holds these few fields per track in memory.
+    """
+    id: int
+    title: str
+    performer: str
+    filename: str
+    duration: int  # Seconds
+    size: int  # Bytes
+
+
+def music_title(music):
+    """
+    Build the "title - performer" string used to search a track. Untagged files fall back to
+    their filename, and None is returned when there is nothing to search for.
+    """
+    title = music.title
+    if title == 'Unknown':
+        title = splitext(music.filename)[0].replace("_", " ").strip()
+        if not title or title.lower() == 'unknown':
+            return None
+    if music.performer == 'Unknown':
+        return title
+    return f"{title} - {music.performer}"
 
 
 class Telegram:
+    # How many times a channel is retried after a Telegram flood wait
+    FLOOD_RETRIES = 3
+
     def __init__(self, api_id, api_hash, channel_username):
         print("\n===== Telegram Authentication =====")
         # try to load previous connection
@@ -12,7 +54,12 @@ class Telegram:
 
         self.session_string = StringSession(telegram_token)
         self.client = TelegramClient(self.session_string, api_id, api_hash)
-        self.channel_username = channel_username
+        # One or more channels, the first one is used when a method isn't given a channel
+        self.channels = [channel_username] if isinstance(channel_username, str) else list(channel_username)
+        self.channel_username = self.channels[0]
+        # Highest message ID seen by the last get_music_files call, overall and per channel
+        self.last_message_id = 0
+        self.last_message_ids = {}
 
     async def init_conn(self, save_session: bool = False) -> None:
         print("Initializing Telegram Connection...")
@@ -23,109 +70,164 @@ class Telegram:
         if save_session:
             self.save_session()
 
-    async def get_music_files(self, limit: int = 100):
-        print(f"\n===== Retrieving Music Files (Limit: {limit}) =====")
+    async def get_music_files(self, limit: int = 100, min_id: int = 0, channel_username: str = None):
+        """
+        Return the latest `limit` audio files of the channel. Telegram filters the messages on its
+        side, so text, photos and videos are never downloaded.
+        With min_id, only messages newer than that ID are fetched (limit=None fetches all of them).
+        """
+        channel_username = channel_username or self.channel_username
+        print(f"\n===== Retrieving Music Files (Limit: {limit or 'none'}) =====")
         # Make sure we're connected
         if not self.client.is_connected():
             await self.client.connect()
             
         # Get the channel entity
-        print(f"Getting channel: {self.channel_username}")
-        channel = await self.client.get_entity(self.channel_username)
+        print(f"Getting channel: {channel_username}")
+        channel = await self.client.get_entity(channel_username)
         
-        # Retrieve messages from the channel
-        print(f"Retrieving messages (limit: {limit})...")
-        messages = await self.client.get_messages(channel, limit=limit)
-
+        # Retrieve the audio messages of the channel, Telethon pages through them 100 at a time
+        if min_id:
+            print(f"Retrieving music newer than ID {min_id} from {channel_username} (limit: {limit or 'none'})...")
+        else:
+            print(f"Retrieving music from {channel_username} (limit: {limit})...")
         music_files = []  # List to store the music files
         process_count = 0
+        self.last_message_id = min_id
+
+        with METRICS.time("telegram_fetch_seconds"):
+            async for msg in self.client.iter_messages(channel, limit=limit, min_id=min_id,
+                                                       filter=InputMessagesFilterMusic):
+                process_count += 1
+                if process_count % 500 == 0:
+                    print(f"Progress: {process_count} messages of {channel_username} processed")
+                self.last_message_id = max(self.last_message_id, msg.id)
 
-        for msg in messages:
-            process_count += 1
-            if process_count % 50 == 0:
-                print(f"Progress: {process_count}/{len(messages)} messages processed")
-                
-            # Check if the message contains media
-            if msg.media and isinstance(msg.media, MessageMediaDocument):
-                document = msg.media.document
-                # Check if the document is not null
-                if document:
-                    # Check if the document attributes indicate it's audio
-                    is_audio = any(attr for attr in document.attributes if isinstance(attr, DocumentAttributeAudio))
-
-                    if is_audio:
-                        # Initialize default values
-                        title = 'Unknown'
-                        performer = 'Unknown'
-                        filename = 'unknown.mp3'
-
-                        # Extract audio attributes
-                        audio_attr = next(
-                            (attr for attr in document.attributes if isinstance(attr, DocumentAttributeAudio)), None)
-                        if audio_attr:
-                            title = audio_attr.title or 'Unknown'
-                            performer = audio_attr.performer or 'Unknown'
-
-                        # Extract filename attribute
-                        filename_attr = next(
-                            (attr for attr in document.attributes if isinstance(attr, DocumentAttributeFilename)), None)
-                        if filename_attr:
-                            filename = filename_attr.file_name or 'unknown.mp3'
-
-                        # Append to music files
-                        music_files.append({
-                            "id": msg.id,
-                            "title": title,
-                            "performer": performer,
-                            "filename": filename,
-                            "file_size": document.size,
-                            "mime_type": document.mime_type,
-                            "date": msg.date,
-                            "document": document
-                        })
-
-        print(f"Found {len(music_files)} music files in the channel.")
+                music = self.extract_music(msg)
+                if music:
+                    music_files.append(music)
+        METRICS.inc("telegram_messages_total", process_count)
+        METRICS.inc("telegram_music_files_total", len(music_files))
+        self.last_message_ids[channel_username] = self.last_message_id
+
+        print(f"Found {len(music_files)} music files in {channel_username}.")
         return music_files
 
+    async def iter_music_files(self, limit: int = 100, min_id: int = 0, channel_username: str = None):
+        """
+        Like get_music_files, but yields each music file as soon as its page of messages
+        arrives instead of collecting the whole channel first.
+        """
+        channel_username = channel_username or self.channel_username
+        if not self.client.is_connected():
+            await self.client.connect()
+
+        print(f"Getting channel: {channel_username}")
+        channel = await self.client.get_entity(channel_username)
+
+        self.last_message_id = min_id
+        async for msg in self.client.iter_messages(channel, limit=limit, min_id=min_id,
+                                                   filter=InputMessagesFilterMusic):
+            self.last_message_id = max(self.last_message_id, msg.id)
+            self.last_message_ids[channel_username] = self.last_message_id
+            METRICS.inc("telegram_messages_total")
+            music = self.extract_music(msg)
+            if music:
+                METRICS.inc("telegram_music_files_total")
+                yield music
+
+    async def extract_channels(self, limit: int = 100, min_ids: dict = None, concurrency: int = 4, output=None):
+        """
+        Extract all channels concurrently over this one client, at most `concurrency` at a time.
+        Channels with a min_id only fetch messages newer than it. Returns {channel: music files}.
+
+        With an output (a JsonlWriter), the title of every music file is appended to it as soon as
+        its message is read instead of being collected, and {channel: titles written} is returned.
+        """
+        min_ids = min_ids or {}
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def stream(limit, min_id, channel_username):
+            written = 0
+            async for music in self.iter_music_files(limit, min_id, channel_username):
+                title = music_title(music)
+                if title:
+                    output.write({"channel": channel_username, "id": music.id, "title": title})
+                    written += 1
+            print(f"Streamed {written} music titles from {channel_username}.")
+            return written
+
+        async def extract(channel_username):
+            async with semaphore:
+                min_id = min_ids.get(channel_username, 0)
+                fetch = stream if output else self.get_music_files
+                for attempt in range(self.FLOOD_RETRIES + 1):
+                    try:
+                        # A streamed channel that is retried is written again, readers drop the repeated titles
+                        return await fetch(None if min_id else limit, min_id, channel_username)
+                    except FloodWaitError as e:
+                        METRICS.inc("telegram_flood_waits_total")
+                        # Telethon sleeps through short flood waits itself, these are the long ones
+                        if attempt == self.FLOOD_RETRIES:
+                            raise
+                        print(f"Telegram asked us to wait {e.seconds}s before reading {channel_username}...")
+                        await asyncio.sleep(e.seconds)
+
+        results = await asyncio.gather(*(extract(channel) for channel in self.channels))
+        return dict(zip(self.channels, results))
+
+    @staticmethod
+    def extract_music(msg):
+        """Return the MusicFile of a message, or None if it doesn't hold an audio file"""
+        # Check if the message contains media
+        if not (msg.media and isinstance(msg.media, MessageMediaDocument)):
+            return None
+
+        document = msg.media.document
+        # Check if the document is not null
+        if not document:
+            return None
+
+        # Check if the document attributes indicate it's audio
+        audio_attr = next(
+            (attr for attr in document.attributes if isinstance(attr, DocumentAttributeAudio)), None)
+        if not audio_attr:
+            return None
+
+        # Extract audio attributes
+        title = audio_attr.title or 'Unknown'
+        performer = audio_attr.performer or 'Unknown'
+
+        # Extract filename attribute
+        filename = 'unknown.mp3'
+        filename_attr = next(
+            (attr for attr in document.attributes if isinstance(attr, DocumentAttributeFilename)), None)
+        if filename_attr:
+            filename = filename_attr.file_name or 'unknown.mp3'
+
+        return MusicFile(msg.id, title, performer, filename, audio_attr.duration or 0, document.size or 0)
+
+    def load_high_water_mark(self, channel_username=None):
+        """Return the highest message ID processed in an earlier run for this channel, 0 if none"""
+        try:
+            return int(STATE_STORE.get(channel_username or self.channel_username, {}).get("max_id", 0))
+        except (AttributeError, TypeError, ValueError) as e:
+            print(f"Error loading {STATE_FILE}, doing a full extraction: {e}")
+            return 0
+
+    def save_high_water_mark(self, max_id, channel_username=None):
+        STATE_STORE.update(**{channel_username or self.channel_username: {"max_id": max_id}})
+
     @staticmethod
     def load_session():
         print("Loading Previous Sessions If Available...")
-        try:
-            with open("./session_tokens.json", "r") as session_file:
-                tokens = json.loads(session_file.read())
-                if "telegram" not in tokens:
-                    raise SyntaxError("Telegram token not found")
-                elif not tokens["telegram"]:
-                    print("No Previous Sessions Found.")
-                return tokens["telegram"] or ''
-        except FileNotFoundError:
+        telegram_token = SESSION_STORE.get("telegram")
+        if telegram_token is None:
             print("No saved session found, will create a new one")
-            return ''
-        except SyntaxError as e:
-            print("Syntax Error Occurred: ", e)
-            return ''
-        except Exception as e:
-            print("An unknown error occurred while attempting to load the saved session:", e)
-            return ''
+        elif not telegram_token:
+            print("No Previous Sessions Found.")
+        return telegram_token or ''
 
     def save_session(self):
-        session_string = self.session_string.save()
-        try:
-            with open("./session_tokens.json", "r") as session_file:
-                tokens = json.loads(session_file.read())
-                if "telegram" not in tokens:
-                    tokens = {"telegram": "", "spotify": ""}
-        except FileNotFoundError:
-            print("No saved session found, will create a new one")
-            tokens = {"telegram": "", "spotify": ""}
-        except SyntaxError as e:
-            print("Syntax Error Occurred: ", e)
-            return
-        except Exception as e:
-            print("An unknown error occurred while attempting to load the saved session:", e)
-            return
-
-        tokens["telegram"] = session_string
-        with open("./session_tokens.json", "w") as session_file:
-            session_file.write(json.dumps(tokens))
+        SESSION_STORE.update(telegram=self.session_string.save())
         print("Session Saved Successfully!")
@@ -0,0 +1,94 @@
+from threading import Lock, Timer
+from time import time
+from metrics import METRICS
+from session_store import SESSION_STORE
+
+
+class TokenManager:
+    """
+    The Spotify access token and its expiry. spotipy takes it as its auth_manager and asks it for
+    the token on every request: a token that is still valid is used without a network call, and a
+    background timer refreshes it shortly before it expires, so long runs never send a stale one.
+    """
+
+    # Refresh in the background this many seconds before the token expires
+    REFRESH_MARGIN = 300
+    # A token closer than this to its expiry is refreshed before it is handed out
+    MIN_VALIDITY = 60
+
+    def __init__(self, oauth, store=SESSION_STORE):
+        self.oauth = oauth
+        self.store = store
+        self.access_token = store.get("spotify") or None
+        self.refresh_token = store.get("spotify_refresh") or None
+        self.expires_at = store.get("spotify_expires_at") or 0
+        self.lock = Lock()
+        self.timer = None
+
+    @property
+    def token_info(self):
+        return {"access_token": self.access_token, "refresh_token": self.refresh_token,
+                "expires_at": self.expires_at}
+
+    def expires_in(self):
+        return self.expires_at - time()
+
+    def is_valid(self, margin=MIN_VALIDITY):
+        # Tokens saved before expires_at was stored count as expired
+        return bool(self.access_token) and self.expires_in() > margin
+
+    def get_access_token(self, as_dict=False):
+        """spotipy's auth_manager interface"""
+        if not self.is_valid() and self.refresh_token:
+            with self.lock:
+                # Another thread may have refreshed it while we were waiting for the lock
+                if not self.is_valid():
+                    self._refresh()
+        return self.token_info if as_dict else self.access_token
+
+    def refresh(self):
+        with self.lock:
+            return self._refresh()
+
+    def _refresh(self):
+        if not self.refresh_token:
+            raise Exception("No Spotify refresh token available")
+        with METRICS.time("spotify_token_refresh_seconds"):
+            token_info = self.oauth.refresh_access_token(self.refresh_token)
+        self.save(token_info)
+        return token_info
+
+    def save(self, token_info):
+        """Use a new token and store it, e.g. one just obtained through the authorization flow"""
+        self.access_token = token_info["access_token"]
+        # Spotify only sometimes rotates the refresh token
+        self.refresh_token = token_info.get("refresh_token") or self.refresh_token
+        self.expires_at = token_info.get("expires_at") or int(time()) + token_info.get("expires_in", 3600)
+        self.store.update(spotify=self.access_token, spotify_refresh=self.refresh_token or "",
+                          spotify_expires_at=self.expires_at)
+        if self.timer:
+            self.start()
+
+    def start(self):
+        """Schedule the background refresh for REFRESH_MARGIN seconds before the token expires"""
+        self.stop()
+        if not self.refresh_token:
+            return
+        # Wait at least half the remaining lifetime, in case Spotify hands out tokens shorter than the margin
+        expires_in = self.expires_in()
+        self.timer = Timer(max(0.0, expires_in - self.REFRESH_MARGIN, expires_in / 2), self.background_refresh)
+        self.timer.daemon = True
+        self.timer.start()
+
+    def stop(self):
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+
+    def background_refresh(self):
+        try:
+            self.refresh()
+            print("Refreshed Spotify token in the background")
+        except Exception as e:
+            # The next request refreshes it instead
+            print(f"Background Spotify token refresh failed: {e}")
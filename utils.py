@@ -1,8 +1,11 @@
+import re
 from os import getenv
 from urllib.parse import urlparse, parse_qs
 from dotenv import load_dotenv
 from spotipy import SpotifyOAuth, Spotify
-import json
+from spotipy.cache_handler import MemoryCacheHandler
+from metrics import METRICS
+from session_store import SESSION_STORE
 
 
 def get_spotify_user_id():
@@ -18,7 +21,7 @@ def get_spotify_user_id():
             client_secret=getenv("SPOTIFY_CLIENT_SECRET"),
             redirect_uri=getenv("SPOTIFY_REDIRECT_URI"),
             scope=scopes,
-            cache_path=None,  # Don't use cache file since we use session_tokens.json
+            cache_handler=MemoryCacheHandler(),  # Don't use cache file since we use session_tokens.json
             open_browser=False
         )
 
@@ -40,7 +43,7 @@ def get_spotify_user_id():
         
         # Exchange the authorization code for an access token
         print("Exchanging authorization code for access token...")
-        token_info = sp_oauth.get_access_token(code)
+        token_info = sp_oauth.get_access_token(code, check_cache=False)
 
         # Save the token info to session_tokens.json
         save_token_info(token_info)
@@ -69,67 +72,193 @@ def get_spotify_user_id():
 
 def save_token_info(token_info):
     """Save token info to session_tokens.json"""
-    try:
-        # Load existing tokens
-        try:
-            with open("./session_tokens.json", "r") as session_file:
-                tokens = json.loads(session_file.read())
-        except (FileNotFoundError, json.JSONDecodeError):
-            tokens = {"telegram": ""}
-        
-        # Update tokens
-        tokens["spotify"] = token_info.get("access_token", "")
-        tokens["spotify_refresh"] = token_info.get("refresh_token", "")
-        tokens["spotify_expires_at"] = token_info.get("expires_at", 0)
-        
-        # Save updated tokens
-        with open("./session_tokens.json", "w") as session_file:
-            session_file.write(json.dumps(tokens))
-            
-    except Exception as e:
-        print(f"Error saving token info: {e}")
+    SESSION_STORE.update(spotify=token_info.get("access_token", ""),
+                         spotify_refresh=token_info.get("refresh_token", ""),
+                         spotify_expires_at=token_info.get("expires_at", 0))
+
+
+def levenshtein_distance(text1, text2, max_distance=None):
+    """
+    Levenshtein distance computed with Myers' bit-parallel algorithm, which processes a whole
+    column of the distance matrix per character using integer bit operations.
+    If max_distance is given, stops early and returns max_distance + 1 as soon as the
+    distance is known to be larger than max_distance.
+    """
+    # A common prefix or suffix never changes the distance
+    start = 0
+    while start < len(text1) and start < len(text2) and text1[start] == text2[start]:
+        start += 1
+    end1, end2 = len(text1), len(text2)
+    while end1 > start and end2 > start and text1[end1 - 1] == text2[end2 - 1]:
+        end1 -= 1
+        end2 -= 1
+    text1, text2 = text1[start:end1], text2[start:end2]
+
+    # Use the shorter string as the bit pattern
+    if len(text1) > len(text2):
+        text1, text2 = text2, text1
+    len1, len2 = len(text1), len(text2)
+
+    # The distance is at least the difference in length
+    if max_distance is not None and len2 - len1 > max_distance:
+        return max_distance + 1
+    if len1 == 0:
+        return len2
+
+    # Bitmask of the positions of each character in the pattern
+    peq = {}
+    for i, char in enumerate(text1):
+        peq[char] = peq.get(char, 0) | (1 << i)
+
+    mask = (1 << len1) - 1
+    last_bit = 1 << (len1 - 1)
+    positive = mask  # vertical +1 deltas
+    negative = 0  # vertical -1 deltas
+    distance = len1
 
+    for j, char in enumerate(text2):
+        eq = peq.get(char, 0)
+        xv = eq | negative
+        xh = (((eq & positive) + positive) ^ positive) | eq
+        horizontal_positive = negative | ~(xh | positive)
+        horizontal_negative = positive & xh
 
-def calculate_similarity(text1, text2):
+        if horizontal_positive & last_bit:
+            distance += 1
+        elif horizontal_negative & last_bit:
+            distance -= 1
+
+        # Each remaining character can lower the distance by at most one
+        if max_distance is not None and distance - (len2 - j - 1) > max_distance:
+            return max_distance + 1
+
+        horizontal_positive = (horizontal_positive << 1) | 1
+        horizontal_negative <<= 1
+        positive = (horizontal_negative | ~(xv | horizontal_positive)) & mask
+        negative = horizontal_positive & xv
+
+    return distance
+
+
+def calculate_similarity(text1, text2, min_similarity=None):
     """
     Calculate similarity between two strings using Levenshtein distance.
     Returns a value between 0 (completely different) and 1 (identical).
+    If min_similarity is given, returns 0.0 early once the similarity is certain to be below it;
+    scores that can reach min_similarity are always exact.
     """
     # Lowercase for better comparison
     text1 = text1.lower()
     text2 = text2.lower()
 
-    # Calculate Levenshtein distance
-    len1, len2 = len(text1), len(text2)
-
-    # Initialize the distance matrix
-    dp = [[0 for _ in range(len2 + 1)] for _ in range(len1 + 1)]
+    max_len = max(len(text1), len(text2))
+    if max_len == 0:  # Handle empty strings
+        return 1.0
 
-    # Fill the matrix
-    for i in range(len1 + 1):
-        dp[i][0] = i
-    for j in range(len2 + 1):
-        dp[0][j] = j
+    # The extra 1 keeps floating point rounding from cutting off a score right at the threshold
+    max_distance = None
+    if min_similarity is not None:
+        max_distance = int(max_len * (1.0 - min_similarity)) + 1
 
-    for i in range(1, len1 + 1):
-        for j in range(1, len2 + 1):
-            cost = 0 if text1[i - 1] == text2[j - 1] else 1
-            dp[i][j] = min(
-                dp[i - 1][j] + 1,  # deletion
-                dp[i][j - 1] + 1,  # insertion
-                dp[i - 1][j - 1] + cost  # substitution
-            )
+    distance = levenshtein_distance(text1, text2, max_distance)
+    if max_distance is not None and distance > max_distance:
+        return 0.0
 
     # Calculate similarity as 1 - normalized distance
-    distance = dp[len1][len2]
-    max_len = max(len1, len2)
-    if max_len == 0:  # Handle empty strings
-        return 1.0
-
     similarity = 1.0 - (distance / max_len)
     return similarity
 
 
+def token_sort_similarity(text1, text2, min_similarity=None):
+    """
+    Like calculate_similarity, but compares the words of both strings in sorted order,
+    so "Artist - Title" and "Title - Artist" are treated as identical.
+    """
+    text1 = " ".join(sorted(text1.lower().replace(" - ", " ").split()))
+    text2 = " ".join(sorted(text2.lower().replace(" - ", " ").split()))
+    return calculate_similarity(text1, text2, min_similarity)
+
+
+# Scorers that can be picked by name, e.g. for offline re-scoring
+SCORERS = {
+    "levenshtein": calculate_similarity,
+    "token_sort": token_sort_similarity
+}
+
+
+def pick_best_match(query, candidates, similarity_threshold=0.5, scorer=calculate_similarity):
+    """
+    Return the candidate most similar to the query with its similarity added,
+    or None if no candidate reaches the similarity threshold.
+    """
+    best_match = None
+    best_similarity = 0
+
+    # Check each result for similarity with the query
+    with METRICS.time("similarity_seconds"):
+        for track in candidates:
+            # Construct a comparable string from the track data
+            track_full = f"{track['name']} - {track['artist']}"
+
+            # Calculate similarity, giving up early on candidates that can't reach the threshold
+            similarity = scorer(query, track_full, similarity_threshold)
+
+            # Update best match if this is better
+            if similarity > best_similarity:
+                best_similarity = similarity
+                best_match = {**track, 'similarity': similarity}
+    METRICS.inc("similarity_comparisons_total", len(candidates))
+
+    # Only return if the best match is above the threshold
+    if best_match and best_similarity >= similarity_threshold:
+        return best_match
+
+    return None
+
+
+# Tags uploaders add to titles that never appear in Spotify track names, e.g. "(Official Audio)"
+TITLE_NOISE_PATTERN = re.compile(
+    r"[(\[]\s*(official\s*)?(music\s*)?(lyrics?\s*)?(audio|video|visuali[sz]er|lyrics?)\s*[)\]]"
+    r"|[(\[]\s*(hq|hd|320\s*(kbps)?|explicit|free download)\s*[)\]]",
+    re.IGNORECASE
+)
+
+
+def normalize_title(title):
+    """
+    Canonical form of a "title - performer" string, used to group reposts of the same song.
+    Returns an empty string when nothing but "Unknown" placeholders is left.
+    """
+    title = TITLE_NOISE_PATTERN.sub(" ", title.lower())
+    parts = [" ".join(part.split()) for part in title.split(" - ")]
+    parts = [part for part in parts if part and part != "unknown"]
+    return " - ".join(parts)
+
+
+def split_title(title):
+    """Split a "title - performer" string as music_title builds it, the performer is "" if there is none"""
+    name, separator, performer = title.rpartition(" - ")
+    if not separator:
+        return title, ""
+    return name, performer
+
+
+def group_titles(titles):
+    """
+    Group titles by their normalized form. Returns (groups, skipped): groups maps each canonical
+    key to the indexes of its titles in order of first appearance, skipped lists the untaggable ones.
+    """
+    groups = {}
+    skipped = []
+    for i, title in enumerate(titles):
+        key = normalize_title(title)
+        if key:
+            groups.setdefault(key, []).append(i)
+        else:
+            skipped.append(i)
+    return groups, skipped
+
+
 if __name__ == "__main__":
     print("\n===== Spotify User ID Helper =====")
     print("This utility helps you get your Spotify User ID for use in the migration tool.")
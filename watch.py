@@ -0,0 +1,313 @@
+import asyncio
+from os import getenv
+from time import perf_counter
+from telethon import events
+from telethon.tl.types import InputMessagesFilterMusic
+from telethon.utils import get_peer_id
+from telegram import Telegram, music_title
+from spotify import Spotify
+from search_cache import SearchCache
+from query_planner import QueryPlanner
+from catalog_index import CatalogIndex
+from metrics import METRICS
+from job_queue import JobQueue
+from config import DEFAULT_SIMILARITY_THRESHOLD, STREAMING_OUTPUT, DEAD_LETTER_FILE
+from main import (REQUIRED_ENVS, SEARCH_WORKERS, SPOTIFY_MAX_RPS, SEARCH_CACHE_FILE, SEARCH_CACHE_TTL_DAYS,
+                  SEARCH_CACHE_MAX_ENTRIES, PLAYLIST_SYNC, QUERY_PLANNER, QUERY_PLAN_STOP_SIMILARITY, LIBRARY_PREPASS,
+                  LIBRARY_INCLUDE_PLAYLISTS, METRICS_PORT, CATALOG_FILE, CATALOG_WORKERS, SEARCH_MAX_ATTEMPTS,
+                  load_channel_titles, save_channel_titles, merge_new_titles, open_title_stream)
+
+# Posts arriving within this many seconds of the first one of a burst are added with one playlist call
+WATCH_COALESCE_SECONDS = float(getenv('WATCH_COALESCE_SECONDS', 2))
+# Longest wait between two reconnection attempts after Telegram dropped the connection
+WATCH_MAX_RECONNECT_DELAY = float(getenv('WATCH_MAX_RECONNECT_DELAY', 300))
+# Attempts to sync a burst before its posts are parked in DEAD_LETTER_FILE for a replay
+WATCH_SYNC_ATTEMPTS = int(getenv('WATCH_SYNC_ATTEMPTS', 5))
+
+
+class PlaylistWatcher:
+    """
+    Keeps a playlist in sync with channels as they post: every new audio message is searched on
+    Spotify and its match added within seconds. Posts of a burst are coalesced into a single
+    playlist_add_items call. When the connection drops, the watcher reconnects and first catches
+    up on the messages posted in the meantime. A burst that keeps failing to sync is retried with
+    backoff, then its posts are parked in the dead-letter file so they don't hold up later ones.
+    """
+
+    BATCH_SIZE = 100  # Spotify's limit per playlist_add_items call
+
+    def __init__(self, telegram, spotify, playlist_id, similarity_threshold, high_water_marks=None,
+                 existing_uris=None, workers=4, coalesce_seconds=2.0, library=None, on_synced=None,
+                 catalog=None, sync_attempts=5, max_retry_delay=300.0):
+        self.telegram = telegram
+        self.spotify = spotify
+        self.playlist_id = playlist_id
+        self.similarity_threshold = similarity_threshold
+        self.workers = workers
+        self.coalesce_seconds = coalesce_seconds
+        self.sync_attempts = max(1, sync_attempts)
+        self.max_retry_delay = max_retry_delay
+        self.library = library
+        self.catalog = catalog
+        # Called with the (channel, message ID, title) entries of every batch once it is in the playlist,
+        # or parked in the dead-letter file
+        self.on_synced = on_synced
+        # Message ID each channel's next catch-up starts after. Only catch-ups move it: a live post
+        # arriving before the catch-up ran must not hide the posts missed while disconnected
+        self.catch_up_ids = dict(high_water_marks or {})
+        self.sent_uris = set(existing_uris or ())
+        self.queue = asyncio.Queue()
+        self.seen = set()  # (channel, message ID) of every post queued since the last catch-up
+        self.channel_ids = {}  # peer ID -> channel username
+        self.batches = 0
+        # (writer, position, URIs) of the last write if it failed without a clear answer
+        self.unconfirmed = None
+
+    def enqueue(self, channel, msg):
+        # The live handler and a catch-up can both see the same post
+        if (channel, msg.id) in self.seen:
+            return
+        self.seen.add((channel, msg.id))
+        music = Telegram.extract_music(msg)
+        title = music_title(music) if music else None
+        if not title:
+            return
+        # The last field counts the failed attempts to sync the post
+        self.queue.put_nowait((channel, msg.id, title, perf_counter(), 0))
+        METRICS.inc("watch_posts_total")
+        print(f"New post in {channel}: {title}")
+
+    async def on_message(self, event):
+        channel = self.channel_ids.get(event.chat_id)
+        if channel:
+            self.enqueue(channel, event.message)
+
+    async def catch_up(self):
+        """Queue the audio posts published since the last catch-up of every channel, oldest first"""
+        # Posts at or below the starting points can't come back
+        self.seen = {(channel, message_id) for channel, message_id in self.seen
+                     if message_id > self.catch_up_ids.get(channel, 0)}
+        for channel in self.telegram.channels:
+            min_id = self.catch_up_ids.get(channel, 0)
+            if not min_id:
+                # Without a high-water mark the channel's history is left to main.py, later catch-ups
+                # start from its newest post
+                latest = await self.telegram.client.get_messages(channel, limit=1)
+                self.catch_up_ids[channel] = latest[0].id if latest else 0
+                continue
+            messages = [msg async for msg in self.telegram.client.iter_messages(channel, min_id=min_id,
+                                                                                filter=InputMessagesFilterMusic)]
+            if messages:
+                print(f"Catching up on {len(messages)} messages posted in {channel} while disconnected")
+            for msg in reversed(messages):
+                self.enqueue(channel, msg)
+            if messages:
+                # Newest first; posts the live handler already queued are skipped by enqueue
+                self.catch_up_ids[channel] = max(min_id, messages[0].id)
+
+    async def search(self, semaphore, title):
+        """Returns (True, the best match or None), or (False, the error) once the search job was parked"""
+        async with semaphore:
+            # Titles already in the user's library or in a catalog export skip the search API
+            track = self.library.match(title, self.similarity_threshold) if self.library else None
+            if not track and self.catalog:
+                track = self.catalog.match(title, self.similarity_threshold)
+            if track:
+                return True, track
+            # A search that keeps failing is parked in the dead-letter file instead of holding up the burst
+            return await asyncio.to_thread(self.spotify.jobs.run, title, self.spotify.search_track, title,
+                                           self.similarity_threshold)
+
+    async def sync_batch(self, batch):
+        """Search the titles of a burst and add the matches with one playlist call"""
+        semaphore = asyncio.Semaphore(self.workers)
+        searches = await asyncio.gather(*(self.search(semaphore, title) for _, _, title, _, _ in batch))
+
+        uris = []
+        for (_, _, title, _, _), (succeeded, track) in zip(batch, searches):
+            if not succeeded:
+                METRICS.inc("migration_searches_total", result="failed")
+                print(f"Search failed, left for a replay: {title}")
+                continue
+            METRICS.inc("migration_searches_total", result="found" if track else "not_found")
+            if not track:
+                print(f"Not found with enough similarity: {title}")
+            elif track['uri'] in self.sent_uris or track['uri'] in uris:
+                print(f"Already in the playlist: {title} → {track['name']} by {track['artist']}")
+            else:
+                print(f"Found: {title} → {track['name']} by {track['artist']} (Similarity: {track['similarity']:.2f})")
+                uris.append(track['uri'])
+
+        if self.unconfirmed:
+            # A burst that failed to sync may still have landed, it's looked up before being sent again
+            writer, position, sent = self.unconfirmed
+            if await asyncio.to_thread(writer.is_in_playlist, position, sent):
+                print(f"{len(sent)} tracks were added despite the last error, not sending them again")
+                self.sent_uris.update(sent)
+            self.unconfirmed = None
+            uris = [uri for uri in uris if uri not in self.sent_uris]
+        if uris:
+            # Appended at the playlist's current end, which may have been edited since the last burst
+            writer = await asyncio.to_thread(self.spotify.playlist_writer, self.playlist_id, 1)
+            position = writer.next_position
+            writer.add(uris, self.batches)
+            try:
+                await asyncio.to_thread(writer.close)
+            except Exception:
+                self.unconfirmed = writer, position, uris
+                raise
+            self.sent_uris.update(uris)
+            self.batches += 1
+        for _, _, _, queued_at, _ in batch:
+            METRICS.observe("watch_sync_seconds", perf_counter() - queued_at)
+        if self.on_synced:
+            self.on_synced([(channel, message_id, title) for channel, message_id, title, _, _ in batch])
+
+    def park(self, batch, error):
+        """Give up on posts that failed every sync attempt, a replay of the dead-letter file searches them again"""
+        for _, _, title, _, attempts in batch:
+            self.spotify.jobs.park(title, error, attempts)
+        METRICS.inc("watch_parked_total", len(batch))
+        if self.on_synced:
+            self.on_synced([(channel, message_id, title) for channel, message_id, title, _, _ in batch])
+
+    async def process(self):
+        """Take the queued posts a burst at a time, waiting coalesce_seconds for more after the first one"""
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.coalesce_seconds
+            while len(batch) < self.BATCH_SIZE:
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), max(0.0, deadline - loop.time())))
+                except asyncio.TimeoutError:
+                    break
+            try:
+                await self.sync_batch(batch)
+            except Exception as e:
+                METRICS.inc("watch_errors_total")
+                batch = [(*item[:4], item[4] + 1) for item in batch]
+                exhausted = [item for item in batch if item[4] >= self.sync_attempts]
+                if exhausted:
+                    print(f"Syncing {len(exhausted)} posts failed {self.sync_attempts} times, parking them: {e}")
+                    self.park(exhausted, e)
+                retry = [item for item in batch if item[4] < self.sync_attempts]
+                if not retry:
+                    continue
+                # Put the rest of the burst back, waiting longer after every failed attempt
+                delay = min(self.max_retry_delay, self.coalesce_seconds * 2 ** max(item[4] for item in retry))
+                print(f"Error syncing {len(retry)} posts, retrying in {delay:.1f}s: {e}")
+                for item in retry:
+                    self.queue.put_nowait(item)
+                await asyncio.sleep(delay)
+
+    async def run(self):
+        client = self.telegram.client
+        for channel in self.telegram.channels:
+            self.channel_ids[get_peer_id(await client.get_entity(channel))] = channel
+        client.add_event_handler(self.on_message, events.NewMessage(chats=list(self.channel_ids)))
+
+        processor = asyncio.create_task(self.process())
+        delay = 1.0
+        try:
+            while True:
+                try:
+                    if not client.is_connected():
+                        print("Reconnecting to Telegram...")
+                        await client.connect()
+                    await self.catch_up()
+                    delay = 1.0
+                    print(f"Watching {', '.join(self.telegram.channels)} for new posts...")
+                    # Telethon reconnects on its own, this only returns once it gave up
+                    await client.run_until_disconnected()
+                    print("Disconnected from Telegram")
+                except (ConnectionError, OSError) as e:
+                    print(f"Telegram connection error: {e}")
+                METRICS.inc("watch_reconnects_total")
+                print(f"Reconnecting in {delay:.0f}s...")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, WATCH_MAX_RECONNECT_DELAY)
+        finally:
+            processor.cancel()
+            client.remove_event_handler(self.on_message)
+
+
+async def main():
+    for env in REQUIRED_ENVS:
+        if getenv(env) is None:
+            raise EnvironmentError(f"{env} is not set!")
+
+    if METRICS_PORT:
+        METRICS.serve(METRICS_PORT)
+        print(f"Serving metrics on http://127.0.0.1:{METRICS_PORT}/metrics")
+
+    channels = [channel.strip() for channel in getenv("TELEGRAM_CHANNEL_USERNAME").split(",") if channel.strip()]
+    tel = Telegram(getenv("TELEGRAM_API_ID"), getenv("TELEGRAM_API_HASH"), channels)
+    await tel.init_conn(True)
+    high_water_marks = {channel: tel.load_high_water_mark(channel) for channel in channels}
+
+    search_cache = None
+    if SEARCH_CACHE_FILE:
+        search_cache = SearchCache(SEARCH_CACHE_FILE, SEARCH_CACHE_TTL_DAYS * 24 * 3600, SEARCH_CACHE_MAX_ENTRIES)
+    query_planner = QueryPlanner(QUERY_PLAN_STOP_SIMILARITY) if QUERY_PLANNER else None
+    jobs = JobQueue(DEAD_LETTER_FILE, SEARCH_MAX_ATTEMPTS)
+    spotify = Spotify(getenv("SPOTIFY_CLIENT_ID"), getenv("SPOTIFY_CLIENT_SECRET"), getenv("SPOTIFY_REDIRECT_URI"),
+                      getenv("SPOTIFY_USER_ID"), SPOTIFY_MAX_RPS, search_cache, query_planner, jobs)
+
+    playlist_id = getenv("SPOTIFY_PLAYLIST_ID")
+    existing_uris = set()
+    if not playlist_id:
+        playlist_name = input("Enter a name for your Spotify playlist [Telegram Music]: ") or "Telegram Music"
+        playlist_description = input("Enter the description for your Spotify playlist [Imported from Telegram]: ") or "Imported from Telegram"
+        playlist_id = spotify.create_playlist(playlist_name, playlist_description)
+        print(f"Set SPOTIFY_PLAYLIST_ID={playlist_id} to keep watching into this playlist after a restart")
+    elif PLAYLIST_SYNC:
+        existing_uris, _ = spotify.get_playlist_state(playlist_id)
+    # Posts parked in the dead-letter file are replayed into this playlist
+    jobs.playlist_id = playlist_id
+    library = spotify.load_library(LIBRARY_INCLUDE_PLAYLISTS) if LIBRARY_PREPASS else None
+    catalog = CatalogIndex.load(CATALOG_FILE, CATALOG_WORKERS) if CATALOG_FILE else None
+
+    # Watched posts are recorded like extracted ones, so the next main.py run neither re-reads nor prunes them
+    channel_titles = load_channel_titles(channels)
+    title_output = open_title_stream(channel_titles) if STREAMING_OUTPUT else None
+
+    def on_synced(entries):
+        for channel in channels:
+            channel_entries = [(message_id, title) for entry_channel, message_id, title in entries
+                               if entry_channel == channel]
+            if not channel_entries:
+                continue
+            if title_output:
+                for message_id, title in channel_entries:
+                    title_output.write({"channel": channel, "id": message_id, "title": title})
+            else:
+                new_titles = [title for _, title in sorted(channel_entries, reverse=True)]
+                channel_titles[channel], _ = merge_new_titles(new_titles, channel_titles.get(channel, []))
+            high_water_marks[channel] = max(high_water_marks.get(channel, 0),
+                                            max(message_id for message_id, _ in channel_entries))
+            tel.save_high_water_mark(high_water_marks[channel], channel)
+        if not title_output:
+            save_channel_titles(channel_titles, channels)
+
+    print("\n===== Watching Channels =====")
+    print(f"Adding new posts to playlist {playlist_id}, bursts within {WATCH_COALESCE_SECONDS}s are added together")
+    watcher = PlaylistWatcher(tel, spotify, playlist_id, DEFAULT_SIMILARITY_THRESHOLD, high_water_marks,
+                              existing_uris, SEARCH_WORKERS, WATCH_COALESCE_SECONDS, library, on_synced,
+                              catalog, WATCH_SYNC_ATTEMPTS, WATCH_MAX_RECONNECT_DELAY)
+    try:
+        await watcher.run()
+    finally:
+        if title_output:
+            title_output.close()
+        jobs.close()
+        if search_cache:
+            search_cache.close()
+        METRICS.close()
+
+
+if __name__ == '__main__':
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        print("\nStopped watching")